@@ -0,0 +1,566 @@
+import asyncio
+import collections
+import socket
+
+import control
+import protocol
+
+# asyncio 版のクライアントライブラリ
+#
+# 1つのイベントループで多数のセッションを同時に扱える（ボット、ブリッジ、負荷試験など）。
+# セッションの状態はすべて ChatSession に持たせ、モジュールのグローバル変数は使わない。
+#
+#   session = await join_room("room", "alice")
+#   await session.send("hello")
+#   async for message in session.messages():
+#       print(message.user_name, message.body)
+#
+# client.py の対話型のクライアントもこのライブラリを使っている。
+
+DEFAULT_HOST = "localhost"
+DEFAULT_TCP_PORT = 9002
+DEFAULT_UDP_PORT = 9001
+
+OPERATION_CREATE = 1
+OPERATION_JOIN = 2
+OPERATION_CONTROL = 3  # 接続を閉じずに制御用の接続として使う（ControlSession）
+
+MAX_ROOMNAME_SIZE = 28
+MAX_USERNAME_SIZE = 229
+
+# 受け取ったまま読まれていないメッセージをいくつまで溜めるか（超えた分は捨てる）
+DEFAULT_QUEUE_SIZE = 1024
+# リレーで受け取ったメッセージの番号をいくつまで覚えておくか（履歴の応答と重なった分を表示しないため）
+RECENT_SEQS_SIZE = 1024
+# 制御用の接続で1回に読むバイト数
+CONTROL_READ_SIZE = 65536
+# テキスト形式ではサーバが待つ時間を教えてくれないので、送信を止めておく秒数
+TEXT_THROTTLE_DELAY = 1.0
+
+# 届かなかったメッセージの再送要求（NACK）
+# 番号の抜けを見つけてから NACK_DELAY 秒待ち（順番が入れ替わっただけのものを除き、まとめて送るため）、
+# まだ届いていない番号を1つの NACK で送る。届くまで NACK_INTERVAL 秒ごとに NACK_ATTEMPTS 回まで送り直す
+NACK_DELAY = 0.01
+NACK_INTERVAL = 0.1
+NACK_ATTEMPTS = 5
+# 1回に抜けとして覚えておく番号の数（これより前の分はあきらめる）
+MAX_MISSING = 1024
+# 1つの NACK に入れる範囲の数（データグラムに収まる数）
+MAX_NACK_RANGES = (
+    protocol.MAX_DATAGRAM_SIZE - protocol.CHAT_HEADER.size - 64
+) // protocol.NACK_RANGE.size
+
+Message = collections.namedtuple("Message", ["seq", "user_name", "body"])
+
+
+class ChatError(Exception):
+    pass
+
+
+class AuthError(ChatError):
+    # サーバがトークンを受け付けなかった（タイムアウトで退出させられた場合など）
+    pass
+
+
+def create_header(room_name_size, operation, state, operation_payload_size):
+    # 各値をバイト列に変換
+    room_name_size_bytes = room_name_size.to_bytes(1, byteorder="big")
+    operation_bytes = operation.to_bytes(1, byteorder="big")
+    state_bytes = state.to_bytes(1, byteorder="big")
+    operation_payload_size_bytes = operation_payload_size.to_bytes(29, byteorder="big")
+
+    # ヘッダーの組み立て
+    header = (
+        room_name_size_bytes
+        + operation_bytes
+        + state_bytes
+        + operation_payload_size_bytes
+    )
+    return header
+
+
+def create_body(room_name, operation_payload):
+    # ルーム名とオペレーションペイロードをUTF-8でバイト列にエンコード
+    room_name_bytes = room_name.encode("utf-8")
+    operation_payload_bytes = operation_payload.encode("utf-8")
+
+    # ボディの組み立て
+    body = room_name_bytes + operation_payload_bytes
+    return body
+
+
+async def handshake(
+    operation: int,
+    room_name: str,
+    user_name: str,
+    host=DEFAULT_HOST,
+    tcp_port=DEFAULT_TCP_PORT,
+    text_frames=False,
+):
+    # TCPでルームの作成または参加を行い、(セッションID, トークン) を返す
+    check_names(room_name, user_name)
+    room_name_bytes = room_name.encode("utf-8")
+    user_name_bytes = user_name.encode("utf-8")
+
+    reader, writer = await asyncio.open_connection(host, tcp_port)
+    try:
+        # ヘッダー（32 バイト）: RoomNameSize（1 バイト） | Operation（1 バイト） | State（1 バイト） | OperationPayloadSize（29 バイト）
+        writer.write(
+            create_header(len(room_name_bytes), operation, 0, len(user_name_bytes))
+            + create_body(room_name, user_name)
+        )
+        await writer.drain()
+
+        # サーバーからの応答（0: 初期化, 1: 処理中, 2: 完了）を待ち受ける
+        while True:
+            response = await reader.read(1)
+            if not response:
+                raise ChatError("connection closed during handshake")
+            if response[0] == 2:
+                break
+            if response[0] == 3:
+                if operation == OPERATION_CREATE:
+                    raise ChatError("chat room {} already exists".format(room_name))
+                raise ChatError("chat room {} does not exist".format(room_name))
+            if response[0] not in (0, 1):
+                raise ChatError("something wrong with starting chatroom")
+
+        # サーバが接続を閉じるまでがトークン
+        response = await reader.read()
+    finally:
+        writer.close()
+
+    session_id = 0
+    if not text_frames:
+        # バイナリフレームの場合はトークンの前にセッションID（4バイト）が付いている
+        (session_id,) = protocol.SESSION_ID.unpack_from(response)
+        response = response[protocol.SESSION_ID.size :]
+    return session_id, response.decode("utf-8")
+
+
+class ControlSession:
+    # 制御用の接続（control.py）。1本の TCP 接続で作成・参加・退出・一覧などを何回でも行う
+    # 応答を待たずに複数のリクエストを送れる（asyncio.gather() でまとめて呼ぶなど）。
+    # 同じイベントループの周回で送られたリクエストは1回の書き込みにまとめ、応答は RequestID で対応を取る
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.next_request_id = 1
+        # RequestID → 応答を待っている Future
+        self.pending = {}
+        # まだ書き込んでいないリクエストのフレーム
+        self.outgoing = []
+        # 接続が切れた理由（切れていなければ None）
+        self.error = None
+        self.receiver = asyncio.create_task(self.receive())
+
+    @property
+    def closed(self) -> bool:
+        return self.error is not None
+
+    async def receive(self):
+        buffer = bytearray()
+        try:
+            while True:
+                data = await self.reader.read(CONTROL_READ_SIZE)
+                if not data:
+                    raise ChatError("control connection closed")
+                buffer += data
+                frames, consumed = control.unpack_frames(
+                    buffer, control.MAX_RESPONSE_SIZE
+                )
+                del buffer[:consumed]
+                for request_id, status, body in frames:
+                    future = self.pending.pop(request_id, None)
+                    if future is not None and not future.done():
+                        future.set_result((status, body))
+        except (ChatError, ValueError, OSError) as e:
+            self.fail(e if isinstance(e, ChatError) else ChatError(str(e)))
+
+    def fail(self, error: ChatError):
+        # 接続が切れたので、応答を待っているリクエストをすべて失敗させる
+        self.error = error
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.pending.clear()
+        self.writer.close()
+
+    def flush(self):
+        if self.outgoing and self.error is None:
+            self.writer.write(b"".join(self.outgoing))
+        self.outgoing.clear()
+
+    async def request(self, operation: int, body: bytes = b""):
+        # リクエストを送って (Status, Body) を返す
+        if self.error is not None:
+            raise self.error
+        request_id = self.next_request_id
+        self.next_request_id = (request_id + 1) & 0xFFFFFFFF
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.outgoing.append(control.pack_frame(request_id, operation, body))
+        if len(self.outgoing) == 1:
+            asyncio.get_running_loop().call_soon(self.flush)
+        return await future
+
+    async def open_room(self, operation: int, room_name: str, user_name: str):
+        # ルームの作成または参加を行い、(セッションID, トークン) を返す
+        check_names(room_name, user_name)
+        status, body = await self.request(
+            operation, control.pack_room_request(room_name, user_name)
+        )
+        if status == control.STATUS_FAILED:
+            if operation == OPERATION_CREATE:
+                raise ChatError("chat room {} already exists".format(room_name))
+            raise ChatError("chat room {} does not exist".format(room_name))
+        check_status(status)
+        return control.unpack_session(body)
+
+    async def create(self, room_name: str, user_name: str):
+        return await self.open_room(OPERATION_CREATE, room_name, user_name)
+
+    async def join(self, room_name: str, user_name: str):
+        return await self.open_room(OPERATION_JOIN, room_name, user_name)
+
+    async def leave(self, session_id: int, token: str):
+        status, _ = await self.request(
+            control.OP_LEAVE, control.pack_session(session_id, token)
+        )
+        check_status(status)
+
+    async def renew(self, session_id: int, token: str) -> str:
+        # 新しいトークンを返す（ランダムなトークンの場合は同じもの）
+        status, body = await self.request(
+            control.OP_RENEW, control.pack_session(session_id, token)
+        )
+        check_status(status)
+        return control.unpack_session(body)[1]
+
+    async def list_rooms(self, prefix: str = "", limit: int = 100):
+        # 名前が prefix で始まるルームの [(ルーム名, 人数), ...] を名前順に返す
+        status, body = await self.request(
+            control.OP_LIST_ROOMS, control.pack_list_request(limit, prefix)
+        )
+        check_status(status)
+        return control.unpack_rooms(body)
+
+    async def list_members(self, room_name: str, limit: int = 1000):
+        status, body = await self.request(
+            control.OP_LIST_MEMBERS, control.pack_list_request(limit, room_name)
+        )
+        if status == control.STATUS_FAILED:
+            raise ChatError("chat room {} does not exist".format(room_name))
+        check_status(status)
+        return control.unpack_names(body)
+
+    def close(self):
+        if self.error is None:
+            self.fail(ChatError("control connection closed"))
+        self.receiver.cancel()
+
+
+def check_names(room_name: str, user_name: str):
+    if len(room_name.encode("utf-8")) > MAX_ROOMNAME_SIZE:
+        raise ValueError("room name must be less than 28 bytes")
+    if len(user_name.encode("utf-8")) > MAX_USERNAME_SIZE:
+        raise ValueError("user name must be less than 229 bytes")
+
+
+def check_status(status: int):
+    if status == control.STATUS_INVALID_TOKEN:
+        raise AuthError("Invalid token")
+    if status != control.STATUS_OK:
+        raise ChatError("control request failed with status {}".format(status))
+
+
+async def connect_control(host=DEFAULT_HOST, tcp_port=DEFAULT_TCP_PORT):
+    # ハンドシェイクで OPERATION_CONTROL を送り、制御用の接続を開く
+    reader, writer = await asyncio.open_connection(host, tcp_port)
+    try:
+        writer.write(create_header(0, OPERATION_CONTROL, 0, 0))
+        # 0（初期化）, 1（処理中）, 2（完了）が届いたら制御用の接続になっている
+        response = await reader.readexactly(3)
+    except asyncio.IncompleteReadError:
+        writer.close()
+        raise ChatError("connection closed during handshake")
+    if response != bytes([0, 1, 2]):
+        writer.close()
+        raise ChatError("server does not support control connections")
+    return ControlSession(reader, writer)
+
+
+class ChatSession(asyncio.DatagramProtocol):
+    # 1人のユーザーの1つのルームでのセッション（UDP）
+    def __init__(
+        self,
+        user_name: str,
+        room_name: str,
+        session_id: int,
+        token: str,
+        server_address,
+        text_frames=False,
+        last_seen=0,
+        queue_size=DEFAULT_QUEUE_SIZE,
+        nack=True,
+        epoch=0,
+    ):
+        self.user_name = user_name
+        self.room_name = room_name
+        self.session_id = session_id
+        self.token = token
+        self.server_address = server_address
+        self.text_frames = text_frames
+        # 最後に受け取ったメッセージの番号（再接続した時に、その後の履歴から受け取るため）
+        self.last_seen = last_seen
+        # last_seen の番号を振ったサーバの Epoch（サーバが再起動すると変わる）
+        self.epoch = epoch
+        # 最近渡したメッセージの番号（履歴とリレーの両方で届いたものや、重複したデータグラムを捨てる）
+        self.recent_seqs = {}
+        # 届かなかったメッセージの番号 → NACK を送った回数（バイナリフレームのみ）
+        self.nack = nack and not text_frames
+        self.missing = {}
+        self.nack_timer = None
+        self.nacks_sent = 0
+        self.recovered = 0  # 再送で届いたメッセージの数
+        self.lost = 0  # 再送を頼んでも届かなかったメッセージの数
+        # トークンを付けた最初のメッセージがサーバに届いたかどうか
+        # メッセージが返ってくるまではトークンを付けて送り続ける（最初のメッセージが失われた場合のため）
+        self.token_acknowledged = False
+        self.queue = asyncio.Queue(queue_size)
+        self.dropped = 0
+        # サーバの送信レートの制限を超えた回数と、送信を再開してよい時刻（loop.time()）
+        self.throttled = 0
+        self.resume_at = 0.0
+        self.transport = None
+        # サーバから戻ってくるフレームには、ユーザー名とヘッダが付く
+        self.max_message_size = protocol.MAX_DATAGRAM_SIZE - protocol.relayed_size(
+            user_name.encode("utf-8"), 0
+        )
+
+    async def open(self, request_history=True):
+        loop = asyncio.get_running_loop()
+        # connect() しておき、サーバ以外から届いたデータグラム（偽の KIND_ERROR など）は受け取らない
+        await loop.create_datagram_endpoint(
+            lambda: self, remote_addr=self.server_address, family=socket.AF_INET
+        )
+        if request_history and not self.text_frames:
+            # 参加する前や、前回抜けていた間に送られたメッセージを送ってもらう
+            # （トークンを付けて送るので、自分が発言する前からリレーも届くようになる）
+            self.transport.sendto(
+                protocol.pack_history_request(
+                    self.session_id,
+                    self.token.encode("utf-8"),
+                    self.last_seen,
+                    self.epoch,
+                )
+            )
+        return self
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        if self.text_frames:
+            text = data.decode("utf-8", "replace")
+            if text == "Invalid token":
+                self.finish(AuthError(text))
+                return
+            if text == "Rate limited":
+                self.throttle(TEXT_THROTTLE_DELAY)
+                return
+            user_name, _, body = text.partition(":")
+            self.deliver(Message(0, user_name, body))
+            return
+
+        frame = protocol.parse_server_frame(data)
+        if frame is None:
+            return
+        kind, content = frame
+        if kind == protocol.KIND_ERROR:
+            if content == "Invalid token":
+                self.finish(AuthError(content))
+            else:
+                self.finish(ChatError(content))
+            return
+        if kind == protocol.KIND_THROTTLE:
+            self.throttle(content)
+            return
+        self.token_acknowledged = True
+        epoch = protocol.frame_epoch(data)
+        if epoch != self.epoch:
+            # サーバが再起動して番号が振り直された。それまでに受け取った番号は忘れる
+            self.epoch = epoch
+            self.last_seen = 0
+            self.missing.clear()
+            self.recent_seqs.clear()
+        for seq, user_name, body in content:
+            # 履歴・再送とリレーの両方で届いたメッセージや、重複して届いたデータグラムは1回だけ渡す
+            if seq in self.recent_seqs:
+                continue
+            if kind == protocol.KIND_HISTORY:
+                if self.missing.pop(seq, None) is not None:
+                    self.recovered += 1
+                self.last_seen = max(self.last_seen, seq)
+            elif self.missing.pop(seq, None) is None and seq > self.last_seen:
+                if self.nack and self.last_seen and seq > self.last_seen + 1:
+                    self.detect_gap(self.last_seen + 1, seq)
+                self.last_seen = seq
+            # （抜けていた番号が遅れて届いた場合は last_seen を戻さない）
+            self.recent_seqs[seq] = None
+            if len(self.recent_seqs) > RECENT_SEQS_SIZE:
+                del self.recent_seqs[next(iter(self.recent_seqs))]
+            self.deliver(Message(seq, user_name, body))
+
+    def error_received(self, exc):
+        pass
+
+    def detect_gap(self, first: int, end: int):
+        # first から end の手前までが届いていない。少し待ってから NACK を送る
+        for seq in range(max(first, end - MAX_MISSING), end):
+            self.missing[seq] = 0
+        if self.nack_timer is None:
+            loop = asyncio.get_running_loop()
+            self.nack_timer = loop.call_later(NACK_DELAY, self.send_nack)
+
+    def send_nack(self):
+        # まだ届いていない番号を連続する範囲にまとめて、1つの NACK で送る
+        self.nack_timer = None
+        if self.transport is None:
+            return
+        ranges = []
+        for seq in sorted(self.missing):
+            attempts = self.missing[seq]
+            if attempts >= NACK_ATTEMPTS:
+                # サーバの再送用の履歴からも消えているなどで届かない
+                del self.missing[seq]
+                self.lost += 1
+                continue
+            if ranges and ranges[-1][0] + ranges[-1][1] == seq:
+                ranges[-1][1] += 1
+            elif len(ranges) < MAX_NACK_RANGES:
+                ranges.append([seq, 1])
+            else:
+                continue
+            self.missing[seq] = attempts + 1
+        if not ranges:
+            return
+        # 抜けに気づくのはリレーを受け取った後（アドレスが登録済み）なので、トークンは付けない
+        self.transport.sendto(protocol.pack_nack(self.session_id, b"", ranges))
+        self.nacks_sent += 1
+        loop = asyncio.get_running_loop()
+        self.nack_timer = loop.call_later(NACK_INTERVAL, self.send_nack)
+
+    def throttle(self, retry_after: float):
+        # 直前に送ったメッセージは捨てられている。しばらく send() を待たせる
+        self.throttled += 1
+        loop = asyncio.get_running_loop()
+        self.resume_at = max(self.resume_at, loop.time() + retry_after)
+
+    def deliver(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def finish(self, item):
+        # 終わり（None）やエラーは必ず読み手に届くよう、キューがいっぱいでも古いものを捨てて入れる
+        while self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(item)
+
+    def encode(self, message: str) -> bytes:
+        if self.text_frames:
+            return "{}:{}:{}:{}".format(
+                self.room_name, self.token, self.user_name, message
+            ).encode("utf-8")
+        # トークンがサーバに届いた後は、短いセッションIDだけで送る
+        token = b"" if self.token_acknowledged else self.token.encode("utf-8")
+        return protocol.pack_chat(self.session_id, token, message.encode("utf-8"))
+
+    async def send(self, message: str):
+        data = self.encode(message)
+        if (
+            len(data) > protocol.MAX_DATAGRAM_SIZE
+            or len(message.encode("utf-8")) > self.max_message_size
+        ):
+            raise ValueError("message should be less than 4096 bytes")
+        # サーバから送信レートの制限を超えたと知らされていたら、再開してよい時刻まで待つ
+        delay = self.resume_at - asyncio.get_running_loop().time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self.transport.sendto(data)
+
+    async def messages(self):
+        # 受け取ったメッセージを届いた順に返す。close() されると終わり、認証エラーなどは例外になる
+        # 再送で届いたメッセージは、その後の番号のメッセージより後になることがある（Message.seq で並べ直せる）
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        if self.nack_timer is not None:
+            self.nack_timer.cancel()
+            self.nack_timer = None
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+            self.finish(None)
+
+
+async def open_session(
+    operation: int,
+    room_name: str,
+    user_name: str,
+    host=DEFAULT_HOST,
+    tcp_port=DEFAULT_TCP_PORT,
+    udp_port=DEFAULT_UDP_PORT,
+    text_frames=False,
+    last_seen=0,
+    queue_size=DEFAULT_QUEUE_SIZE,
+    nack=True,
+    control=None,
+    epoch=0,
+):
+    # control に ControlSession を渡すと、TCP 接続を張り直さずにその接続で作成・参加を行う
+    if control is not None:
+        session_id, token = await control.open_room(operation, room_name, user_name)
+    else:
+        session_id, token = await handshake(
+            operation, room_name, user_name, host, tcp_port, text_frames
+        )
+    loop = asyncio.get_running_loop()
+    addresses = await loop.getaddrinfo(
+        host, udp_port, family=socket.AF_INET, type=socket.SOCK_DGRAM
+    )
+    server_address = addresses[0][4]
+    session = ChatSession(
+        user_name,
+        room_name,
+        session_id,
+        token,
+        server_address,
+        text_frames,
+        last_seen,
+        queue_size,
+        nack,
+        epoch,
+    )
+    return await session.open()
+
+
+async def create_room(room_name: str, user_name: str, **options):
+    # 新しいルームを作成して、そのルームのセッションを返す
+    return await open_session(OPERATION_CREATE, room_name, user_name, **options)
+
+
+async def join_room(room_name: str, user_name: str, **options):
+    # 既存のルームに参加して、そのルームのセッションを返す
+    # last_seen を渡すと、その番号より後の履歴から受け取る
+    # （epoch には前のセッションの ChatSession.epoch を渡す。サーバが再起動していれば最初から受け取る）
+    return await open_session(OPERATION_JOIN, room_name, user_name, **options)
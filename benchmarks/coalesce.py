@@ -0,0 +1,135 @@
+# まとめ送り（--coalesce-ms）のウィンドウごとに、届いたメッセージ1件あたりの
+# サーバの sendto の回数（=送ったパケット数）とCPU時間、増える遅延を測る
+#
+# 1つのルームに --members 人が参加し、そのうち --senders 人が合計 --rate 件/秒で送る。
+#
+#   python -m benchmarks.coalesce --windows 0 2 5 10 --members 20 --rate 500
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+import urllib.request
+
+import asyncclient
+from benchmarks.loadgen import cpu_seconds
+
+PREFIX = "c:"
+
+
+def counters(port):
+    with urllib.request.urlopen("http://127.0.0.1:{}/metrics.json".format(port)) as f:
+        return json.load(f)["counters"]
+
+
+async def run_room(args):
+    options = dict(host=args.host, tcp_port=args.tcp_port, udp_port=args.udp_port)
+    sessions = [await asyncclient.create_room("burst", "user0", **options)]
+    for i in range(1, args.members):
+        sessions.append(
+            await asyncclient.join_room("burst", "user{}".format(i), **options)
+        )
+    latencies = []
+
+    async def receive(session):
+        async for message in session.messages():
+            if message.body.startswith(PREFIX):
+                latencies.append(time.perf_counter() - float(message.body[2:]))
+
+    tasks = [asyncio.create_task(receive(session)) for session in sessions]
+    await asyncio.sleep(0.5)
+    return sessions, latencies, tasks
+
+
+async def send_burst(args, sessions):
+    senders = sessions[: args.senders]
+    interval = 1 / args.rate
+    sent = 0
+    deadline = time.perf_counter() + args.duration
+    next_send = time.perf_counter()
+    while time.perf_counter() < deadline:
+        await senders[sent % len(senders)].send(PREFIX + repr(time.perf_counter()))
+        sent += 1
+        next_send += interval
+        delay = next_send - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    await asyncio.sleep(0.5)
+    return sent
+
+
+async def measure(args, server):
+    sessions, latencies, tasks = await run_room(args)
+    before = counters(args.metrics_port)
+    cpu_before = cpu_seconds([server.pid])
+    sent = await send_burst(args, sessions)
+    cpu = cpu_seconds([server.pid]) - cpu_before
+    after = counters(args.metrics_port)
+    for session in sessions:
+        session.close()
+    await asyncio.gather(*tasks)
+
+    def delta(name):
+        return after.get(name, 0) - before.get(name, 0)
+
+    return sent, sorted(latencies), delta("datagrams_out"), cpu
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--tcp-port", type=int, default=29402)
+    parser.add_argument("--udp-port", type=int, default=29401)
+    parser.add_argument("--metrics-port", type=int, default=29403)
+    parser.add_argument("--windows", type=float, nargs="+", default=[0, 2, 5, 10])
+    parser.add_argument("--members", type=int, default=20)
+    parser.add_argument("--senders", type=int, default=5)
+    parser.add_argument("--rate", type=float, default=500, help="ルーム全体の送信レート（件/秒）")
+    parser.add_argument("--duration", type=float, default=5.0)
+    args = parser.parse_args()
+
+    for window in args.windows:
+        command = [
+            sys.executable,
+            "server.py",
+            "--tcp-port",
+            str(args.tcp_port),
+            "--udp-port",
+            str(args.udp_port),
+            "--metrics-port",
+            str(args.metrics_port),
+            "--coalesce-ms",
+            str(window),
+            "--log-level",
+            "warning",
+        ]
+        server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+        time.sleep(1.0)
+        try:
+            sent, latencies, packets, cpu = asyncio.run(measure(args, server))
+        finally:
+            server.terminate()
+            server.wait()
+
+        delivered = len(latencies)
+        expected = sent * args.members
+
+        def at(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+        print(
+            "window={:>4g}ms delivered={:6.1%} sendto/msg={:.3f} "
+            "cpu={:6.2f}us/msg latency p50={:6.2f}ms p99={:6.2f}ms".format(
+                window,
+                delivered / expected,
+                packets / max(delivered, 1),
+                cpu / max(delivered, 1) * 1e6,
+                at(0.5),
+                at(0.99),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
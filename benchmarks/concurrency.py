@@ -0,0 +1,173 @@
+# 参加・退出とリレーが別々のスレッドで同時に起きる時の索引の安全性とスループットを測る
+#
+# サーバと同じく、リレーは1つのスレッド（UDPのスレッド）で行い、その間に --joiners 個のスレッドが
+# 参加 → アドレス登録 → 退出を繰り返す（ハンドシェイクのスレッドとタイムアウトの代わり）。
+# 送信は何もしないソケットに対して行うので、索引とメンバーの一覧の読み書きのコストだけが出る。
+#
+#   cow     メンバーの一覧はコピーオンライトで、リレーはロックを取らない（server.py の実装）
+#   global  リレーも1メッセージごとに Registry.lock を取る（全体を1つのロックで守る場合）
+#
+# 終わった後に、各ルームのリレー先アドレスの一覧がメンバーの一覧と一致しているかを確認する。
+#
+#   python -m benchmarks.concurrency --rooms 10 --members 100 --joiners 200
+import argparse
+import random
+import sys
+import threading
+import time
+
+import protocol
+import server
+
+
+class NullSocket:
+    # sendto() で何もしないソケット
+    def sendto(self, data, address):
+        return len(data)
+
+
+def build_registry(args):
+    server.registry = server.Registry()
+    server.expiry_scheduler = server.ExpiryScheduler(server.DEFAULT_CLIENT_TIMEOUT)
+    senders = []
+    for room in range(args.rooms):
+        room_name = "room{}".format(room)
+        for i in range(args.members):
+            _, client = server.process_operation(
+                1 if i == 0 else 2, room_name, "user{}".format(i)
+            )
+            address = ("10.0.{}.{}".format(room, i // 250), 10000 + i)
+            server.registry.bind_address(client.room, client, address)
+            if i == 0:
+                frame = protocol.pack_chat(client.userid, b"", b"x" * 64)
+                senders.append((memoryview(frame), len(frame), address))
+    return senders
+
+
+def relay(args, senders, mode, stop, result):
+    # UDPのスレッドの代わり。各ルームの作成者から順番にメッセージを受け取ったことにしてリレーする
+    sock = NullSocket()
+    handle = server.handle_binary_datagram
+    lock = server.registry.lock
+    count = 0
+    errors = 0
+    while not stop.is_set():
+        for view, nbytes, address in senders:
+            try:
+                if mode == "global":
+                    with lock:
+                        handle(sock, view, nbytes, address)
+                else:
+                    handle(sock, view, nbytes, address)
+            except Exception:
+                errors += 1
+        count += len(senders)
+    result["messages"] = count
+    result["errors"] = errors
+
+
+def join_loop(args, index, stop, latencies, errors):
+    # 参加してアドレスを登録し、少し待ってから退出する、を繰り返す
+    rng = random.Random(index)
+    count = 0
+    while not stop.is_set():
+        room_name = "room{}".format(rng.randrange(args.rooms))
+        user_name = "joiner{}-{}".format(index, count)
+        host = "10.1.{}.{}".format(index // 250, index % 250)
+        address = (host, 20000 + count % 40000)
+        started = time.perf_counter()
+        try:
+            _, client = server.process_operation(2, room_name, user_name)
+            room = client.room
+            server.registry.bind_address(room, client, address)
+            latencies.append(time.perf_counter() - started)
+            time.sleep(args.stay)
+            server.registry.remove_client(room, client)
+        except Exception:
+            errors.append(sys.exc_info()[1])
+        count += 1
+        time.sleep(args.interval)
+
+
+def check_consistency():
+    # リレー先アドレスの一覧とメンバーの一覧、アドレスの索引が一致しているか
+    registry = server.registry
+    broken = 0
+    for room in list(registry.rooms.values()):
+        expected = sorted(
+            client.address
+            for client in room.active_clients.values()
+            if client.address is not None
+        )
+        if sorted(room.addresses) != expected:
+            broken += 1
+        for client in room.active_clients.values():
+            if client.address is None:
+                continue
+            if registry.addresses.get(client.address) is not client:
+                broken += 1
+    return broken
+
+
+def run(args, mode, joiners):
+    senders = build_registry(args)
+    stop = threading.Event()
+    result = {}
+    latencies = []
+    errors = []
+    threads = [
+        threading.Thread(target=relay, args=(args, senders, mode, stop, result))
+    ]
+    threads += [
+        threading.Thread(target=join_loop, args=(args, index, stop, latencies, errors))
+        for index in range(joiners)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+
+    def at(p):
+        if not latencies:
+            return float("nan")
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    print(
+        "{:<6} joiners={:<4} relay={:8.0f} msg/s joins={:6.0f}/s "
+        "join p50={:6.2f}ms p99={:7.2f}ms errors={} inconsistent={}".format(
+            mode,
+            joiners,
+            result["messages"] / elapsed,
+            len(latencies) / elapsed,
+            at(0.5),
+            at(0.99),
+            result["errors"] + len(errors),
+            check_consistency(),
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--members", type=int, default=100)
+    parser.add_argument("--joiners", type=int, default=200)
+    parser.add_argument("--stay", type=float, default=0.05, help="参加してから退出するまでの秒数")
+    parser.add_argument("--interval", type=float, default=0.01, help="退出してから次に参加するまでの秒数")
+    parser.add_argument("--duration", type=float, default=5.0)
+    args = parser.parse_args()
+
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print("python {} (GIL {})".format(sys.version.split()[0], "on" if gil else "off"))
+    for mode in ("cow", "global"):
+        run(args, mode, 0)
+        run(args, mode, args.joiners)
+
+
+if __name__ == "__main__":
+    main()
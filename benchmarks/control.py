@@ -0,0 +1,126 @@
+# 1本の制御用の接続で操作を続けて行う場合と、操作ごとにTCP接続を張る場合（従来のハンドシェイク）の
+# 1秒あたりの操作数を比べる
+#
+#   per-connection  操作ごとに接続して閉じる。--concurrency 個を同時に行う
+#   control         1本の制御用の接続で、応答を待ってから次を送る（--concurrency 1）か、
+#                   --concurrency 個の応答を待たずに送る（パイプライン）
+#
+# 操作はルームへの参加（毎回新しいユーザー）と、前方一致でのルームの一覧。
+#
+#   python -m benchmarks.control --operations 5000 --concurrency 1 64
+import argparse
+import asyncio
+import subprocess
+import sys
+import time
+
+import asyncclient
+
+ROOMS = 100
+
+
+async def run_operations(count, concurrency, operation):
+    # operation(i) を count 回、同時に concurrency 個まで実行し、(操作数/秒, 遅延の p50) を返す
+    latencies = []
+    next_index = 0
+
+    async def worker():
+        nonlocal next_index
+        while next_index < count:
+            index = next_index
+            next_index += 1
+            started = time.perf_counter()
+            await operation(index)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return count / elapsed, latencies[len(latencies) // 2] * 1000
+
+
+async def measure(args):
+    host = "127.0.0.1"
+    setup = await asyncclient.connect_control(host, args.tcp_port)
+    await asyncio.gather(
+        *[setup.create("room{}".format(i), "owner") for i in range(ROOMS)]
+    )
+    setup.close()
+    run = 0
+
+    for concurrency in args.concurrency:
+        for mode in ("per-connection", "control"):
+            run += 1
+            prefix = "r{}-".format(run)
+            control = None
+            if mode == "control":
+                control = await asyncclient.connect_control(host, args.tcp_port)
+
+            async def join(index):
+                room_name = "room{}".format(index % ROOMS)
+                user_name = prefix + str(index)
+                if control is None:
+                    await asyncclient.handshake(
+                        asyncclient.OPERATION_JOIN,
+                        room_name,
+                        user_name,
+                        host,
+                        args.tcp_port,
+                    )
+                else:
+                    await control.join(room_name, user_name)
+
+            async def list_rooms(index):
+                if control is None:
+                    # 従来の接続には一覧の操作がないので、比べるのは制御用の接続どうし
+                    return
+                await control.list_rooms("room{}".format(index % 10), 20)
+
+            rate, p50 = await run_operations(args.operations, concurrency, join)
+            print(
+                "{:<14} concurrency={:<4} join: {:8.0f} ops/s p50={:6.2f}ms".format(
+                    mode, concurrency, rate, p50
+                )
+            )
+            if control is not None:
+                rate, p50 = await run_operations(
+                    args.operations, concurrency, list_rooms
+                )
+                print(
+                    "{:<14} concurrency={:<4} list: {:8.0f} ops/s p50={:6.2f}ms".format(
+                        mode, concurrency, rate, p50
+                    )
+                )
+                control.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tcp-port", type=int, default=29602)
+    parser.add_argument("--udp-port", type=int, default=29601)
+    parser.add_argument("--operations", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 64])
+    args = parser.parse_args()
+
+    command = [
+        sys.executable,
+        "server.py",
+        "--tcp-port",
+        str(args.tcp_port),
+        "--udp-port",
+        str(args.udp_port),
+        "--log-level",
+        "warning",
+    ]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    time.sleep(1.0)
+    try:
+        asyncio.run(measure(args))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
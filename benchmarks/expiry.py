@@ -0,0 +1,72 @@
+# メッセージ1件あたりのタイムアウトチェックのコストを測る
+# 変更前（メッセージごとにルーム内の全クライアントを走査）と ExpiryScheduler を比較する
+#
+#   python -m benchmarks.expiry --members 10 100 1000 10000
+import argparse
+import time
+
+import server
+
+
+def legacy_check(active_clients, timeout_period, current_time):
+    # 変更前の send_chat のタイムアウトチェック部分
+    for userid in list(active_clients):
+        if current_time - active_clients[userid].last_activity > timeout_period:
+            del active_clients[userid]
+
+
+def make_room(members, scheduler):
+    owner = server.Chatclient(0, b"token")
+    room = server.Chatroom("bench", b"token", owner)
+    scheduler.schedule(room, owner)
+    for userid in range(1, members):
+        client = server.Chatclient(userid, b"token")
+        room.add_client(client)
+        scheduler.schedule(room, client)
+    return room
+
+
+def per_message(fn, messages):
+    start = time.perf_counter()
+    for _ in range(messages):
+        fn()
+    return (time.perf_counter() - start) / messages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--members", type=int, nargs="+", default=[10, 100, 1000, 10000]
+    )
+    parser.add_argument("--messages", type=int, default=2000)
+    args = parser.parse_args()
+
+    timeout_period = 300
+    for members in args.members:
+        scheduler = server.ExpiryScheduler(timeout_period)
+        room = make_room(members, scheduler)
+
+        legacy = per_message(
+            lambda: legacy_check(room.active_clients, timeout_period, time.time()),
+            args.messages,
+        )
+        # スケジューラはEXPIRY_INTERVALごとに呼ばれるが、ここでは最悪ケースとしてメッセージごとに呼ぶ
+        scheduled = per_message(lambda: scheduler.expire(time.time()), args.messages)
+
+        # 期限切れが発生した時のコスト（全員の期限が切れた状態で1回だけ実行）
+        # サーバと同じく、ルームの一覧のコピーはまとめて1回だけ行う
+        start = time.perf_counter()
+        expired = scheduler.expire(time.time() + timeout_period + 1)
+        room.del_clients([client for _, client in expired])
+        sweep = time.perf_counter() - start
+
+        print(
+            "members={:>6} legacy={:>9.2f}us/msg scheduler={:>6.2f}us/msg "
+            "evict-all={:>8.2f}ms ({} clients)".format(
+                members, legacy * 1e6, scheduled * 1e6, sweep * 1000, len(expired)
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
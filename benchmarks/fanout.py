@@ -0,0 +1,93 @@
+# ルーム内へのリレー（ファンアウト）1メッセージあたりのコストを測る
+# 変更前のループ（メンバーごとにエンコードし、active_clientsを毎回たどる）と relay_message を比較する
+#
+#   python -m benchmarks.fanout --members 10 100 500
+import argparse
+import socket
+import time
+
+import server
+
+
+def legacy_relay(sock, user_name, message, active_clients):
+    # 変更前の send_chat のリレー部分（print は除く）
+    all_message = user_name + ":" + message
+    for userid in list(active_clients):
+        try:
+            sock.sendto(all_message.encode("utf-8"), active_clients[userid].address)
+        except:
+            pass
+
+
+def make_room(sinks):
+    owner = server.Chatclient(0, b"token")
+    room = server.Chatroom("bench", b"token", owner)
+    for userid, sink in enumerate(sinks):
+        if userid not in room.active_clients:
+            room.add_client(server.Chatclient(userid, b"token"))
+        room.set_client_address(userid, sink.getsockname())
+    # アドレス未登録のメンバーも混ぜておく（変更前はこれにも送ろうとしていた）
+    for userid in range(len(sinks), len(sinks) + len(sinks) // 10):
+        room.add_client(server.Chatclient(userid, b"token"))
+    return room
+
+
+def drain(sinks):
+    for sink in sinks:
+        try:
+            while True:
+                sink.recv(4096)
+        except BlockingIOError:
+            pass
+
+
+def measure(fn, messages, sinks):
+    start = time.perf_counter()
+    for _ in range(messages):
+        fn()
+    elapsed = time.perf_counter() - start
+    drain(sinks)
+    return elapsed / messages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--members", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--messages", type=int, default=200)
+    args = parser.parse_args()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    user_name, message = "alice", "hello " * 20
+
+    for members in args.members:
+        sinks = []
+        for _ in range(members):
+            sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sink.bind(("127.0.0.1", 0))
+            sink.setblocking(False)
+            sinks.append(sink)
+        room = make_room(sinks)
+
+        def legacy():
+            legacy_relay(sock, user_name, message, room.active_clients)
+
+        def relay():
+            payload = (user_name + ":" + message).encode("utf-8")
+            server.relay_message(sock, payload, room.addresses)
+
+        legacy_cost = measure(legacy, args.messages, sinks)
+        relay_cost = measure(relay, args.messages, sinks)
+        print(
+            "members={:>5} legacy={:>8.1f}us/msg relay={:>8.1f}us/msg per-send={:.2f}us".format(
+                members,
+                legacy_cost * 1e6,
+                relay_cost * 1e6,
+                relay_cost * 1e6 / members,
+            )
+        )
+        for sink in sinks:
+            sink.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+# フェデレーション（複数のノードでルームを共有）のベンチマーク
+#
+#   latency     ノード0のメンバーが送ったメッセージが、同じノードのメンバーと他のノードのメンバーに届くまでの時間
+#   throughput  同じ人数・同じルーム数を1ノードで処理した場合と、--nodes 個のノードに分けた場合の
+#               全ノード合計のスループット（受け付けたメッセージ数/秒、クライアントへの送信数/秒）
+#
+# ノードは localhost の別々のポートで起動する。スループットはマシンのコア数で頭打ちになる。
+#
+#   python -m benchmarks.federation --nodes 3 --rooms 30 --members 30
+import argparse
+import asyncio
+import json
+import multiprocessing
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+import asyncclient
+import protocol
+
+BASE_PORT = 29300
+
+
+def node_ports(index):
+    # (UDP, TCP, 計測値) のポート
+    base = BASE_PORT + index * 10
+    return base + 1, base + 2, base + 3
+
+
+def start_nodes(count):
+    processes = []
+    for index in range(count):
+        udp_port, tcp_port, metrics_port = node_ports(index)
+        command = [
+            sys.executable,
+            "server.py",
+            "--tcp-port",
+            str(tcp_port),
+            "--udp-port",
+            str(udp_port),
+            "--metrics-port",
+            str(metrics_port),
+            "--log-level",
+            "warning",
+        ]
+        if count > 1:
+            command += ["--node-id", str(index + 1), "--peers"]
+            command += [
+                "127.0.0.1:{}".format(node_ports(other)[0])
+                for other in range(count)
+                if other != index
+            ]
+        processes.append(subprocess.Popen(command, stdout=subprocess.DEVNULL))
+    time.sleep(1.0)
+    return processes
+
+
+def stop_nodes(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.wait()
+
+
+def options(index):
+    udp_port, tcp_port, _ = node_ports(index)
+    return dict(host="127.0.0.1", tcp_port=tcp_port, udp_port=udp_port)
+
+
+def counters(index):
+    url = "http://127.0.0.1:{}/metrics.json".format(node_ports(index)[2])
+    with urllib.request.urlopen(url) as f:
+        return json.load(f)["counters"]
+
+
+async def open_room(room_name, members, nodes):
+    # メンバーを順番に各ノードへ振り分ける（ルームはノード0で作る）
+    sessions = [await asyncclient.create_room(room_name, "user0", **options(0))]
+    # 他のノードにルームが知らされるのを待つ
+    await asyncio.sleep(0.1)
+    for i in range(1, members):
+        sessions.append(
+            await asyncclient.join_room(
+                room_name, "user{}".format(i), **options(i % nodes)
+            )
+        )
+    return sessions
+
+
+async def measure_latency(args):
+    sessions = await open_room("latency", args.nodes, args.nodes)
+    latencies = [[] for _ in sessions]
+
+    async def receive(index, session):
+        async for message in session.messages():
+            if message.body.startswith("t:"):
+                latencies[index].append(time.perf_counter() - float(message.body[2:]))
+
+    tasks = [
+        asyncio.create_task(receive(index, session))
+        for index, session in enumerate(sessions)
+    ]
+    await asyncio.sleep(0.5)
+    for _ in range(args.latency_messages):
+        await sessions[0].send("t:" + repr(time.perf_counter()))
+        await asyncio.sleep(1 / args.latency_rate)
+    await asyncio.sleep(0.5)
+    for session in sessions:
+        session.close()
+    await asyncio.gather(*tasks)
+    return latencies
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000
+
+
+def flood(args, nodes, ready, stop):
+    # 全ルームのメンバーを各ノードに参加させ、各ルーム・各ノードの1人ずつから送り続ける
+    # 受信はしない（サーバの送信コストだけを測る）
+    async def join():
+        rooms = []
+        for room in range(args.rooms):
+            rooms.append(await open_room("room{}".format(room), args.members, nodes))
+        await asyncio.sleep(0.5)
+        for sessions in rooms:
+            for session in sessions:
+                session.transport.pause_reading()
+        return rooms
+
+    loop = asyncio.new_event_loop()
+    rooms = loop.run_until_complete(join())
+    senders = []
+    for sessions in rooms:
+        for session in sessions[:nodes]:
+            fileno = session.transport.get_extra_info("socket").fileno()
+            sock = socket.fromfd(fileno, socket.AF_INET, socket.SOCK_DGRAM)
+            frame = protocol.pack_chat(session.session_id, b"", b"x" * 64)
+            senders.append((sock, frame, session.server_address))
+    ready.set()
+    interval = len(senders) / args.rate
+    next_round = time.perf_counter()
+    while not stop.is_set():
+        for sock, frame, address in senders:
+            try:
+                sock.sendto(frame, address)
+            except OSError:
+                pass
+        next_round += interval
+        delay = next_round - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def measure_throughput(args, nodes):
+    processes = start_nodes(nodes)
+    ready = multiprocessing.Event()
+    stop = multiprocessing.Event()
+    flooder = multiprocessing.Process(target=flood, args=(args, nodes, ready, stop))
+    flooder.start()
+    try:
+        ready.wait()
+        time.sleep(0.5)
+        before = [counters(index) for index in range(nodes)]
+        time.sleep(args.duration)
+        after = [counters(index) for index in range(nodes)]
+    finally:
+        stop.set()
+        flooder.join()
+        stop_nodes(processes)
+
+    def rate(name):
+        total = sum(a.get(name, 0) - b.get(name, 0) for a, b in zip(after, before))
+        return total / args.duration
+
+    print(
+        "throughput nodes={}: messages={:.0f}/s delivered={:.0f}/s "
+        "federation frames={:.0f}/s".format(
+            nodes, rate("datagrams_in"), rate("datagrams_out"), rate("federation_out")
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--rooms", type=int, default=30)
+    parser.add_argument("--members", type=int, default=30)
+    parser.add_argument("--rate", type=float, default=20000, help="全体の送信レート（件/秒）")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--latency-messages", type=int, default=500)
+    parser.add_argument("--latency-rate", type=float, default=200)
+    args = parser.parse_args()
+
+    processes = start_nodes(args.nodes)
+    try:
+        latencies = asyncio.run(measure_latency(args))
+    finally:
+        stop_nodes(processes)
+    for index, values in enumerate(latencies):
+        where = "local" if index == 0 else "node{}".format(index)
+        print(
+            "latency {:<6} received={}/{} p50={:.2f}ms p99={:.2f}ms".format(
+                where,
+                len(values),
+                args.latency_messages,
+                percentile(values, 0.5),
+                percentile(values, 0.99),
+            )
+        )
+
+    measure_throughput(args, 1)
+    measure_throughput(args, args.nodes)
+
+
+if __name__ == "__main__":
+    main()
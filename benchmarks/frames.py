@@ -0,0 +1,63 @@
+# UDPメッセージ1件あたりの解析コストを、テキスト形式とバイナリフレームで比較する
+#
+#   python -m benchmarks.frames --message-size 64 512 2048
+import argparse
+import secrets
+import time
+
+import protocol
+import server
+
+
+def parse_text(data: bytes):
+    # 変更前の send_chat と同じ: 全体をデコードしてから ":" で分割する
+    room_name, token, user_name, message = data.decode("utf-8").split(":", 3)
+    return room_name, token, user_name, message
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--message-size", type=int, nargs="+", default=[64, 512, 2048])
+    parser.add_argument("--iterations", type=int, default=200000)
+    args = parser.parse_args()
+
+    token = secrets.token_urlsafe(server.TOKEN_LENGTH)
+    for size in args.message_size:
+        message = "あ" * (size // 3)
+        text = "room:{}:alice:{}".format(token, message).encode("utf-8")
+        first = protocol.pack_chat(1, token.encode("utf-8"), message.encode("utf-8"))
+        session = protocol.pack_chat(1, b"", message.encode("utf-8"))
+
+        buffer = bytearray(protocol.MAX_DATAGRAM_SIZE)
+        view = memoryview(buffer)
+
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            parse_text(text)
+        text_cost = (time.perf_counter() - start) / args.iterations
+
+        results = []
+        for frame in (first, session):
+            buffer[: len(frame)] = frame
+            nbytes = len(frame)
+            start = time.perf_counter()
+            for _ in range(args.iterations):
+                protocol.parse_chat(view, nbytes)
+            results.append((time.perf_counter() - start) / args.iterations)
+
+        print(
+            "message={:>5}B text={:.3f}us ({}B) binary+token={:.3f}us ({}B) "
+            "binary+session={:.3f}us ({}B)".format(
+                len(message.encode("utf-8")),
+                text_cost * 1e6,
+                len(text),
+                results[0] * 1e6,
+                len(first),
+                results[1] * 1e6,
+                len(session),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
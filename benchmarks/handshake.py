@@ -0,0 +1,178 @@
+# TCPハンドシェイク（ルーム作成・参加）のベンチマーク
+# 従来の1接続ずつ処理するループと、asyncio版のハンドシェイクサーバを比較する
+#
+#   python -m benchmarks.handshake --joins 5000 --concurrency 500 --stalled 20
+import argparse
+import asyncio
+import multiprocessing
+import socket
+import time
+
+import server
+from client import create_body, create_header
+
+
+def serial_enter_chatroom(server_address, server_port, read_timeout):
+    # 変更前の enter_chatroom と同じ構造: listen(1) で1接続ずつ最後まで処理する
+    # 比較のため、操作の処理自体は server.process_operation を使う
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((server_address, server_port))
+    sock.listen(1)
+    while True:
+        connection, _ = sock.accept()
+        # タイムアウトがないと応答しないクライアントでベンチマークが終わらなくなる
+        connection.settimeout(read_timeout)
+        try:
+            connection.sendall((0).to_bytes(1, "big"))
+            header = connection.recv(32)
+            roomname_size, operation, state, payload_size = server.parse_header(header)
+            body = connection.recv(roomname_size + payload_size)
+            room_name = body[:roomname_size].decode("utf-8")
+            user_name = body[roomname_size:].decode("utf-8")
+            connection.sendall((1).to_bytes(1, "big"))
+            reaction, client = server.process_operation(operation, room_name, user_name)
+            connection.sendall(reaction.to_bytes(1, "big"))
+            if client is not None:
+                connection.sendall(
+                    server.protocol.SESSION_ID.pack(client.userid)
+                    + server.encode_token(client.token).encode("ascii")
+                )
+        except Exception:
+            pass
+        finally:
+            connection.close()
+
+
+def run_server(mode, port, backlog, read_timeout):
+    if mode == "serial":
+        serial_enter_chatroom("127.0.0.1", port, read_timeout)
+    else:
+        server.enter_chatroom("127.0.0.1", port, backlog, read_timeout)
+
+
+async def handshake(port, operation, room_name, user_name):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        writer.write(
+            create_header(
+                len(room_name.encode("utf-8")),
+                operation,
+                0,
+                len(user_name.encode("utf-8")),
+            )
+            + create_body(room_name, user_name)
+        )
+        await writer.drain()
+        while True:
+            reaction = (await reader.readexactly(1))[0]
+            if reaction == 2:
+                break
+            if reaction not in (0, 1):
+                raise Exception("handshake failed: {}".format(reaction))
+        token = await reader.read()
+        if not token:
+            raise Exception("empty token")
+        return token
+    finally:
+        writer.close()
+
+
+async def stall(port, duration):
+    # 接続だけしてヘッダを送らないクライアント
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    except OSError:
+        return
+    await asyncio.sleep(duration)
+    writer.close()
+
+
+async def run_clients(port, joins, concurrency, stalled, stall_duration):
+    await handshake(port, 1, "bench", "owner")
+
+    stallers = [
+        asyncio.create_task(stall(port, stall_duration)) for _ in range(stalled)
+    ]
+    await asyncio.sleep(0.05)
+
+    latencies = []
+    failures = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        nonlocal failures
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await handshake(port, 2, "bench", "user{}".format(i))
+                latencies.append(time.perf_counter() - start)
+            except Exception:
+                failures += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(joins)))
+    elapsed = time.perf_counter() - start
+
+    for task in stallers:
+        task.cancel()
+    await asyncio.gather(*stallers, return_exceptions=True)
+    return latencies, failures, elapsed
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def bench(mode, args, port):
+    process = multiprocessing.Process(
+        target=run_server,
+        args=(mode, port, args.backlog, args.read_timeout),
+        daemon=True,
+    )
+    process.start()
+    time.sleep(0.5)
+    try:
+        latencies, failures, elapsed = asyncio.run(
+            run_clients(
+                port, args.joins, args.concurrency, args.stalled, args.stall_duration
+            )
+        )
+    finally:
+        process.terminate()
+        process.join()
+
+    print(
+        "{:<8} handshakes/s={:>9.1f} p50={:>8.2f}ms p99={:>8.2f}ms failures={}".format(
+            mode,
+            len(latencies) / elapsed,
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000,
+            failures,
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--joins", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--stalled", type=int, default=0, help="ヘッダを送らない接続の数")
+    parser.add_argument("--stall-duration", type=float, default=2.0)
+    parser.add_argument("--backlog", type=int, default=server.DEFAULT_BACKLOG)
+    parser.add_argument("--read-timeout", type=float, default=1.0)
+    parser.add_argument("--port", type=int, default=19002)
+    parser.add_argument("--mode", choices=["serial", "asyncio", "both"], default="both")
+    args = parser.parse_args()
+
+    modes = ["serial", "asyncio"] if args.mode == "both" else [args.mode]
+    for offset, mode in enumerate(modes):
+        bench(mode, args, args.port + offset)
+
+
+if __name__ == "__main__":
+    main()
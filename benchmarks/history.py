@@ -0,0 +1,89 @@
+# ルームごとのメッセージ履歴（リングバッファ）のメモリとリレーへの影響を測る
+#
+#   ・1,000ルームにそれぞれ1,000件の履歴を持たせた時のメモリ
+#   ・メッセージ1件のエンコード（＋履歴への記録）のコスト
+#   ・参加時に1,000件の履歴をまとめて送り直すためのフレームの組み立てコスト
+#
+#   python -m benchmarks.history --rooms 1000 --history 1000 --message-size 64
+import argparse
+import time
+import tracemalloc
+
+import protocol
+import server
+
+
+def build_rooms(rooms, history_size, message):
+    registry = server.Registry()
+    registry.history_size = history_size
+    for i in range(rooms):
+        room, _ = registry.create_room("room{}".format(i), "owner")
+        for _ in range(history_size):
+            server.encode_relay(room, b"owner", message, False)
+    return registry
+
+
+def measure_memory(rooms, history_size, message):
+    tracemalloc.start()
+    registry = build_rooms(rooms, history_size, message)
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return used, registry
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rooms", type=int, default=1000)
+    parser.add_argument("--history", type=int, default=1000)
+    parser.add_argument("--message-size", type=int, default=64)
+    parser.add_argument("--iterations", type=int, default=200000)
+    args = parser.parse_args()
+
+    message = b"x" * args.message_size
+
+    base, _ = measure_memory(args.rooms, 0, message)
+    used, registry = measure_memory(args.rooms, args.history, message)
+    print(
+        "memory rooms={} history={} message={}B: without={:.1f}MB with={:.1f}MB "
+        "(+{:.1f}KB/room, {:.0f}B/message)".format(
+            args.rooms,
+            args.history,
+            args.message_size,
+            base / 1e6,
+            used / 1e6,
+            (used - base) / args.rooms / 1e3,
+            (used - base) / (args.rooms * args.history),
+        )
+    )
+
+    # リレー1件あたりのコスト（送信を除いた、エンコードと記録の部分）
+    rooms = list(registry.rooms.values())
+    without = server.Chatroom("plain", b"", server.Chatclient(0, b""), 0)
+    results = []
+    for name, targets in (("without", [without]), ("with", rooms)):
+        count = len(targets)
+        start = time.perf_counter()
+        for i in range(args.iterations):
+            server.encode_relay(targets[i % count], b"alice", message, False)
+        results.append((name, (time.perf_counter() - start) / args.iterations))
+    print(
+        "relay encode: "
+        + " ".join("{}={:.3f}us".format(name, cost * 1e6) for name, cost in results)
+    )
+
+    # 参加時の送り直し（全件）
+    room = rooms[0]
+    repeat = 200
+    start = time.perf_counter()
+    for _ in range(repeat):
+        frames = list(protocol.pack_batches(room.history.since(0)))
+    cost = (time.perf_counter() - start) / repeat
+    print(
+        "catch-up {} messages: {} datagrams, {:.1f}us".format(
+            len(room.history.since(0)), len(frames), cost * 1e6
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
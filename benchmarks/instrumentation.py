@@ -0,0 +1,124 @@
+# UDPメッセージ1件あたりの処理コストを、計測の有無と従来の print() で比較する
+#
+#   bare        カウンタ・ヒストグラムを何もしないものに差し替えた場合
+#   metrics     現在の server.py（カウンタ・ヒストグラムあり、デバッグログなし）
+#   print       従来の send_chat と同じ print() をメッセージごとに行った場合
+#
+#   python -m benchmarks.instrumentation --members 1 10 100
+import argparse
+import os
+import socket
+import time
+
+import protocol
+import server
+
+
+class NullInstrument:
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+INSTRUMENTS = (
+    "datagrams_in",
+    "datagrams_out",
+    "malformed_datagrams",
+    "auth_failures",
+    "send_errors",
+    "parse_seconds",
+    "auth_seconds",
+    "fanout_seconds",
+)
+
+
+def legacy_prints(out, room, data, nbytes, address):
+    # 変更前の send_chat がメッセージごとに出力していたもの
+    print("\nwaiting to receive message", file=out)
+    print("received {} bytes from {}".format(nbytes, address), file=out)
+    print(bytes(data[:nbytes]), file=out)
+    print("chatroom_info", room, file=out)
+    print("active_clients", room.active_clients, file=out)
+    for client in room.active_clients.values():
+        print(client.address, file=out)
+
+
+def build_room(sinks):
+    # 認証はアドレスの索引で行うので、メンバーごとに別のリレー先を使う
+    server.registry = server.Registry()
+    room, owner = server.registry.create_room("room", "user0")
+    clients = [owner]
+    for i in range(1, len(sinks)):
+        clients.append(server.registry.join_room("room", "user{}".format(i))[1])
+    for client, sink in zip(clients, sinks):
+        server.registry.bind_address(room, client, sink.getsockname())
+    return room, owner
+
+
+def run(sock, room, sender, iterations, out=None):
+    frame = protocol.pack_chat(sender.userid, b"", b"x" * 64)
+    buffer = bytearray(protocol.MAX_DATAGRAM_SIZE)
+    buffer[: len(frame)] = frame
+    view = memoryview(buffer)
+    nbytes = len(frame)
+    address = sender.address
+    start = time.perf_counter()
+    for _ in range(iterations):
+        if out is not None:
+            legacy_prints(out, room, view, nbytes, address)
+        server.handle_binary_datagram(sock, view, nbytes, address)
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--members", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument(
+        "--print-to",
+        default=os.devnull,
+        help="print() の出力先（端末に出す場合のコストを見るなら /dev/tty）",
+    )
+    args = parser.parse_args()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    instruments = {name: getattr(server, name) for name in INSTRUMENTS}
+
+    with open(args.print_to, "w") as out:
+        for members in args.members:
+            # リレー先。受信はしないので、バッファがあふれた分は捨てられる
+            sinks = [
+                socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(members)
+            ]
+            for sink in sinks:
+                sink.bind(("127.0.0.1", 0))
+            room, sender = build_room(sinks)
+            server.expiry_scheduler = server.ExpiryScheduler(300)
+
+            for name in INSTRUMENTS:
+                setattr(server, name, NullInstrument())
+            bare = run(sock, room, sender, args.iterations)
+            for name, instrument in instruments.items():
+                setattr(server, name, instrument)
+            measured = run(sock, room, sender, args.iterations)
+            printed = run(sock, room, sender, args.iterations, out)
+
+            print(
+                "members={:>4} bare={:.2f}us metrics={:.2f}us (+{:.1f}%) "
+                "print={:.2f}us (+{:.1f}%)".format(
+                    members,
+                    bare * 1e6,
+                    measured * 1e6,
+                    (measured / bare - 1) * 100,
+                    printed * 1e6,
+                    (printed / bare - 1) * 100,
+                )
+            )
+            for sink in sinks:
+                sink.close()
+
+
+if __name__ == "__main__":
+    main()
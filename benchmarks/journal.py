@@ -0,0 +1,105 @@
+# ジャーナルを有効にした時の参加のスループットと、再起動（状態の復元）にかかる時間を測る
+#
+#   ・参加: ジャーナルなし / あり（書き込みスレッドが追いつくまでを含む）
+#   ・再起動: ログだけから復元する場合と、スナップショットから復元する場合
+#
+#   python -m benchmarks.journal --sessions 1000000 --room-size 100
+import argparse
+import gc
+import os
+import shutil
+import tempfile
+import time
+
+import journal
+import server
+
+
+def join_all(registry, sessions, room_size):
+    for i in range(sessions):
+        room_name = "room{}".format(i // room_size)
+        if i % room_size == 0:
+            registry.create_room(room_name, "user{}".format(i))
+        else:
+            registry.join_room(room_name, "user{}".format(i))
+
+
+def directory_size(directory):
+    return sum(
+        os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+    )
+
+
+def restore(directory):
+    registry = server.Registry()
+    state = journal.Journal(directory)
+    start = time.perf_counter()
+    registry.restore(state.recover())
+    elapsed = time.perf_counter() - start
+    state.file.close()
+    return registry, state, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=1000000)
+    parser.add_argument("--room-size", type=int, default=100)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    join_all(server.Registry(), args.sessions, args.room_size)
+    plain = time.perf_counter() - start
+    gc.collect()
+
+    directory = tempfile.mkdtemp(prefix="chat-journal-")
+    try:
+        registry = server.Registry()
+        state = journal.Journal(directory, snapshot_bytes=1 << 62)
+        state.start(registry.dump)
+        registry.journal = state
+        start = time.perf_counter()
+        join_all(registry, args.sessions, args.room_size)
+        enqueued = time.perf_counter() - start
+        while state.backlog():
+            time.sleep(0.01)
+        # キューが空になった後も最後のまとまりを書いている可能性があるので、少し待つ
+        time.sleep(0.1)
+        drained = time.perf_counter() - start
+        print(
+            "join sessions={}: without journal={:.0f}/s with journal={:.0f}/s "
+            "(written={:.0f}/s, log={:.1f}MB)".format(
+                args.sessions,
+                args.sessions / plain,
+                args.sessions / enqueued,
+                args.sessions / drained,
+                directory_size(directory) / 1e6,
+            )
+        )
+        del registry
+        gc.collect()
+
+        # ログだけから復元
+        restored, state, from_log = restore(directory)
+        # スナップショットを取ってから、もう一度復元
+        state.file = open(state.log_path(state.generation), "ab")
+        state.dump = restored.dump
+        state.snapshot()
+        state.file.close()
+        del restored
+        gc.collect()
+        restored, _, from_snapshot = restore(directory)
+        print(
+            "restart sessions={}: log only={:.2f}s snapshot={:.2f}s "
+            "(snapshot={:.1f}MB)".format(
+                sum(len(room.active_clients) for room in restored.rooms.values()),
+                from_log,
+                from_snapshot,
+                os.path.getsize(os.path.join(directory, journal.SNAPSHOT_NAME)) / 1e6,
+            )
+        )
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
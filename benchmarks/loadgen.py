@@ -0,0 +1,396 @@
+# チャットサーバの負荷生成ツール
+#
+# 多数の仮想ユーザーが 9002番(TCP)でルームを作成・参加し、9001番(UDP)で指定したレートでメッセージを送る。
+# 参加のスループット、リレーの遅延（送信から各メンバーに届くまで）のパーセンタイル、配送率、
+# サーバのCPU使用率を測り、結果をJSONで保存する（バージョン間で比較するため）。
+#
+#   python server.py &
+#   python -m benchmarks.loadgen --users 2000 --rooms 50 --rate 500 --duration 20 --server-pid $!
+#
+#   # サーバをこのツールから起動する場合
+#   python -m benchmarks.loadgen --spawn-server --server-args "--workers 2" --output result.json
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shlex
+import subprocess
+import sys
+import time
+
+import protocol
+from client import create_body, create_header
+
+
+class VirtualUser:
+    def __init__(self, user_name, room_name):
+        self.user_name = user_name
+        self.room_name = room_name
+        self.session_id = 0
+        self.token = ""
+        self.transport = None
+        self.bound = False
+
+
+class UserProtocol(asyncio.DatagramProtocol):
+    # 1ユーザー分のUDPソケット。届いたメッセージから遅延を記録する
+    def __init__(self, user, stats, text_frames):
+        self.user = user
+        self.stats = stats
+        self.text_frames = text_frames
+
+    def datagram_received(self, data, address):
+        now = time.perf_counter()
+        if self.text_frames:
+            text = data.decode("utf-8", "replace")
+            if text == "Invalid token":
+                self.stats.auth_errors += 1
+                return
+            messages = [(0, *text.split(":", 1))]
+        else:
+            frame = protocol.parse_server_frame(data)
+            if frame is None:
+                return
+            kind, content = frame
+            if kind == protocol.KIND_ERROR:
+                self.stats.auth_errors += 1
+                return
+            if kind == protocol.KIND_THROTTLE:
+                return
+            messages = content
+        for message in messages:
+            if len(message) != 3:
+                continue
+            body = message[2]
+            if not body.startswith("lg:"):
+                continue
+            self.user.bound = True
+            # 本文は "lg:<送信時刻>"。同じプロセスの perf_counter なのでそのまま差を取れる
+            sent_at = float(body[3:])
+            if sent_at >= self.stats.measure_from:
+                self.stats.delivered += 1
+                self.stats.latencies.append(now - sent_at)
+
+
+class Stats:
+    def __init__(self):
+        self.join_latencies = []
+        self.join_failures = 0
+        self.sent = 0
+        self.expected = 0
+        self.delivered = 0
+        self.latencies = []
+        self.auth_errors = 0
+        # 参加直後の登録用メッセージは計測に含めない
+        self.measure_from = float("inf")
+
+
+def percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    values = sorted(values)
+
+    def at(p):
+        return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+    return {
+        "p50": at(50) * 1000,
+        "p95": at(95) * 1000,
+        "p99": at(99) * 1000,
+        "max": values[-1] * 1000,
+    }
+
+
+async def handshake(args, user, operation, stats):
+    start = time.perf_counter()
+    try:
+        reader, writer = await asyncio.open_connection(args.host, args.tcp_port)
+    except OSError:
+        stats.join_failures += 1
+        return False
+    try:
+        writer.write(
+            create_header(
+                len(user.room_name.encode("utf-8")),
+                operation,
+                0,
+                len(user.user_name.encode("utf-8")),
+            )
+            + create_body(user.room_name, user.user_name)
+        )
+        await writer.drain()
+        while True:
+            reaction = (await reader.readexactly(1))[0]
+            if reaction == 2:
+                break
+            if reaction not in (0, 1):
+                raise Exception("handshake failed")
+        response = await reader.read()
+        if not args.text_frames:
+            (user.session_id,) = protocol.SESSION_ID.unpack_from(response)
+            response = response[protocol.SESSION_ID.size :]
+        user.token = response.decode("utf-8")
+    except Exception:
+        stats.join_failures += 1
+        return False
+    finally:
+        writer.close()
+    stats.join_latencies.append(time.perf_counter() - start)
+    return True
+
+
+def encode(args, user, body):
+    if args.text_frames:
+        return "{}:{}:{}:{}".format(
+            user.room_name, user.token, user.user_name, body
+        ).encode("utf-8")
+    token = b"" if user.bound else user.token.encode("utf-8")
+    return protocol.pack_chat(user.session_id, token, body.encode("utf-8"))
+
+
+def cpu_seconds(pids):
+    # /proc/<pid>/stat の utime + stime（子プロセスのワーカーも含める）
+    total = 0
+    ticks = os.sysconf("SC_CLK_TCK")
+    for pid in all_pids(pids):
+        try:
+            with open("/proc/{}/stat".format(pid)) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        total += (int(fields[11]) + int(fields[12])) / ticks
+    return total
+
+
+def all_pids(pids):
+    found = []
+    pending = list(pids)
+    while pending:
+        pid = pending.pop()
+        found.append(pid)
+        try:
+            for task in os.listdir("/proc/{}/task".format(pid)):
+                with open("/proc/{}/task/{}/children".format(pid, task)) as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return found
+
+
+async def run(args):
+    stats = Stats()
+    loop = asyncio.get_running_loop()
+    server = (args.host, args.udp_port)
+
+    users = [
+        VirtualUser("user{}".format(i), "{}{}".format(args.room_prefix, i % args.rooms))
+        for i in range(args.users)
+    ]
+    owners = users[: args.rooms]
+    members = users[args.rooms :]
+
+    # 参加フェーズ: 各ルームの作成者が先にルームを作り、残りのユーザーが同時に参加する
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def join(user, operation):
+        async with semaphore:
+            return await handshake(args, user, operation, stats)
+
+    join_start = time.perf_counter()
+    created = await asyncio.gather(*(join(user, 1) for user in owners))
+    joined = await asyncio.gather(*(join(user, 2) for user in members))
+    join_elapsed = time.perf_counter() - join_start
+    active = [user for user, ok in zip(owners + members, created + joined) if ok]
+
+    room_sizes = {}
+    for user in active:
+        room_sizes[user.room_name] = room_sizes.get(user.room_name, 0) + 1
+
+    # UDPソケットを開き、トークン付きのメッセージでアドレスを登録する
+    for user in active:
+        user.transport, _ = await loop.create_datagram_endpoint(
+            lambda user=user: UserProtocol(user, stats, args.text_frames),
+            remote_addr=None,
+            local_addr=("0.0.0.0", 0),
+        )
+    for _ in range(3):
+        for user in active:
+            if not user.bound:
+                user.transport.sendto(
+                    encode(args, user, "lg:{}".format(time.perf_counter())), server
+                )
+        await asyncio.sleep(0.5)
+        if args.text_frames:
+            break
+
+    # 送信フェーズ: 全体で args.rate 件/秒になるよう、1msごとに必要な件数を送る
+    cpu_before = cpu_seconds(args.server_pid) if args.server_pid else None
+    stats.measure_from = time.perf_counter()
+    start = stats.measure_from
+    deadline = start + args.duration
+    while True:
+        now = time.perf_counter()
+        if now >= deadline:
+            break
+        due = int((now - start) * args.rate) - stats.sent
+        for _ in range(due):
+            user = random.choice(active)
+            body = "lg:{}".format(time.perf_counter())
+            user.transport.sendto(encode(args, user, body), server)
+            stats.sent += 1
+            stats.expected += room_sizes[user.room_name]
+        await asyncio.sleep(0.001)
+    send_elapsed = time.perf_counter() - start
+    cpu_after = cpu_seconds(args.server_pid) if args.server_pid else None
+
+    # 送信後、遅れて届くメッセージを待つ
+    await asyncio.sleep(args.grace)
+    for user in active:
+        user.transport.close()
+
+    result = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "revision": git_revision(),
+        "config": {
+            key: value for key, value in vars(args).items() if key != "server_pid"
+        },
+        "join": {
+            "attempted": len(users),
+            "succeeded": len(active),
+            "failures": stats.join_failures,
+            "per_second": len(active) / join_elapsed if join_elapsed else None,
+            "latency_ms": percentiles(stats.join_latencies),
+        },
+        "messages": {
+            "sent": stats.sent,
+            "sent_per_second": stats.sent / send_elapsed,
+            "expected_deliveries": stats.expected,
+            "delivered": stats.delivered,
+            "delivery_ratio": stats.delivered / stats.expected if stats.expected else None,
+            "deliveries_per_second": stats.delivered / send_elapsed,
+            "fanout_latency_ms": percentiles(stats.latencies),
+            "auth_errors": stats.auth_errors,
+        },
+        "server_cpu": None,
+    }
+    if cpu_before is not None:
+        cpu = cpu_after - cpu_before
+        result["server_cpu"] = {
+            "seconds": cpu,
+            "percent": cpu / send_elapsed * 100,
+            "us_per_delivery": cpu / stats.delivered * 1e6 if stats.delivered else None,
+        }
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# 比較する指標（JSON内のパス）
+COMPARED_METRICS = [
+    ("join", "per_second"),
+    ("join", "latency_ms", "p99"),
+    ("messages", "deliveries_per_second"),
+    ("messages", "delivery_ratio"),
+    ("messages", "fanout_latency_ms", "p50"),
+    ("messages", "fanout_latency_ms", "p99"),
+    ("server_cpu", "us_per_delivery"),
+]
+
+
+def compare(baseline, result):
+    # 以前の結果と並べて表示する
+    for path in COMPARED_METRICS:
+        before, after = baseline, result
+        for key in path:
+            before = before.get(key) if isinstance(before, dict) else None
+            after = after.get(key) if isinstance(after, dict) else None
+        if before is None or after is None:
+            continue
+        change = (after - before) / before * 100 if before else float("nan")
+        print(
+            "{:<40} {:>12.3f} -> {:>12.3f} ({:+.1f}%)".format(
+                ".".join(path), before, after, change
+            )
+        )
+
+
+def raise_file_limit():
+    # ユーザーごとにUDPソケットを1つ使うので、開けるファイル数の上限を上げておく
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Online Chat Messenger load generator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--tcp-port", type=int, default=9002)
+    parser.add_argument("--udp-port", type=int, default=9001)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--room-prefix", default="lg")
+    parser.add_argument("--rate", type=float, default=200, help="全体の送信レート（件/秒）")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--grace", type=float, default=1.0, help="送信終了後に受信を待つ秒数")
+    parser.add_argument("--concurrency", type=int, default=200, help="同時に行う参加の数")
+    parser.add_argument("--text-frames", action="store_true")
+    parser.add_argument(
+        "--server-pid", type=int, nargs="*", default=[], help="CPU使用率を測るサーバのPID"
+    )
+    parser.add_argument(
+        "--spawn-server", action="store_true", help="server.py をこのツールから起動する"
+    )
+    parser.add_argument("--server-args", default="", help="--spawn-server の時に渡す引数")
+    parser.add_argument("--output", help="結果を保存するJSONファイル")
+    parser.add_argument("--baseline", help="比較する以前の結果（--output で保存したJSON）")
+    args = parser.parse_args()
+
+    raise_file_limit()
+
+    server = None
+    if args.spawn_server:
+        command = [
+            sys.executable,
+            "server.py",
+            "--tcp-port",
+            str(args.tcp_port),
+            "--udp-port",
+            str(args.udp_port),
+        ]
+        command += shlex.split(args.server_args)
+        if args.text_frames:
+            command.append("--text-frames")
+        server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+        args.server_pid = [server.pid]
+        time.sleep(1.0)
+
+    try:
+        result = asyncio.run(run(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(json.load(f), result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+# パケットが失われる経路で、再送要求（NACK）あり・なしのメッセージの届き方を比べる
+#
+# クライアントとサーバの UDP の間に、サーバ → クライアントのデータグラムを --loss の割合で
+# 捨てる中継プロセスを挟む（ハンドシェイクの TCP は直接つなぐ）。
+# 1つのルームに --members 人が参加し、そのうち --senders 人が合計 --rate 件/秒で送る。
+#
+#   goodput    届いたメッセージ（重複は除く）/ 届くはずのメッセージ
+#   recovered  後の番号より遅れて届いた（=再送で届いた）メッセージの割合と、その遅延 p50/p99
+#   p99        届いたメッセージ全体の遅延 p99
+#
+#   python -m benchmarks.lossy --loss 0.01 0.02 0.05 0.1 --members 10 --rate 200
+import argparse
+import asyncio
+import multiprocessing
+import random
+import selectors
+import socket
+import subprocess
+import sys
+import time
+
+import asyncclient
+
+PREFIX = "l:"
+
+
+def proxy(args, loss, ready, stop):
+    # クライアントのアドレスごとにサーバ向けのソケットを作り、サーバからの応答を
+    # 元のクライアントに送り返す。サーバ → クライアントの分だけ loss の割合で捨てる
+    server_address = (args.host, args.udp_port)
+    front = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    front.bind((args.host, args.proxy_port))
+    selector = selectors.DefaultSelector()
+    selector.register(front, selectors.EVENT_READ)
+    upstreams = {}
+    rng = random.Random(args.seed)
+    ready.set()
+    while not stop.is_set():
+        for key, _ in selector.select(0.1):
+            sock = key.fileobj
+            if sock is front:
+                data, address = front.recvfrom(65536)
+                upstream = upstreams.get(address)
+                if upstream is None:
+                    upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    upstream.connect(server_address)
+                    upstreams[address] = upstream
+                    selector.register(upstream, selectors.EVENT_READ, address)
+                upstream.send(data)
+            else:
+                data = sock.recv(65536)
+                if rng.random() >= loss:
+                    front.sendto(data, key.data)
+
+
+async def measure(args, nack):
+    options = dict(
+        host=args.host, tcp_port=args.tcp_port, udp_port=args.proxy_port, nack=nack
+    )
+    sessions = [await asyncclient.create_room("lossy", "user0", **options)]
+    for i in range(1, args.members):
+        sessions.append(
+            await asyncclient.join_room("lossy", "user{}".format(i), **options)
+        )
+    latencies = []
+    recovered = []
+
+    async def receive(session):
+        seen = set()
+        newest = 0
+        async for message in session.messages():
+            if not message.body.startswith(PREFIX) or message.seq in seen:
+                continue
+            seen.add(message.seq)
+            latency = time.perf_counter() - float(message.body[2:])
+            latencies.append(latency)
+            if message.seq < newest:
+                recovered.append(latency)
+            newest = max(newest, message.seq)
+
+    tasks = [asyncio.create_task(receive(session)) for session in sessions]
+    await asyncio.sleep(0.5)
+
+    senders = sessions[: args.senders]
+    interval = 1 / args.rate
+    sent = 0
+    deadline = time.perf_counter() + args.duration
+    next_send = time.perf_counter()
+    while time.perf_counter() < deadline:
+        await senders[sent % len(senders)].send(PREFIX + repr(time.perf_counter()))
+        sent += 1
+        next_send += interval
+        await asyncio.sleep(max(0, next_send - time.perf_counter()))
+    await asyncio.sleep(args.grace)
+    nacks = sum(session.nacks_sent for session in sessions)
+    for session in sessions:
+        session.close()
+    await asyncio.gather(*tasks)
+    return sent * args.members, sorted(latencies), sorted(recovered), nacks
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000
+
+
+def run_scenario(args, loss, nack):
+    command = [
+        sys.executable,
+        "server.py",
+        "--tcp-port",
+        str(args.tcp_port),
+        "--udp-port",
+        str(args.udp_port),
+        "--log-level",
+        "warning",
+    ]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    ready = multiprocessing.Event()
+    stop = multiprocessing.Event()
+    relay = multiprocessing.Process(target=proxy, args=(args, loss, ready, stop))
+    relay.start()
+    time.sleep(1.0)
+    try:
+        ready.wait()
+        expected, latencies, recovered, nacks = asyncio.run(measure(args, nack))
+    finally:
+        stop.set()
+        relay.join()
+        server.terminate()
+        server.wait()
+
+    print(
+        "loss={:5.1%} nack={:<3} goodput={:7.2%} recovered={:6.2%} "
+        "(p50={:7.2f}ms p99={:7.2f}ms) p99={:7.2f}ms nacks={}".format(
+            loss,
+            "on" if nack else "off",
+            len(latencies) / expected,
+            len(recovered) / expected,
+            percentile(recovered, 0.5),
+            percentile(recovered, 0.99),
+            percentile(latencies, 0.99),
+            nacks,
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--tcp-port", type=int, default=29502)
+    parser.add_argument("--udp-port", type=int, default=29501)
+    parser.add_argument("--proxy-port", type=int, default=29504)
+    parser.add_argument("--loss", type=float, nargs="+", default=[0.01, 0.02, 0.05, 0.1])
+    parser.add_argument("--members", type=int, default=10)
+    parser.add_argument("--senders", type=int, default=5)
+    parser.add_argument("--rate", type=float, default=200, help="ルーム全体の送信レート（件/秒）")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--grace", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    for loss in args.loss:
+        for nack in (False, True):
+            run_scenario(args, loss, nack)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# 接続中のユーザー1人あたりの常駐メモリ（RSS）を測る
+# 変更前の表現（__dict__ を持つクラス、token_urlsafe(255) の文字列トークン、索引やヒープに
+# (ルーム, クライアント) のタプル）と、現在の Registry を比較する
+#
+#   python -m benchmarks.memory --users 10000 100000 1000000
+import argparse
+import heapq
+import multiprocessing
+import os
+import secrets
+import time
+
+import server
+
+USERS_PER_ROOM = 100
+
+
+class LegacyChatclient:
+    # 変更前の Chatclient と同じ表現
+    def __init__(self, userid, token, user_name="", address=None, last_activity=None):
+        self.userid = userid
+        self.token = token
+        self.user_name = user_name
+        self.address = address
+        self.last_activity = (
+            last_activity if last_activity is not None else time.time()
+        )
+
+
+class LegacyChatroom:
+    def __init__(self, room_name, owner_token, owner_info):
+        self.room_name = room_name
+        self.active_clients = {owner_info.userid: owner_info}
+        self.user_ids = {owner_info.user_name: owner_info.userid}
+        self.addresses = []
+
+
+def resident_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def build_legacy(users):
+    rooms, tokens, addresses, heap = {}, {}, {}, []
+    for i in range(users):
+        userid = i + 1
+        user_name = "user{}".format(i)
+        client = LegacyChatclient(userid, secrets.token_urlsafe(255), user_name)
+        room_name = "room{}".format(i // USERS_PER_ROOM)
+        if i % USERS_PER_ROOM == 0:
+            room = rooms[room_name] = LegacyChatroom(room_name, client.token, client)
+        else:
+            room = rooms[room_name]
+            room.active_clients[userid] = client
+            room.user_ids[user_name] = userid
+        tokens[client.token] = (room, client)
+        heapq.heappush(heap, (client.last_activity + 300, userid, room, client))
+        address = ("127.0.0.1", 10000 + i % 50000)
+        client.address = address
+        addresses[(address[0], address[1] + i)] = (room, client)
+    for room in rooms.values():
+        room.addresses = [client.address for client in room.active_clients.values()]
+    return rooms, tokens, addresses, heap
+
+
+def build_registry(users):
+    registry = server.Registry()
+    scheduler = server.ExpiryScheduler(server.DEFAULT_CLIENT_TIMEOUT)
+    for i in range(users):
+        room_name = "room{}".format(i // USERS_PER_ROOM)
+        if i % USERS_PER_ROOM == 0:
+            room, client = registry.create_room(room_name, "user{}".format(i))
+        else:
+            room, client, _ = registry.join_room(room_name, "user{}".format(i))
+        scheduler.schedule(room, client)
+        # リレー先一覧の再構築は1ルーム分だけにして、ここでは索引への登録だけ行う
+        address = ("127.0.0.1", 10000 + i % 50000)
+        client.address = address
+        registry.addresses[(address[0], address[1] + i)] = client
+    for room in registry.rooms.values():
+        room.rebuild_addresses()
+    return registry, scheduler
+
+
+def measure(kind, users, results):
+    before = resident_bytes()
+    state = build_legacy(users) if kind == "legacy" else build_registry(users)
+    after = resident_bytes()
+    results.put((after - before) / users)
+    del state
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--users", type=int, nargs="+", default=[10000, 100000, 1000000]
+    )
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("fork")
+    for users in args.users:
+        line = ["users={:>8}".format(users)]
+        for kind in ("legacy", "registry"):
+            # 計測ごとに新しいプロセスを使い、前の計測で確保したメモリの影響を受けないようにする
+            results = context.Queue()
+            process = context.Process(target=measure, args=(kind, users, results))
+            process.start()
+            per_user = results.get()
+            process.join()
+            line.append("{}={:.0f}B/user".format(kind, per_user))
+        print(" ".join(line))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+# 1つのルームが大量のメッセージで溢れている時に、他のルームのリレーがどれだけ影響を受けるかを測る
+#
+#   idle     溢れているルームなし（基準）
+#   flood    溢れているルームあり、レート制限なし
+#   limited  溢れているルームあり、--client-rate / --room-rate で制限
+#
+# 溢れさせる側は別プロセスで、大きなルームの複数のメンバーから --flood-rate で送り続ける。
+# リレーのコストはルームの人数倍になるので、受信するだけなら軽いレートでもリレーのスレッドは溢れる。
+# （--flood-rate 0 で全力で送ると、サーバが受信するより前にカーネルの受信バッファで捨てられるようになり、
+#   それは制限では防げない）
+# 静かなルームは一定のレートで送り、配送率と遅延（p50/p99）を測る。
+#
+#   python -m benchmarks.ratelimit --quiet-rooms 20 --flood-members 200 --flooders 20
+import argparse
+import asyncio
+import json
+import multiprocessing
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+import asyncclient
+import protocol
+
+PREFIX = "q:"
+
+
+def flood(args, ready, stop, sent):
+    # 大きなルームを作り、先頭の --flooders 人のソケットから送り続ける
+    async def join():
+        options = dict(host=args.host, tcp_port=args.tcp_port, udp_port=args.udp_port)
+        sessions = [await asyncclient.create_room("flood", "user0", **options)]
+        for i in range(1, args.flood_members):
+            sessions.append(
+                await asyncclient.join_room("flood", "user{}".format(i), **options)
+            )
+        # 履歴の要求でアドレスが登録されるのを待つ
+        await asyncio.sleep(0.5)
+        # 受信はしない（リレーの送信コストだけをサーバにかける）
+        for session in sessions:
+            session.transport.pause_reading()
+        return sessions
+
+    loop = asyncio.new_event_loop()
+    sessions = loop.run_until_complete(join())
+    server_address = (args.host, args.udp_port)
+    senders = []
+    for session in sessions[: args.flooders]:
+        frame = protocol.pack_chat(session.session_id, b"", b"x" * 64)
+        # 同じアドレスから送るよう、セッションのソケットを複製して使う
+        fileno = session.transport.get_extra_info("socket").fileno()
+        sock = socket.fromfd(fileno, socket.AF_INET, socket.SOCK_DGRAM)
+        senders.append((sock, frame))
+    ready.set()
+    count = 0
+    started = time.perf_counter()
+    while not stop.is_set():
+        for sock, frame in senders:
+            try:
+                sock.sendto(frame, server_address)
+            except OSError:
+                pass
+        count += len(senders)
+        if args.flood_rate:
+            # 送りすぎた分だけ待つ（0 の場合は全力で送る）
+            ahead = count / args.flood_rate - (time.perf_counter() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+    sent.value = count
+
+
+class Receiver:
+    def __init__(self):
+        self.latencies = []
+
+
+async def receive(session, receiver):
+    async for message in session.messages():
+        if message.body.startswith(PREFIX):
+            receiver.latencies.append(time.perf_counter() - float(message.body[2:]))
+
+
+async def quiet_rooms(args, ready):
+    options = dict(host=args.host, tcp_port=args.tcp_port, udp_port=args.udp_port)
+    sessions = []
+    for room in range(args.quiet_rooms):
+        room_name = "quiet{}".format(room)
+        sessions.append(await asyncclient.create_room(room_name, "user0", **options))
+        for i in range(1, args.quiet_members):
+            sessions.append(
+                await asyncclient.join_room(room_name, "user{}".format(i), **options)
+            )
+    receiver = Receiver()
+    tasks = [asyncio.create_task(receive(session, receiver)) for session in sessions]
+    await asyncio.sleep(0.5)
+    while not ready.is_set():
+        await asyncio.sleep(0.05)
+
+    senders = sessions[:: args.quiet_members]
+    interval = 1 / args.rate
+    sent = 0
+    deadline = time.perf_counter() + args.duration
+    next_send = time.perf_counter()
+    while time.perf_counter() < deadline:
+        sender = senders[sent % len(senders)]
+        # サーバから通知されて待たされると遅延に含まれるよう、待つ前の時刻を入れる
+        await sender.send(PREFIX + repr(time.perf_counter()))
+        sent += 1
+        next_send += interval
+        await asyncio.sleep(max(0, next_send - time.perf_counter()))
+    await asyncio.sleep(args.grace)
+    for session in sessions:
+        session.close()
+    await asyncio.gather(*tasks)
+    return sent * args.quiet_members, sorted(receiver.latencies)
+
+
+def counters(port):
+    with urllib.request.urlopen("http://127.0.0.1:{}/metrics.json".format(port)) as f:
+        return json.load(f)["counters"]
+
+
+def run_scenario(args, name, server_args, flooding):
+    command = [
+        sys.executable,
+        "server.py",
+        "--tcp-port",
+        str(args.tcp_port),
+        "--udp-port",
+        str(args.udp_port),
+        "--metrics-port",
+        str(args.metrics_port),
+        "--log-level",
+        "warning",
+    ] + server_args
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    time.sleep(1.0)
+    ready = multiprocessing.Event()
+    stop = multiprocessing.Event()
+    sent = multiprocessing.Value("q", 0)
+    flooder = None
+    try:
+        if flooding:
+            flooder = multiprocessing.Process(
+                target=flood, args=(args, ready, stop, sent)
+            )
+            flooder.start()
+        else:
+            ready.set()
+        expected, latencies = asyncio.run(quiet_rooms(args, ready))
+        stop.set()
+        if flooder is not None:
+            flooder.join()
+        stats = counters(args.metrics_port)
+    finally:
+        stop.set()
+        server.terminate()
+        server.wait()
+
+    def at(p):
+        if not latencies:
+            return float("nan")
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    print(
+        "{:<8} quiet delivered={:6.1%} p50={:7.2f}ms p99={:8.2f}ms | "
+        "flood sent={:>9} in={:>9} dropped(client)={:>9} dropped(room)={:>8} "
+        "out={:>9}".format(
+            name,
+            len(latencies) / expected,
+            at(0.5),
+            at(0.99),
+            sent.value,
+            stats.get("datagrams_in", 0),
+            stats.get("rate_limited_clients", 0),
+            stats.get("rate_limited_rooms", 0),
+            stats.get("datagrams_out", 0),
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--tcp-port", type=int, default=29202)
+    parser.add_argument("--udp-port", type=int, default=29201)
+    parser.add_argument("--metrics-port", type=int, default=29203)
+    parser.add_argument("--quiet-rooms", type=int, default=20)
+    parser.add_argument("--quiet-members", type=int, default=5)
+    parser.add_argument("--rate", type=float, default=200, help="静かなルーム全体の送信レート（件/秒）")
+    parser.add_argument("--flood-members", type=int, default=200)
+    parser.add_argument("--flooders", type=int, default=20)
+    parser.add_argument(
+        "--flood-rate", type=float, default=5000, help="溢れさせる側の送信レート（件/秒、0の場合は全力）"
+    )
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--grace", type=float, default=1.0)
+    parser.add_argument(
+        "--limits",
+        default="--client-rate 50 --room-rate 100 --throttle-replies",
+        help="limited の時にサーバに渡す引数",
+    )
+    args = parser.parse_args()
+
+    run_scenario(args, "idle", [], False)
+    run_scenario(args, "flood", [], True)
+    run_scenario(args, "limited", args.limits.split(), True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# 認証（トークン → ルーム・クライアント）の検索コストがユーザー数に対してどう変わるかを測る
+# 変更前の「ルーム名の長さ → ユーザー名の長さ → トークンの文字列比較」と Registry.authenticate を比較する
+#
+#   python -m benchmarks.registry --users 1000 10000 100000
+import argparse
+import random
+import secrets
+import time
+
+import server
+
+USERS_PER_ROOM = 100
+
+
+def build_registry(users):
+    registry = server.Registry()
+    credentials = []
+    for i in range(users):
+        room_name = "room{}".format(i // USERS_PER_ROOM)
+        user_name = "user{}".format(i)
+        if i % USERS_PER_ROOM == 0:
+            _, client = registry.create_room(room_name, user_name)
+        else:
+            _, client, _ = registry.join_room(room_name, user_name)
+        credentials.append((room_name, server.encode_token(client.token)))
+    return registry, credentials
+
+
+def build_legacy(credentials):
+    # 変更前の構造: chatrooms[len(room_name)].active_clients[len(user_name)]
+    # トークンも変更前と同じく token_urlsafe(255) の文字列（約340文字）にする
+    chatrooms = {}
+    legacy_credentials = []
+    for i, (room_name, _) in enumerate(credentials):
+        user_name = "user{}".format(i)
+        token = secrets.token_urlsafe(255)
+        room = chatrooms.setdefault(len(room_name), {})
+        room[len(user_name)] = token
+        legacy_credentials.append((room_name, token))
+    return chatrooms, legacy_credentials
+
+
+def legacy_authenticate(chatrooms, room_name, token, user_name):
+    active_clients = chatrooms.get(len(room_name))
+    if active_clients is None:
+        return False
+    stored = active_clients.get(len(user_name))
+    return stored is not None and token == stored
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--lookups", type=int, default=200000)
+    args = parser.parse_args()
+
+    for users in args.users:
+        registry, credentials = build_registry(users)
+        legacy, legacy_credentials = build_legacy(credentials)
+        samples = [random.randrange(users) for _ in range(args.lookups)]
+        # 文字列のハッシュがキャッシュされないよう、受信時と同じく毎回新しい文字列を使う
+        requests = [
+            (credentials[i][0], credentials[i][1].encode().decode()) for i in samples
+        ]
+        legacy_requests = [
+            (
+                legacy_credentials[i][0],
+                legacy_credentials[i][1].encode().decode(),
+                "user{}".format(i),
+            )
+            for i in samples
+        ]
+
+        # 受信したトークン文字列のデコードも含めて測る
+        start = time.perf_counter()
+        ok = 0
+        for room_name, token in requests:
+            if registry.authenticate(server.decode_token(token), room_name) is not None:
+                ok += 1
+        registry_cost = (time.perf_counter() - start) / len(requests)
+
+        start = time.perf_counter()
+        legacy_ok = 0
+        for room_name, token, user_name in legacy_requests:
+            if legacy_authenticate(legacy, room_name, token, user_name):
+                legacy_ok += 1
+        legacy_cost = (time.perf_counter() - start) / len(requests)
+
+        distinct = sum(len(room) for room in legacy.values())
+        print(
+            "users={:>7} registry={:.3f}us ({:.1%} ok) legacy={:.3f}us ({:.1%} ok, "
+            "{} users distinguishable)".format(
+                users,
+                registry_cost * 1e6,
+                ok / len(requests),
+                legacy_cost * 1e6,
+                legacy_ok / len(requests),
+                distinct,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# asyncclient で1つのイベントループから多数のセッションを開き、
+# 参加のスループット、配送率、クライアントのセッション1つあたりのメモリを測る
+#
+#   python -m benchmarks.sessions --sessions 1000 5000 --room-size 50
+import argparse
+import asyncio
+import resource
+import subprocess
+import sys
+import time
+
+import asyncclient
+
+
+def rss_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+async def open_all(args, sessions, prefix):
+    options = dict(host=args.host, tcp_port=args.tcp_port, udp_port=args.udp_port)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def open_one(i):
+        room_name = "{}{}".format(prefix, i // args.room_size)
+        user_name = "user{}".format(i)
+        async with semaphore:
+            if i % args.room_size == 0:
+                return await asyncclient.create_room(room_name, user_name, **options)
+            return await asyncclient.join_room(room_name, user_name, **options)
+
+    # ルームを作ってから、残りのメンバーを参加させる
+    owners = await asyncio.gather(
+        *(open_one(i) for i in range(0, sessions, args.room_size))
+    )
+    members = await asyncio.gather(
+        *(open_one(i) for i in range(sessions) if i % args.room_size != 0)
+    )
+    return list(owners) + list(members)
+
+
+async def run(args, sessions, prefix):
+    before = rss_bytes()
+    start = time.perf_counter()
+    opened = await open_all(args, sessions, prefix)
+    joined = time.perf_counter() - start
+    per_session = (rss_bytes() - before) / sessions
+
+    # 履歴の要求（open() で送る）でアドレスが登録されるのを待ってから、各ルームのオーナーが送る
+    # 受信側も同じイベントループなので、一度に送りすぎないよう --rate で間隔を空ける
+    await asyncio.sleep(args.grace)
+    owners = opened[: (sessions + args.room_size - 1) // args.room_size]
+    for _ in range(args.messages):
+        for session in owners:
+            await session.send("hello")
+            await asyncio.sleep(1 / args.rate)
+    await asyncio.sleep(args.grace)
+    received = 0
+    for session in opened:
+        received += session.queue.qsize()
+    for session in opened:
+        session.close()
+
+    expected = sessions * args.messages
+    print(
+        "sessions={:>6}: join={:.0f}/s delivered={:.1%} ({}/{}) "
+        "client rss={:.1f}KB/session".format(
+            sessions,
+            sessions / joined,
+            received / expected,
+            received,
+            expected,
+            per_session / 1024,
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--tcp-port", type=int, default=29102)
+    parser.add_argument("--udp-port", type=int, default=29101)
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1000, 5000])
+    parser.add_argument("--room-size", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=5, help="ルームごとに送るメッセージ数")
+    parser.add_argument("--rate", type=float, default=500, help="全体の送信レート（件/秒）")
+    parser.add_argument("--grace", type=float, default=2.0, help="送信後に受信を待つ秒数")
+    parser.add_argument("--server-args", default="", help="server.py に渡す引数")
+    args = parser.parse_args()
+
+    # セッションごとにUDPソケットを1つ使うので、開けるファイル数の上限を上げておく
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    command = [
+        sys.executable,
+        "server.py",
+        "--tcp-port",
+        str(args.tcp_port),
+        "--udp-port",
+        str(args.udp_port),
+    ] + args.server_args.split()
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    time.sleep(1.0)
+    try:
+        for index, sessions in enumerate(args.sessions):
+            asyncio.run(run(args, sessions, "bench{}-".format(index)))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# 認証1回あたりのコストとセッション1つあたりのメモリを、ランダムなトークン（索引で検索）と
+# 署名付きトークン（HMACの確認＋ユーザーIDの索引）で比較する
+#
+#   python -m benchmarks.tokens --users 1000 100000
+import argparse
+import gc
+import time
+import tracemalloc
+
+import server
+import tokens
+
+
+def build(users, signed):
+    registry = server.Registry()
+    if signed:
+        registry.signer = tokens.TokenSigner(tokens.generate_keys())
+    issued = []
+    for i in range(users):
+        room_name = "room{}".format(i // 100)
+        if i % 100 == 0:
+            _, client = registry.create_room(room_name, "user{}".format(i))
+        else:
+            _, client, _ = registry.join_room(room_name, "user{}".format(i))
+        issued.append(server.encode_token(registry.issue_token(client)))
+    return registry, issued
+
+
+def measure_memory(users, signed):
+    gc.collect()
+    tracemalloc.start()
+    registry, issued = build(users, signed)
+    # クライアントに渡したトークンはサーバのメモリではないので除く
+    issued_size = sum(len(token) + 49 for token in issued) + 8 * len(issued) + 56
+    used = tracemalloc.get_traced_memory()[0] - issued_size
+    tracemalloc.stop()
+    return used / users, registry, issued
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 100000])
+    parser.add_argument("--iterations", type=int, default=200000)
+    args = parser.parse_args()
+
+    for users in args.users:
+        results = []
+        for name, signed in (("random", False), ("signed", True)):
+            per_session, registry, issued = measure_memory(users, signed)
+            count = len(issued)
+            # テキスト形式の1メッセージ分（base64 のデコード＋認証）
+            start = time.perf_counter()
+            for i in range(args.iterations):
+                token = issued[i % count]
+                registry.authenticate(server.decode_token(token), None)
+            cost = (time.perf_counter() - start) / args.iterations
+            assert registry.authenticate(server.decode_token(issued[0])) is not None
+            results.append((name, cost, per_session, len(issued[0])))
+            del registry, issued
+
+        print(
+            "users={:>7} ".format(users)
+            + " ".join(
+                "{}: auth={:.2f}us mem={:.0f}B/session token={}chars".format(
+                    name, cost * 1e6, per_session, token_size
+                )
+                for name, cost, per_session, token_size in results
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+# ワーカープロセス数ごとのリレーのスループット（1秒あたりに配送できたメッセージ数）を測る
+#
+#   python -m benchmarks.workers --workers 0 1 2 4 --rooms 16 --members 20
+#
+# --workers 0 は従来どおり1スレッドでリレーするモード。
+# 複数コアを使う効果を見るため、CPUが2コア以上ある環境で実行すること。
+import argparse
+import multiprocessing
+import selectors
+import socket
+import subprocess
+import sys
+import time
+
+import protocol
+from asyncclient import create_body, create_header
+
+HOST = "127.0.0.1"
+
+
+def recv_until_closed(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+
+def handshake(tcp_port, operation, room_name, user_name):
+    sock = socket.create_connection((HOST, tcp_port))
+    try:
+        sock.sendall(
+            create_header(
+                len(room_name.encode("utf-8")),
+                operation,
+                0,
+                len(user_name.encode("utf-8")),
+            )
+            + create_body(room_name, user_name)
+        )
+        response = recv_until_closed(sock)
+    finally:
+        sock.close()
+    if len(response) < 3 or response[2] != 2:
+        raise Exception("handshake failed for {}".format(user_name))
+    response = response[3:]
+    (session_id,) = protocol.SESSION_ID.unpack_from(response)
+    return session_id, response[protocol.SESSION_ID.size :]
+
+
+def bind_member(udp_port, tcp_port, operation, room_name, user_name):
+    # ハンドシェイクしてから、トークン付きのメッセージを送ってUDPアドレスを登録する
+    session_id, token = handshake(tcp_port, operation, room_name, user_name)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    sock.settimeout(2.0)
+    sock.sendto(protocol.pack_chat(session_id, token, b"hello"), (HOST, udp_port))
+    sock.recvfrom(protocol.MAX_DATAGRAM_SIZE)
+    return sock, session_id
+
+
+def receive(tcp_port, udp_port, rooms, members, ready, stop, results):
+    sockets = []
+    for room in range(rooms):
+        for member in range(1, members):
+            sock, _ = bind_member(
+                udp_port, tcp_port, 2, "room{}".format(room), "user{}".format(member)
+            )
+            sock.setblocking(False)
+            sockets.append(sock)
+    ready.set()
+
+    selector = selectors.DefaultSelector()
+    for sock in sockets:
+        selector.register(sock, selectors.EVENT_READ)
+    received = 0
+    while not stop.is_set():
+        for key, _ in selector.select(timeout=0.1):
+            while True:
+                try:
+                    key.fileobj.recv(protocol.MAX_DATAGRAM_SIZE)
+                except BlockingIOError:
+                    break
+                received += 1
+    results.put(received)
+
+
+def bench(worker_count, args, offset):
+    tcp_port = args.port + offset * 2
+    udp_port = tcp_port + 1
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "server.py",
+            "--tcp-port",
+            str(tcp_port),
+            "--udp-port",
+            str(udp_port),
+            "--workers",
+            str(worker_count),
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    time.sleep(1.0)
+    try:
+        owners = [
+            bind_member(udp_port, tcp_port, 1, "room{}".format(room), "owner")
+            for room in range(args.rooms)
+        ]
+
+        ready = multiprocessing.Event()
+        stop = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        receiver = multiprocessing.Process(
+            target=receive,
+            args=(tcp_port, udp_port, args.rooms, args.members, ready, stop, results),
+        )
+        receiver.start()
+        ready.wait()
+
+        frames = [
+            (sock, protocol.pack_chat(session_id, b"", b"x" * args.message_size))
+            for sock, session_id in owners
+        ]
+        sent = 0
+        interval = 1.0 / args.rate if args.rate else 0
+        start = time.perf_counter()
+        deadline = start + args.duration
+        while time.perf_counter() < deadline:
+            for sock, frame in frames:
+                sock.sendto(frame, (HOST, udp_port))
+                sent += 1
+            if interval:
+                time.sleep(interval)
+        elapsed = time.perf_counter() - start
+        # 送信が終わった後もリレーが追いつくまで少し待つ
+        time.sleep(1.0)
+        stop.set()
+        delivered = results.get()
+        receiver.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    recipients = args.members - 1
+    print(
+        "workers={} sent={:.0f}msg/s delivered={:.0f}datagrams/s "
+        "relayed={:.0f}msg/s ratio={:.1%}".format(
+            worker_count,
+            sent / elapsed,
+            delivered / elapsed,
+            delivered / recipients / elapsed,
+            delivered / (sent * recipients) if sent else 0,
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2, 4])
+    parser.add_argument("--rooms", type=int, default=16)
+    parser.add_argument("--members", type=int, default=20)
+    parser.add_argument("--message-size", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument(
+        "--rate", type=float, default=0, help="1秒あたりの送信ラウンド数（0は上限なし）"
+    )
+    parser.add_argument("--port", type=int, default=19100)
+    args = parser.parse_args()
+
+    for offset, worker_count in enumerate(args.workers):
+        bench(worker_count, args, offset)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,191 +1,196 @@
-import socket
+import argparse
+import asyncio
 import sys
+import threading
 
-# チャットルームの作成と接続（TCP）
+import asyncclient
 
+# 対話型のクライアント
+# チャットルームの作成と接続（TCP）、メッセージの送受信（UDP）は asyncclient で行う
 
-def create_header(room_name_size, operation, state, operation_payload_size):
-    # 各値をバイト列に変換
-    room_name_size_bytes = room_name_size.to_bytes(1, byteorder="big")
-    operation_bytes = operation.to_bytes(1, byteorder="big")
-    state_bytes = state.to_bytes(1, byteorder="big")
-    operation_payload_size_bytes = operation_payload_size.to_bytes(29, byteorder="big")
+# ベンチマークなどから使われているので、ここからも import できるようにしておく
+from asyncclient import create_body, create_header  # noqa: F401
 
-    # ヘッダーの組み立て
-    header = (
-        room_name_size_bytes
-        + operation_bytes
-        + state_bytes
-        + operation_payload_size_bytes
-    )
-    return header
+# ルーム名 → 最後に表示したメッセージの番号（talk_in_room をやり直した時に、その後の履歴から受け取るため）
+last_seen = {}
+# ルーム名 → その番号の Epoch（サーバが再起動して番号が振り直されたかを確かめるため）
+epochs = {}
 
 
-def create_body(room_name, operation_payload):
-    # ルーム名とオペレーションペイロードをUTF-8でバイト列にエンコード
-    room_name_bytes = room_name.encode("utf-8")
-    operation_payload_bytes = operation_payload.encode("utf-8")
+class LineReader:
+    # 標準入力を別スレッドで1行ずつ読み、イベントループのキューに入れる
+    # 入力待ちをキャンセルしても、読みかけの行が失われないようにするため
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
 
-    # ボディの組み立て
-    body = room_name_bytes + operation_payload_bytes
-    return body
+    def run(self):
+        for line in sys.stdin:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, line.rstrip("\n"))
+        # 入力の終わり
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
 
+    async def input(self, prompt: str) -> str:
+        print(prompt, end="", flush=True)
+        line = await self.queue.get()
+        if line is None:
+            raise EOFError
+        return line
 
-import threading
 
-# グローバル変数で認証エラーを追跡
-auth_error = False
+async def input_validation_max(reader: LineReader, input_name: str, max_length: int):
+    while True:
+        input_val = await reader.input("Please input " + input_name + ": ")
+        encoded_name = input_val.encode("utf-8")
 
-# ユーザーがチャットを終了したい場合のためのグローバル変数
-exit_command = False
+        if len(encoded_name) <= max_length:
+            return input_val
+        else:
+            print(input_name + " must be less than " + str(max_length) + " bytes!")
 
 
-def receive_message(sock, stop_event):
-    global auth_error
-    while not stop_event.is_set():
-        try:
-            data, _ = sock.recvfrom(4096)
-            print("Received:", data.decode("utf-8"))
-            message = data.decode("utf-8")
-            if message == "Invalid token":
-                #  認証エラーが起きていた場合、停止
-                # 認証エラー時にメッセージの送受信を停止→main()の最初からやり直したい
-                auth_error = True
-                stop_event.set()
-        except:
-            pass
-
-
-def talk_in_room(user_name, token, room_name):
-    global auth_error
-    global exit_command
-
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    server_address = ("localhost", 9001)
-    stop_event = threading.Event()
-
-    # 受信スレッドを開始
-    receiver_thread = threading.Thread(target=receive_message, args=(sock, stop_event))
-    receiver_thread.start()
+async def print_messages(session: asyncclient.ChatSession):
+    async for message in session.messages():
+        print("Received:", message.user_name + ":" + message.body)
+
 
+async def talk_in_room(reader: LineReader, session: asyncclient.ChatSession):
+    # 受信したメッセージを表示しながら、入力されたメッセージをサーバに送る
+    receiver = asyncio.create_task(print_messages(session))
     try:
         while True:
-            if auth_error:
-                print("Authentication error occurred. Exiting chat room.")
-                return "auth_error"
-            if exit_command:
-                print("Exiting chat room.")
+            line = asyncio.create_task(
+                reader.input("Input your message (or type 'exit' to quit): ")
+            )
+            await asyncio.wait({line, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if receiver.done():
+                line.cancel()
+                try:
+                    receiver.result()
+                except asyncclient.AuthError:
+                    # 認証エラー時はメッセージの送受信を停止し、main() の最初からやり直す
+                    print("Authentication error occurred. Exiting chat room.")
+                    return "auth_error"
                 return "exit_command"
-            message = input("Input your message (or type 'exit' to quit): ")
+
+            message = line.result()
             if message.lower() == "exit":
-                print("exit", message)
-                exit_command = True
-                # return "exit_command"
-            full_message = f"{room_name}:{token}:{user_name}:{message}"
-            if len(full_message.encode("utf-8")) > 4096:
-                print("message should be less than 4096 bytes")
-                continue
-            else:
-                # サーバにメッセージを送る
-                sock.sendto(full_message.encode("utf-8"), server_address)
+                print("Exiting chat room.")
+                return "exit_command"
+            try:
+                await session.send(message)
+            except ValueError as err:
+                print(err)
     finally:
-        # 受信スレッドを停止
-        print("talk_in_room finally")
-        stop_event.set()
-        receiver_thread.join()
-        sock.close()
-
+        # 受信を停止
+        receiver.cancel()
+        session.close()
+        last_seen[session.room_name] = session.last_seen
+        epochs[session.room_name] = session.epoch
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Online Chat Messenger client")
+    parser.add_argument("--host", default=asyncclient.DEFAULT_HOST)
+    parser.add_argument("--tcp-port", type=int, default=asyncclient.DEFAULT_TCP_PORT)
+    parser.add_argument("--udp-port", type=int, default=asyncclient.DEFAULT_UDP_PORT)
+    parser.add_argument(
+        "--text-frames",
+        action="store_true",
+        help="従来のテキスト形式でメッセージを送る（サーバも --text-frames で起動すること）",
+    )
+    return parser.parse_args(argv)
 
-def input_validation_max(input_name: str, max_length: int):
-    while True:
-        input_val = input("Please input " + input_name + ": ")
-        encoded_name = input_val.encode("utf-8")
 
-        if len(encoded_name) <= max_length:
-            return input_val
-        else:
-            print(input_name + " must be less than " + str(max_length) + " bytes!")
+async def print_rooms(control: asyncclient.ControlSession):
+    rooms = await control.list_rooms()
+    if rooms:
+        print("rooms:", ", ".join("{} ({})".format(*room) for room in rooms))
 
 
-def main():
-    global auth_error
-    global exit_command
+async def run(args):
+    reader = LineReader()
+    options = dict(
+        host=args.host,
+        tcp_port=args.tcp_port,
+        udp_port=args.udp_port,
+        text_frames=args.text_frames,
+    )
+    # 作成・参加・退出は1本の制御用の接続で行い、操作ごとにTCP接続を張り直さない
+    # （サーバが一定時間で閉じるので、切れていたら張り直す）
+    control = None
     while True:
-        auth_error = False
-        exit_command = False
+        user_name = await input_validation_max(
+            reader, "user name", asyncclient.MAX_USERNAME_SIZE
+        )
+        start_room = await reader.input("Do you start a new chat? - y/n")
 
-        user_name = input_validation_max("user name", 255)
-        start_room = input("Do you start a new chat? - y/n")
-        room_name = input_validation_max("room name", 28)
-
-        # サーバが待ち受けているポートにソケットを接続します
-        server_address = "localhost"
-        server_port = 9002
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-        print("connecting to {}".format(server_address, server_port))
+        print("connecting to {}:{}".format(args.host, args.tcp_port))
         try:
-            sock.connect((server_address, server_port))
-        except socket.error as err:
+            if control is None or control.closed:
+                control = await asyncclient.connect_control(args.host, args.tcp_port)
+            if start_room != "y" and start_room != "Y":
+                await print_rooms(control)
+        except OSError as err:
             print(err)
             sys.exit(1)
-
-        operation = 2
-        print("start_room", start_room)
-        if start_room == "y" or start_room == "Y":
-            operation = 1
-            # 新たなチャットルームを作成する
-            print("starting a new chat room...")
-        else:
-            print("entering the chat room...")
-
+        except asyncclient.ChatError as err:
+            print("connecting failed:", err)
+            continue
+        room_name = await input_validation_max(
+            reader, "room name", asyncclient.MAX_ROOMNAME_SIZE
+        )
+
+        options["control"] = control
         try:
-            # ヘッダー（32 バイト）: RoomNameSize（1 バイト） | Operation（1 バイト） | State（1 バイト） | OperationPayloadSize（29 バイト）
-            header = create_header(len(room_name), operation, 0, len(user_name))
-            # ヘッダの送信
-            sock.send(header)
-            # ボディの送信
-            body = create_body(room_name, user_name)
-            sock.send(body)
-
-            # サーバーからの応答（トークン）を待ち受ける
-            while True:
-                response = sock.recv(1)
-                response_value = int.from_bytes(response, "big")  # レスポンスを整数に変換
-                if response_value == 0:
-                    print("initializing")
-                elif response_value == 1:
-                    print("preparing")
-                elif response_value == 2:
-                    print("success!")
-                    break
-                else:
-                    raise Exception("something wrong with starting chatroom")
-
-            # サーバーからトークンを受け取る
-            response = sock.recv(4096)
-
-            token = response.decode("utf-8")
-            print("received token", token)
-            sock.close()
-
-            # チャット開始
-            # talk_in_room(user_name, token, room_name)
-            chat_result = talk_in_room(user_name, token, room_name)
-
-            if chat_result == "exit_command":  # ユーザーが終了を希望する場合
-                print("Exiting the chat room...")
-                # break  # main()関数から抜ける
-                continue  # main()関数の最初からやり直す
-
-            if chat_result == "auth_error":
-                print("Authentication error. Restarting...")
-                continue  # main()関数の最初からやり直す
-
-        except:
-            print("starting a chat room failed")
-            sock.close()
+            if start_room == "y" or start_room == "Y":
+                # 新たなチャットルームを作成する
+                print("starting a new chat room...")
+                # 新しいルームなので、同じ名前の前のルームの番号は使わない
+                last_seen.pop(room_name, None)
+                session = await asyncclient.create_room(room_name, user_name, **options)
+            else:
+                print("entering the chat room...")
+                session = await asyncclient.join_room(
+                    room_name,
+                    user_name,
+                    last_seen=last_seen.get(room_name, 0),
+                    epoch=epochs.get(room_name, 0),
+                    **options,
+                )
+        except OSError as err:
+            print(err)
             sys.exit(1)
+        except asyncclient.ChatError as err:
+            print("starting a chat room failed:", err)
+            continue
+        print("success!")
+
+        # チャット開始
+        chat_result = await talk_in_room(reader, session)
+
+        if chat_result == "exit_command":  # ユーザーが終了を希望する場合
+            print("Exiting the chat room...")
+            try:
+                await control.leave(session.session_id, session.token)
+            except asyncclient.ChatError:
+                # 制御用の接続が切れていた場合は、サーバ側のタイムアウトで退出になる
+                pass
+            continue  # 最初からやり直す
+
+        if chat_result == "auth_error":
+            print("Authentication error. Restarting...")
+            continue  # 最初からやり直す
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        asyncio.run(run(args))
+    except (EOFError, KeyboardInterrupt):
+        pass
 
 
-main()
+if __name__ == "__main__":
+    main()
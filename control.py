@@ -0,0 +1,150 @@
+import struct
+
+# 制御用の接続（TCP 9002番）のフレーム
+#
+# ハンドシェイクのヘッダーで Operation に OPERATION_CONTROL（3）を送ると（ルーム名・ペイロードは0バイト）、
+# サーバは 1（処理中）, 2（完了）を返した後、その接続を閉じずに制御用の接続として使う。
+# 1本の接続で作成・参加・退出・一覧などの操作を何回でも行えるので、操作ごとに TCP 接続を張り直さない。
+#
+# リクエスト（クライアント → サーバ）
+#   Length（4） | RequestID（4） | Operation（1） | Body
+# レスポンス（サーバ → クライアント）
+#   Length（4） | RequestID（4） | Status（1） | Body
+# Length はそれより後のバイト数。クライアントは応答を待たずに次のリクエストを送ってよい（パイプライン）。
+# 応答はリクエストの順番どおりとは限らないので、クライアントは RequestID で対応を取る。
+#
+# Operation ごとの Body（リクエスト → 成功した時のレスポンス）
+#   OP_CREATE / OP_JOIN:  RoomNameSize（1） | RoomName | UserName → SessionID（4） | Token
+#   OP_LEAVE:             SessionID（4） | Token → なし
+#   OP_RENEW:             SessionID（4） | Token → SessionID（4） | Token（新しいトークン）
+#   OP_LIST_ROOMS:        Limit（2） | Prefix → { NameSize（1） | Members（4） | RoomName } × ルーム数（名前順）
+#   OP_LIST_MEMBERS:      Limit（2） | RoomName → { NameSize（1） | UserName } × 人数
+# Token はハンドシェイクで返すものと同じ文字列（ASCII）。
+# テキスト形式のハンドシェイクは SessionID を返さないので、SessionID を 0 にするとトークンだけで認証する。
+
+OP_CREATE = 1  # ハンドシェイクの Operation と同じ値
+OP_JOIN = 2
+OP_LEAVE = 3
+OP_RENEW = 4
+OP_LIST_ROOMS = 5
+OP_LIST_MEMBERS = 6
+
+STATUS_OK = 0
+STATUS_FAILED = 1  # ルームがすでにある・ない（ハンドシェイクの 3 と同じ）
+STATUS_INVALID_TOKEN = 2
+STATUS_BAD_REQUEST = 3
+
+LENGTH = struct.Struct("!I")
+HEADER = struct.Struct("!IIB")  # Length | RequestID | Operation（または Status）
+SESSION = struct.Struct("!I")
+LIMIT = struct.Struct("!H")
+ROOM_ENTRY = struct.Struct("!BI")
+
+# リクエストの最大バイト数（Length の値）。ルーム名・ユーザー名・トークンが入れば足りる
+MAX_REQUEST_SIZE = 1024
+# レスポンスの最大バイト数。一覧は MAX_LIST_ENTRIES 件までに切り詰める
+MAX_RESPONSE_SIZE = 1 << 20
+MAX_LIST_ENTRIES = 1000
+
+
+def pack_frame(request_id: int, code: int, body: bytes = b"") -> bytes:
+    # code はリクエストなら Operation、レスポンスなら Status
+    return HEADER.pack(HEADER.size - LENGTH.size + len(body), request_id, code) + body
+
+
+def unpack_frames(buffer, max_size: int):
+    # 受信したバイト列から完全なフレームを取り出し、([(RequestID, code, Body), ...], 使ったバイト数) を返す
+    # Length が max_size を超えるなど、形式が正しくなければ ValueError
+    frames = []
+    offset = 0
+    size = len(buffer)
+    while size - offset >= LENGTH.size:
+        (length,) = LENGTH.unpack_from(buffer, offset)
+        if not HEADER.size - LENGTH.size <= length <= max_size:
+            raise ValueError("invalid control frame length {}".format(length))
+        end = offset + LENGTH.size + length
+        if end > size:
+            break
+        _, request_id, code = HEADER.unpack_from(buffer, offset)
+        frames.append((request_id, code, bytes(buffer[offset + HEADER.size : end])))
+        offset = end
+    return frames, offset
+
+
+def pack_room_request(room_name: str, user_name: str) -> bytes:
+    room_name_bytes = room_name.encode("utf-8")
+    return bytes([len(room_name_bytes)]) + room_name_bytes + user_name.encode("utf-8")
+
+
+def unpack_room_request(body: bytes):
+    # (ルーム名, ユーザー名) を返す
+    if not body:
+        raise ValueError("empty room request")
+    size = body[0]
+    if 1 + size > len(body):
+        raise ValueError("room name is truncated")
+    return body[1 : 1 + size].decode("utf-8"), body[1 + size :].decode("utf-8")
+
+
+def pack_session(session_id: int, token: str) -> bytes:
+    return SESSION.pack(session_id) + token.encode("ascii")
+
+
+def unpack_session(body: bytes):
+    # (セッションID, トークン) を返す
+    if len(body) < SESSION.size:
+        raise ValueError("session is truncated")
+    (session_id,) = SESSION.unpack_from(body)
+    return session_id, body[SESSION.size :].decode("ascii")
+
+
+def pack_list_request(limit: int, name: str) -> bytes:
+    return LIMIT.pack(min(limit, 0xFFFF)) + name.encode("utf-8")
+
+
+def unpack_list_request(body: bytes):
+    # (件数の上限, 名前) を返す
+    if len(body) < LIMIT.size:
+        raise ValueError("list request is truncated")
+    (limit,) = LIMIT.unpack_from(body)
+    return min(limit, MAX_LIST_ENTRIES), body[LIMIT.size :].decode("utf-8")
+
+
+def pack_rooms(entries) -> bytes:
+    # entries は [(ルーム名, 人数), ...]
+    chunks = []
+    for room_name, members in entries:
+        encoded = room_name.encode("utf-8")
+        chunks.append(ROOM_ENTRY.pack(len(encoded), members))
+        chunks.append(encoded)
+    return b"".join(chunks)
+
+
+def unpack_rooms(body: bytes):
+    entries = []
+    offset = 0
+    while offset < len(body):
+        size, members = ROOM_ENTRY.unpack_from(body, offset)
+        offset += ROOM_ENTRY.size
+        entries.append((body[offset : offset + size].decode("utf-8"), members))
+        offset += size
+    return entries
+
+
+def pack_names(names) -> bytes:
+    chunks = []
+    for name in names:
+        encoded = name.encode("utf-8")
+        chunks.append(bytes([len(encoded)]))
+        chunks.append(encoded)
+    return b"".join(chunks)
+
+
+def unpack_names(body: bytes):
+    names = []
+    offset = 0
+    while offset < len(body):
+        size = body[offset]
+        names.append(body[offset + 1 : offset + 1 + size].decode("utf-8"))
+        offset += 1 + size
+    return names
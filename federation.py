@@ -0,0 +1,212 @@
+import socket
+import struct
+import time
+
+# 複数のサーバの間でルームを共有する（フェデレーション）
+#
+# 各サーバ（ノード）は --peers で他の全ノードの UDP アドレスを知っている（フルメッシュ）。
+# ノード間のフレームもクライアント用の UDP ポート（9001番）で送受信し、送信元アドレスが
+# --peers のどれかなら、クライアントのフレームではなくこのモジュールのフレームとして扱う。
+#
+#   ・各ノードは、自分のところに参加者がいるルームの一覧を他のノードに知らせる
+#     （参加者が0人から1人になった時・0人になった時にすぐ知らせ、GOSSIP_INTERVAL ごとに全部を送り直す）
+#   ・メッセージは、そのルームに参加者がいるノードにだけ、ノードごとに1回だけ送る。
+#     受け取ったノードが自分のところの参加者にリレーする（他のノードのクライアントには直接送らない）
+#   ・受け取ったメッセージは他のノードへ送り直さない。フルメッシュなので送り元が全員に送っている。
+#     さらに (送り元ノード, メッセージID) で重複を捨て、自分が送り元のものも捨てる（ループ防止）
+#
+# フレーム
+#   Magic（1） | Version（1） | Kind（1） | Node（2） | ...
+#   KIND_ROOMS / KIND_ROOMS_GONE: { RoomNameSize（1） | RoomName } × ルーム数
+#   KIND_MESSAGE: MessageID（8） | RoomNameSize（1） | NameSize（1） | RoomName | Name | Body
+#
+# 先頭の1バイトはクライアントのフレーム（0xF5）とも UTF-8 とも違う 0xF6 にしてある。
+
+FEDERATION_MAGIC = 0xF6
+FEDERATION_VERSION = 1
+
+KIND_ROOMS = 1  # このルームに参加者がいる
+KIND_ROOMS_GONE = 2  # このルームに参加者がいなくなった
+KIND_MESSAGE = 3
+
+HEADER = struct.Struct("!BBBH")
+MESSAGE_HEADER = struct.Struct("!BBBHQBB")
+ROOM_NAME_SIZE = struct.Struct("!B")
+
+MAX_FRAME_SIZE = 8192
+
+# ルームの一覧を送り直す間隔（秒）と、送られてこなくなったノードをルームから外すまでの時間
+GOSSIP_INTERVAL = 5.0
+ROOM_TIMEOUT = GOSSIP_INTERVAL * 3
+# 送り元ノードごとに覚えておくメッセージIDの数
+DEDUP_SIZE = 4096
+
+
+def parse_peer(text: str):
+    # "host:port" を (IPアドレス, ポート) にする（受信したデータグラムの送信元と比べるため）
+    host, _, port = text.rpartition(":")
+    return socket.gethostbyname(host or "127.0.0.1"), int(port)
+
+
+def pack_message(node_id: int, message_id: int, room_name: bytes, name: bytes, body):
+    return b"".join(
+        (
+            MESSAGE_HEADER.pack(
+                FEDERATION_MAGIC,
+                FEDERATION_VERSION,
+                KIND_MESSAGE,
+                node_id,
+                message_id,
+                len(room_name),
+                len(name),
+            ),
+            room_name,
+            name,
+            body,
+        )
+    )
+
+
+def pack_rooms(node_id: int, kind: int, room_names):
+    # ルーム名の一覧を MAX_FRAME_SIZE に収まる分ずつのフレームにする
+    header = HEADER.pack(FEDERATION_MAGIC, FEDERATION_VERSION, kind, node_id)
+    chunk = [header]
+    size = HEADER.size
+    for room_name in room_names:
+        encoded = room_name.encode("utf-8")
+        entry = ROOM_NAME_SIZE.pack(len(encoded)) + encoded
+        if size + len(entry) > MAX_FRAME_SIZE:
+            yield b"".join(chunk)
+            chunk = [header]
+            size = HEADER.size
+        chunk.append(entry)
+        size += len(entry)
+    if len(chunk) > 1:
+        yield b"".join(chunk)
+
+
+def unpack_rooms(data: bytes):
+    # 形式が正しくなければ ValueError（UnicodeDecodeError を含む）
+    offset = HEADER.size
+    room_names = []
+    while offset < len(data):
+        size = data[offset]
+        offset += 1
+        if offset + size > len(data):
+            raise ValueError("room name is truncated")
+        room_names.append(data[offset : offset + size].decode("utf-8"))
+        offset += size
+    return room_names
+
+
+class Federation:
+    def __init__(self, node_id: int, peers):
+        self.node_id = node_id
+        # ピアの (IPアドレス, ポート) の集合。この集合からのデータグラムだけをノード間のフレームとして扱う
+        self.peers = set(peers)
+        # ルーム名 → {そのルームに参加者がいるピアのアドレス: 最後に知らされた時刻}
+        self.rooms = {}
+        # 送り元ノード → 最近受け取ったメッセージIDの dict（挿入順に古いものから消す）
+        self.seen = {}
+        # 再起動しても前のメッセージIDと重ならないよう、時刻から始める
+        self.next_message_id = time.time_ns()
+        # 重複して届いたメッセージの数
+        self.duplicates = 0
+        # 送信に使うソケット（クライアント用の UDP ソケット。受信ループを始める時に設定する）
+        self.sock = None
+
+    def has_room(self, room_name: str) -> bool:
+        # 他のノードにこのルームの参加者がいるかどうか
+        return bool(self.rooms.get(room_name))
+
+    def forward(self, room_name: str, name: bytes, body) -> int:
+        # ローカルの参加者にリレーしたメッセージを、そのルームに参加者がいるノードに1回ずつ送る
+        # 送ったデータグラムの数を返す
+        targets = self.rooms.get(room_name)
+        if not targets:
+            return 0
+        message_id = self.next_message_id
+        self.next_message_id += 1
+        frame = pack_message(
+            self.node_id, message_id, room_name.encode("utf-8"), name, body
+        )
+        sendto = self.sock.sendto
+        sent = 0
+        for address in targets:
+            try:
+                sendto(frame, address)
+                sent += 1
+            except OSError:
+                pass
+        return sent
+
+    def receive(self, data: bytes, address, now: float):
+        # ピアからのフレームを処理する
+        # ローカルの参加者にリレーするメッセージなら (ルーム名, ユーザー名, 本文) を返す
+        # 形式が正しくなければ ValueError（UnicodeDecodeError を含む）
+        if len(data) < HEADER.size:
+            return None
+        magic, version, kind, node_id = HEADER.unpack_from(data)
+        if magic != FEDERATION_MAGIC or version != FEDERATION_VERSION:
+            return None
+        if node_id == self.node_id:
+            # 自分が送ったもの（--peers に自分が入っている場合など）
+            return None
+
+        if kind == KIND_MESSAGE:
+            if len(data) < MESSAGE_HEADER.size:
+                return None
+            _, _, _, _, message_id, room_size, name_size = MESSAGE_HEADER.unpack_from(
+                data
+            )
+            offset = MESSAGE_HEADER.size
+            if offset + room_size + name_size > len(data):
+                raise ValueError("federation message is truncated")
+            # 受け取ったことにする前に確かめる（壊れたフレームでメッセージIDを埋めないため）
+            room_name = data[offset : offset + room_size].decode("utf-8")
+            offset += room_size
+            seen = self.seen.get(node_id)
+            if seen is None:
+                seen = self.seen[node_id] = {}
+            if message_id in seen:
+                self.duplicates += 1
+                return None
+            seen[message_id] = None
+            if len(seen) > DEDUP_SIZE:
+                del seen[next(iter(seen))]
+            name = data[offset : offset + name_size]
+            return room_name, name, data[offset + name_size :]
+
+        if kind == KIND_ROOMS:
+            for room_name in unpack_rooms(data):
+                self.rooms.setdefault(room_name, {})[address] = now
+        elif kind == KIND_ROOMS_GONE:
+            for room_name in unpack_rooms(data):
+                nodes = self.rooms.get(room_name)
+                if nodes is not None:
+                    nodes.pop(address, None)
+                    if not nodes:
+                        del self.rooms[room_name]
+        return None
+
+    def announce(self, kind: int, room_names):
+        # ルームの一覧を全ピアに送る（ハンドシェイクのスレッドからも呼ぶ）
+        if self.sock is None:
+            # まだ受信ループが始まっていない。始まった時に全部を送る
+            return
+        for frame in pack_rooms(self.node_id, kind, room_names):
+            for address in self.peers:
+                try:
+                    self.sock.sendto(frame, address)
+                except OSError:
+                    pass
+
+    def expire(self, now: float):
+        # しばらく一覧が送られてこないノード（停止したノードなど）をルームから外す
+        oldest = now - ROOM_TIMEOUT
+        for room_name, nodes in list(self.rooms.items()):
+            for address, updated in list(nodes.items()):
+                if updated < oldest:
+                    del nodes[address]
+            if not nodes:
+                del self.rooms[room_name]
@@ -0,0 +1,237 @@
+import mmap
+import os
+import queue
+import socket
+import struct
+import threading
+
+# ルームとセッションの状態を再起動後も残すためのジャーナル
+#
+# 参加・退出などのイベントを追記専用のログ（journal.<世代>）に書き、ログが大きくなったら
+# その時点の状態をスナップショット（snapshot）に書き出して、新しい世代のログに切り替える。
+# 起動時はスナップショットを mmap で読み、その世代以降のログを再生して状態を組み立て直す。
+#
+# ログへの書き込みは専用のスレッドで行い、イベントを記録する側（リレーのスレッドなど）は
+# キューに入れるだけで待たない。
+#
+# レコード（ログとスナップショットで共通）
+#   Kind（1） | UserID（4） | RoomNameSize（1） | UserNameSize（1） | Token（32） | RoomName | UserName | Address（6）
+#   ・Token は CREATE / JOIN の時だけ、Address は BIND の時だけ付く
+#
+# スナップショット
+#   Magic（8） | Generation（4） | NextUserID（8） | レコード × 人数
+#   ・Generation は、このスナップショットの後に再生するログの世代
+
+KIND_CREATE = 1
+KIND_JOIN = 2
+KIND_LEAVE = 3
+KIND_EXPIRE = 4
+KIND_BIND = 5
+
+RECORD_HEADER = struct.Struct("!BIBB")
+ADDRESS = struct.Struct("!4sH")
+SNAPSHOT_HEADER = struct.Struct("!8sIQ")
+SNAPSHOT_MAGIC = b"CHATSNP1"
+TOKEN_SIZE = 32
+
+SNAPSHOT_NAME = "snapshot"
+LOG_PREFIX = "journal."
+
+# ログがこのバイト数を超えたらスナップショットを取る
+DEFAULT_SNAPSHOT_BYTES = 64 * 1024 * 1024
+# 書き込みスレッドが1回にまとめて書くイベントの最大数
+WRITE_BATCH = 4096
+
+
+def encode_record(kind, userid, room_name, user_name=b"", token=b"", address=b""):
+    # room_name / user_name は UTF-8 のバイト列、address は ADDRESS でパックしたもの
+    return b"".join(
+        (
+            RECORD_HEADER.pack(kind, userid, len(room_name), len(user_name)),
+            token,
+            room_name,
+            user_name,
+            address,
+        )
+    )
+
+
+def decode_records(data, offset, end):
+    # (kind, ユーザーID, ルーム名, ユーザー名, トークン, アドレス) を順に返す
+    # 各レコードは (そのレコードの次の位置, イベント) の形で返す
+    # 最後のレコードが途中で切れている場合（書き込み中に止まった場合）はそこで終わる
+    while offset + RECORD_HEADER.size <= end:
+        kind, userid, room_size, name_size = RECORD_HEADER.unpack_from(data, offset)
+        if not KIND_CREATE <= kind <= KIND_BIND:
+            return
+        position = offset + RECORD_HEADER.size
+        # デコードする前に、レコード全体が end までに収まっているかを確かめる
+        size = room_size + name_size
+        if kind == KIND_CREATE or kind == KIND_JOIN:
+            size += TOKEN_SIZE
+        elif kind == KIND_BIND:
+            size += ADDRESS.size
+        if position + size > end:
+            return
+        token = b""
+        if kind == KIND_CREATE or kind == KIND_JOIN:
+            token = bytes(data[position : position + TOKEN_SIZE])
+            position += TOKEN_SIZE
+        try:
+            room_name = bytes(data[position : position + room_size]).decode("utf-8")
+            position += room_size
+            user_name = bytes(data[position : position + name_size]).decode("utf-8")
+            position += name_size
+        except UnicodeDecodeError:
+            # 壊れたレコード。途中で切れた場合と同じく、そこで終わる
+            return
+        address = None
+        if kind == KIND_BIND:
+            ip, port = ADDRESS.unpack_from(data, position)
+            address = (socket.inet_ntoa(ip), port)
+            position += ADDRESS.size
+        offset = position
+        yield offset, (kind, userid, room_name, user_name, token, address)
+
+
+def pack_address(address):
+    host, port = address
+    return ADDRESS.pack(socket.inet_aton(host), port)
+
+
+class Journal:
+    def __init__(self, directory: str, snapshot_bytes: int = DEFAULT_SNAPSHOT_BYTES):
+        self.directory = directory
+        self.snapshot_bytes = snapshot_bytes
+        self.generation = 0
+        self.next_userid = 1
+        self.file = None
+        self.size = 0
+        self.queue = queue.SimpleQueue()
+        # スナップショットを取る時に、その時点の状態をレコードの列として返す関数
+        self.dump = None
+        self.thread = None
+        os.makedirs(directory, exist_ok=True)
+
+    def log_path(self, generation: int) -> str:
+        return os.path.join(self.directory, "{}{}".format(LOG_PREFIX, generation))
+
+    def log_generations(self):
+        generations = []
+        for name in os.listdir(self.directory):
+            if name.startswith(LOG_PREFIX) and name[len(LOG_PREFIX) :].isdigit():
+                generations.append(int(name[len(LOG_PREFIX) :]))
+        return sorted(generations)
+
+    def recover(self):
+        # スナップショットとその後のログを古い順に読み、イベントを返す（最後まで読むこと）
+        # 読み終わったら、最後のログの壊れていない部分の後ろから追記できるようにしておく
+        path = os.path.join(self.directory, SNAPSHOT_NAME)
+        if os.path.exists(path) and os.path.getsize(path) >= SNAPSHOT_HEADER.size:
+            with open(path, "rb") as f, mmap.mmap(
+                f.fileno(), 0, access=mmap.ACCESS_READ
+            ) as data:
+                magic, generation, next_userid = SNAPSHOT_HEADER.unpack_from(data)
+                if magic == SNAPSHOT_MAGIC:
+                    self.generation = generation
+                    self.next_userid = next_userid
+                    for _, event in decode_records(
+                        data, SNAPSHOT_HEADER.size, len(data)
+                    ):
+                        yield event
+
+        valid = 0
+        for generation in self.log_generations():
+            if generation < self.generation:
+                continue
+            self.generation = generation
+            valid = 0
+            path = self.log_path(generation)
+            if os.path.getsize(path) == 0:
+                continue
+            with open(path, "rb") as f, mmap.mmap(
+                f.fileno(), 0, access=mmap.ACCESS_READ
+            ) as data:
+                for valid, event in decode_records(data, 0, len(data)):
+                    yield event
+
+        # 途中で切れたレコードを捨てて、その後ろに追記する
+        self.file = open(self.log_path(self.generation), "ab")
+        self.file.truncate(valid)
+        self.size = valid
+
+    def start(self, dump):
+        # 書き込みスレッドを開始する（recover() の後に呼ぶ）
+        if self.file is None:
+            self.file = open(self.log_path(self.generation), "ab")
+            self.size = self.file.tell()
+        self.dump = dump
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def append(self, kind, userid, room_name, user_name="", token=b"", address=None):
+        # イベントを記録する。キューに入れるだけなので、呼び出し元のスレッドは待たない
+        self.queue.put((kind, userid, room_name, user_name, token, address))
+
+    def backlog(self) -> int:
+        return self.queue.qsize()
+
+    def run(self):
+        get = self.queue.get
+        get_nowait = self.queue.get_nowait
+        while True:
+            events = [get()]
+            try:
+                while len(events) < WRITE_BATCH:
+                    events.append(get_nowait())
+            except queue.Empty:
+                pass
+            chunk = b"".join(encode_event(*event) for event in events)
+            self.file.write(chunk)
+            self.file.flush()
+            self.size += len(chunk)
+            if self.size >= self.snapshot_bytes:
+                self.snapshot()
+
+    def snapshot(self):
+        # 新しい世代のログに切り替えてから、その時点の状態を書き出す
+        # 書き出している間に起きたイベントは新しい世代のログに入るので、起動時に再生すれば追いつく
+        # （同じイベントがスナップショットとログの両方に入っていても、再生の結果は変わらない）
+        self.file.close()
+        self.generation += 1
+        self.file = open(self.log_path(self.generation), "ab")
+        self.size = 0
+
+        next_userid, events = self.dump()
+        path = os.path.join(self.directory, SNAPSHOT_NAME)
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, self.generation, next_userid))
+            batch = []
+            for event in events:
+                batch.append(encode_event(*event))
+                if len(batch) >= WRITE_BATCH:
+                    f.write(b"".join(batch))
+                    batch = []
+            f.write(b"".join(batch))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+
+        for generation in self.log_generations():
+            if generation < self.generation:
+                os.remove(self.log_path(generation))
+
+
+def encode_event(kind, userid, room_name, user_name, token, address):
+    if (kind == KIND_CREATE or kind == KIND_JOIN) and token is None:
+        # 署名付きトークンの場合はサーバがトークンを持っていないので、0で埋めておく
+        token = bytes(TOKEN_SIZE)
+    return encode_record(
+        kind,
+        userid,
+        room_name.encode("utf-8"),
+        user_name.encode("utf-8"),
+        token,
+        pack_address(address) if address is not None else b"",
+    )
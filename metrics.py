@@ -0,0 +1,207 @@
+import bisect
+import http.server
+import json
+import threading
+import time
+
+# サーバの計測値（カウンタ・ヒストグラム・ゲージ）
+#
+# 値の更新はリレーのホットパスから呼ばれるので、ロックを取らずに属性を足すだけにしている。
+# 読み出し（スナップショット）は集計用のスレッドから行うため、多少ずれた値になることはある。
+
+# ヒストグラムの区切り（秒）。1マイクロ秒〜1秒を対数でおおよそ均等に分ける
+DEFAULT_BUCKETS = (
+    1e-6,
+    2.5e-6,
+    5e-6,
+    1e-5,
+    2.5e-5,
+    5e-5,
+    1e-4,
+    2.5e-4,
+    5e-4,
+    1e-3,
+    2.5e-3,
+    5e-3,
+    1e-2,
+    2.5e-2,
+    5e-2,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+)
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        self.bounds = bounds
+        # 最後の要素は最大の区切りを超えた値の数
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        # ゲージは読み出す時に関数を呼んで値を取る（ホットパスでは何もしない）
+        self.gauges = {}
+
+    def counter(self, name):
+        return self.counters.setdefault(name, Counter())
+
+    def histogram(self, name, bounds=DEFAULT_BUCKETS):
+        return self.histograms.setdefault(name, Histogram(bounds))
+
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    def snapshot(self):
+        return {
+            "counters": {name: c.value for name, c in self.counters.items()},
+            "histograms": {
+                name: {
+                    "bounds": list(h.bounds),
+                    "counts": list(h.counts),
+                    "sum": h.sum,
+                    "count": h.count,
+                }
+                for name, h in self.histograms.items()
+            },
+            "gauges": {name: function() for name, function in self.gauges.items()},
+        }
+
+
+def merge(snapshots):
+    # 複数プロセスのスナップショットを1つにまとめる（カウンタ・ヒストグラム・ゲージとも合計する）
+    merged = {"counters": {}, "histograms": {}, "gauges": {}}
+    for snapshot in snapshots:
+        for name, value in snapshot["counters"].items():
+            merged["counters"][name] = merged["counters"].get(name, 0) + value
+        for name, value in snapshot["gauges"].items():
+            if name.endswith("_max"):
+                merged["gauges"][name] = max(merged["gauges"].get(name, 0), value)
+            else:
+                merged["gauges"][name] = merged["gauges"].get(name, 0) + value
+        for name, histogram in snapshot["histograms"].items():
+            target = merged["histograms"].get(name)
+            if target is None:
+                merged["histograms"][name] = {
+                    "bounds": list(histogram["bounds"]),
+                    "counts": list(histogram["counts"]),
+                    "sum": histogram["sum"],
+                    "count": histogram["count"],
+                }
+                continue
+            target["counts"] = [a + b for a, b in zip(target["counts"], histogram["counts"])]
+            target["sum"] += histogram["sum"]
+            target["count"] += histogram["count"]
+    return merged
+
+
+def quantile(histogram, q):
+    # ヒストグラムから分位点のおおよその値（その区間の上限）を求める
+    if not histogram["count"]:
+        return None
+    rank = q * histogram["count"]
+    seen = 0
+    for bound, count in zip(histogram["bounds"], histogram["counts"]):
+        seen += count
+        if seen >= rank:
+            return bound
+    return float("inf")
+
+
+def to_prometheus(snapshot, prefix="chat_"):
+    lines = []
+    for name, value in sorted(snapshot["counters"].items()):
+        lines.append("# TYPE {}{}_total counter".format(prefix, name))
+        lines.append("{}{}_total {}".format(prefix, name, value))
+    for name, value in sorted(snapshot["gauges"].items()):
+        lines.append("# TYPE {}{} gauge".format(prefix, name))
+        lines.append("{}{} {}".format(prefix, name, value))
+    for name, histogram in sorted(snapshot["histograms"].items()):
+        metric = prefix + name
+        lines.append("# TYPE {} histogram".format(metric))
+        cumulative = 0
+        for bound, count in zip(histogram["bounds"], histogram["counts"]):
+            cumulative += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(metric, bound, cumulative))
+        lines.append('{}_bucket{{le="+Inf"}} {}'.format(metric, histogram["count"]))
+        lines.append("{}_sum {}".format(metric, histogram["sum"]))
+        lines.append("{}_count {}".format(metric, histogram["count"]))
+    return "\n".join(lines) + "\n"
+
+
+def summarize(snapshot):
+    # ログに出すための短い要約（ヒストグラムは p50 / p99 だけにする）
+    summary = dict(snapshot["counters"])
+    summary.update(snapshot["gauges"])
+    for name, histogram in snapshot["histograms"].items():
+        for label, q in (("p50", 0.5), ("p99", 0.99)):
+            value = quantile(histogram, q)
+            if value is not None:
+                summary["{}_{}".format(name, label)] = value
+    return summary
+
+
+def serve(collect, host="127.0.0.1", port=9100):
+    # ローカルのスクレイプ用エンドポイント
+    #   GET /metrics      Prometheus のテキスト形式
+    #   GET /metrics.json JSON
+    # collect() はその時点のスナップショットを返す関数
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body = to_prometheus(collect()).encode("utf-8")
+                content_type = "text/plain; version=0.0.4"
+            elif self.path == "/metrics.json":
+                body = json.dumps(collect()).encode("utf-8")
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    return httpd
+
+
+def report_periodically(collect, interval, log):
+    # interval 秒ごとにスナップショットの要約を log（関数）に渡す
+    def run():
+        while True:
+            time.sleep(interval)
+            log(json.dumps(summarize(collect()), sort_keys=True))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
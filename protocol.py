@@ -0,0 +1,209 @@
+import struct
+
+# UDPで送受信するバイナリフレーム（client.py と server.py の両方で使う）
+#
+# 先頭の1バイトは UTF-8 に現れない 0xF5 にしてあるので、従来のテキスト形式
+# 「ルーム名:トークン:ユーザー名:メッセージ」と区別できる
+#
+# クライアント → サーバ（KIND_CHAT / KIND_HISTORY / KIND_NACK）
+#   Magic（1） | Version（1） | Kind（1） | SessionID（4） | TokenSize（2） | Token | Message
+#   ・ハンドシェイク直後の最初のメッセージだけトークンを付けて、UDPアドレスをセッションに登録する
+#   ・それ以降は TokenSize を 0 にして、セッションIDと送信元アドレスで認証する
+#   ・KIND_HISTORY の場合、Message は最後に受け取ったメッセージの番号（4バイト）と、その番号の Epoch（4バイト）で、
+#     それより後の履歴を KIND_HISTORY でまとめて送り返してもらう（Epoch が違えば最初から）
+#   ・KIND_NACK の場合、Message は届かなかったメッセージの番号の範囲 { FirstSeq（4） | Count（2） } の列で、
+#     サーバに残っている分を KIND_HISTORY で送り直してもらう（1回で最大で履歴の容量分）。
+#     トークンは使わず、登録済みの送信元アドレスで認証する
+#
+# サーバ → クライアント（KIND_MESSAGES / KIND_HISTORY）
+#   Magic（1） | Version（1） | Kind（1） | Count（1） | Epoch（4） | FirstSeq（4） | { NameSize（1） | BodySize（2） | Name | Body } × Count
+#   ・メッセージにはルームごとの通し番号が付いていて、フレーム内のメッセージは FirstSeq から連番になる
+#   ・KIND_HISTORY は履歴の要求への応答。すでにリレーで受け取ったメッセージが入っていることがある
+#   ・番号はサーバが再起動すると1から振り直しになる。Epoch はサーバが起動するたびに変わる値で、
+#     Epoch が変わったら、クライアントはそれまでに受け取った番号を忘れる
+#
+# サーバ → クライアント（KIND_ERROR）
+#   Magic（1） | Version（1） | Kind（1） | Text
+#
+# サーバ → クライアント（KIND_THROTTLE）
+#   Magic（1） | Version（1） | Kind（1） | RetryAfter（2、ミリ秒）
+#   ・送信レートの制限を超えてメッセージが捨てられた（サーバが --throttle-replies の時だけ送る）
+
+FRAME_MAGIC = 0xF5
+FRAME_VERSION = 3
+
+KIND_CHAT = 1
+KIND_MESSAGES = 2
+KIND_ERROR = 3
+KIND_HISTORY = 4
+KIND_THROTTLE = 5
+KIND_NACK = 6
+
+# サーバとクライアントは一度に最大で 4096 バイトのメッセージを処理する
+MAX_DATAGRAM_SIZE = 4096
+
+CHAT_HEADER = struct.Struct("!BBBIH")
+MESSAGES_HEADER = struct.Struct("!BBBBII")
+ENTRY_HEADER = struct.Struct("!BH")
+ERROR_HEADER = struct.Struct("!BBB")
+SESSION_ID = struct.Struct("!I")
+HISTORY_REQUEST = struct.Struct("!II")
+THROTTLE = struct.Struct("!BBBH")
+NACK_RANGE = struct.Struct("!IH")
+
+# 1つのフレームに入れられるメッセージの数（Count は1バイト）
+MAX_ENTRIES = 255
+
+
+def pack_chat(session_id: int, token: bytes, message: bytes, kind=KIND_CHAT) -> bytes:
+    return (
+        CHAT_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, kind, session_id, len(token))
+        + token
+        + message
+    )
+
+
+def pack_history_request(
+    session_id: int, token: bytes, last_seen: int, epoch: int = 0
+) -> bytes:
+    body = HISTORY_REQUEST.pack(last_seen, epoch)
+    return pack_chat(session_id, token, body, KIND_HISTORY)
+
+
+def pack_nack(session_id: int, token: bytes, ranges) -> bytes:
+    # ranges は [(最初の番号, 個数), ...]
+    body = b"".join(NACK_RANGE.pack(first, count) for first, count in ranges)
+    return pack_chat(session_id, token, body, KIND_NACK)
+
+
+def unpack_nack(body):
+    # KIND_NACK のメッセージを [(最初の番号, 個数), ...] にする。形式が正しくなければ None
+    if len(body) % NACK_RANGE.size:
+        return None
+    return list(NACK_RANGE.iter_unpack(body))
+
+
+def parse_chat(view: memoryview, nbytes: int):
+    # 受信バッファの memoryview をコピーせずに分解し、(種類, セッションID, トークン, メッセージ) を返す
+    # トークンとメッセージは memoryview のまま返すので、必要な部分だけ呼び出し側で変換する
+    if nbytes < CHAT_HEADER.size:
+        return None
+    magic, version, kind, session_id, token_size = CHAT_HEADER.unpack_from(view)
+    if magic != FRAME_MAGIC or version != FRAME_VERSION:
+        return None
+    if kind != KIND_CHAT and kind != KIND_HISTORY and kind != KIND_NACK:
+        return None
+    token_end = CHAT_HEADER.size + token_size
+    if token_end > nbytes:
+        return None
+    return kind, session_id, view[CHAT_HEADER.size : token_end], view[token_end:nbytes]
+
+
+def relayed_size(name: bytes, body_size: int) -> int:
+    # 1件だけ入った KIND_MESSAGES フレームのバイト数
+    return MESSAGES_HEADER.size + ENTRY_HEADER.size + len(name) + body_size
+
+
+def pack_message(name: bytes, body, seq: int, epoch: int) -> bytes:
+    # 1件だけのメッセージフレーム。body には受信バッファの memoryview をそのまま渡せる
+    return b"".join(
+        (
+            MESSAGES_HEADER.pack(
+                FRAME_MAGIC, FRAME_VERSION, KIND_MESSAGES, 1, epoch, seq
+            ),
+            ENTRY_HEADER.pack(len(name), len(body)),
+            name,
+            body,
+        )
+    )
+
+
+def pack_batches(frames, kind=KIND_MESSAGES):
+    # 1件ずつの KIND_MESSAGES フレーム（番号が連続しているもの）を、
+    # MAX_DATAGRAM_SIZE に収まる分ずつ1つのフレームにまとめ直す
+    # 各メッセージの部分はフレームからそのまま切り出すので、デコードはしない
+    batch = []
+    size = MESSAGES_HEADER.size
+    epoch = first_seq = 0
+    for frame in frames:
+        entry = memoryview(frame)[MESSAGES_HEADER.size :]
+        if batch and (
+            size + len(entry) > MAX_DATAGRAM_SIZE or len(batch) == MAX_ENTRIES
+        ):
+            yield pack_entries(epoch, first_seq, batch, kind)
+            batch = []
+            size = MESSAGES_HEADER.size
+        if not batch:
+            epoch, first_seq = MESSAGES_HEADER.unpack_from(frame)[4:]
+        batch.append(entry)
+        size += len(entry)
+    if batch:
+        yield pack_entries(epoch, first_seq, batch, kind)
+
+
+def pack_entries(epoch: int, first_seq: int, entries, kind=KIND_MESSAGES) -> bytes:
+    header = MESSAGES_HEADER.pack(
+        FRAME_MAGIC, FRAME_VERSION, kind, len(entries), epoch, first_seq
+    )
+    return header + b"".join(entries)
+
+
+def pack_error(text: str) -> bytes:
+    return ERROR_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, KIND_ERROR) + text.encode(
+        "utf-8"
+    )
+
+
+def pack_throttle(retry_after: float) -> bytes:
+    milliseconds = min(int(retry_after * 1000) + 1, 0xFFFF)
+    return THROTTLE.pack(FRAME_MAGIC, FRAME_VERSION, KIND_THROTTLE, milliseconds)
+
+
+def parse_server_frame(data: bytes):
+    # サーバからのフレームを (kind, 内容) に分解する
+    #   KIND_MESSAGES / KIND_HISTORY → [(番号, ユーザー名, メッセージ), ...]
+    #   KIND_ERROR    → エラーメッセージの文字列
+    #   KIND_THROTTLE → 送信を再開してよいまでの秒数
+    # 形式が正しくない（途中で切れているなど）場合は None
+    # サーバはメッセージをデコードせずにリレーするので、UTF-8 として正しくない部分は置き換えて読む
+    # （1人が送った壊れたメッセージで、同じフレームに入っている他のメッセージまで失わないため）
+    if len(data) < ERROR_HEADER.size or data[0] != FRAME_MAGIC:
+        return None
+    magic, version, kind = ERROR_HEADER.unpack_from(data)
+    if version != FRAME_VERSION:
+        return None
+    if kind == KIND_ERROR:
+        return kind, data[ERROR_HEADER.size :].decode("utf-8", "replace")
+    if kind == KIND_THROTTLE:
+        if len(data) < THROTTLE.size:
+            return None
+        return kind, THROTTLE.unpack_from(data)[3] / 1000
+    if kind != KIND_MESSAGES and kind != KIND_HISTORY:
+        return None
+    if len(data) < MESSAGES_HEADER.size:
+        return None
+
+    _, _, _, count, _, seq = MESSAGES_HEADER.unpack_from(data)
+    offset = MESSAGES_HEADER.size
+    messages = []
+    size = len(data)
+    for seq in range(seq, seq + count):
+        if offset + ENTRY_HEADER.size > size:
+            return None
+        name_size, body_size = ENTRY_HEADER.unpack_from(data, offset)
+        offset += ENTRY_HEADER.size
+        if offset + name_size + body_size > size:
+            return None
+        name = data[offset : offset + name_size].decode("utf-8", "replace")
+        offset += name_size
+        body = data[offset : offset + body_size].decode("utf-8", "replace")
+        offset += body_size
+        messages.append((seq, name, body))
+    if offset != size:
+        return None
+    return kind, messages
+
+
+def frame_epoch(data: bytes) -> int:
+    # parse_server_frame() で KIND_MESSAGES / KIND_HISTORY だったフレームの Epoch
+    return MESSAGES_HEADER.unpack_from(data)[4]
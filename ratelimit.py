@@ -0,0 +1,100 @@
+# トークンバケットによる送信レートの制限
+#
+# バケットには最大 burst 個のトークンが入り、1秒に rate 個ずつ補充される。
+# パケット1つごとにトークンを1個使い、足りなければそのパケットは捨てる。
+# rate と burst は RateLimit にだけ持たせ、バケットは残りのトークンと時刻だけを持つので、
+# 実行中に RateLimit の値を変えると、すでにあるバケットにもそのまま効く。
+#
+# 制限の設定ファイル: 1行に「名前 値」（SIGHUP で読み直す）
+#   client_rate 20
+#   client_burst 40
+#   room_rate 200
+#   room_burst 400
+
+# 設定ファイルに書ける名前
+LIMIT_NAMES = ("client_rate", "client_burst", "room_rate", "room_burst")
+
+# 送信元ごとのバケットがこの数を超えたら、満タンに戻ったものを掃除する
+PURGE_SIZE = 4096
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated", "notified")
+
+    def __init__(self):
+        # 最初は満タン（burst は RateLimit 側が持っているので、最初の allow() で合わせる）
+        self.tokens = float("inf")
+        self.updated = 0.0
+        # 制限を超えたことを送信者に知らせたかどうか（制限中は1回だけ知らせる）
+        self.notified = False
+
+
+class RateLimit:
+    __slots__ = ("rate", "burst")
+
+    def __init__(self, rate: float = 0, burst: float = 0):
+        self.rate = rate  # 1秒あたりのパケット数。0 の場合は制限しない
+        self.burst = burst
+
+    def set(self, rate: float, burst: float):
+        # burst を指定しない場合は1秒分
+        self.rate = rate
+        self.burst = max(burst or rate, 1)
+
+    def allow(self, bucket: TokenBucket, now: float) -> bool:
+        # now は time.perf_counter() の値
+        tokens = bucket.tokens + (now - bucket.updated) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        bucket.updated = now
+        if tokens >= 1:
+            bucket.tokens = tokens - 1
+            bucket.notified = False
+            return True
+        bucket.tokens = tokens
+        return False
+
+    def retry_after(self, bucket: TokenBucket) -> float:
+        # 次のトークンが補充されるまでの秒数
+        return (1 - bucket.tokens) / self.rate if self.rate else 0.0
+
+
+class RateLimiter:
+    # キー（送信元アドレスなど）ごとにバケットを持つ
+    def __init__(self, rate: float = 0, burst: float = 0):
+        self.limit = RateLimit()
+        self.limit.set(rate, burst)
+        self.buckets = {}
+        self.purge_size = PURGE_SIZE
+
+    def allow(self, key, now: float) -> bool:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket()
+        return self.limit.allow(bucket, now)
+
+    def purge(self, now: float):
+        # 満タンに戻ったバケットは、新しく作り直しても同じなので消す
+        if len(self.buckets) <= self.purge_size:
+            return
+        rate = self.limit.rate
+        burst = self.limit.burst
+        for key, bucket in list(self.buckets.items()):
+            if bucket.tokens + (now - bucket.updated) * rate >= burst:
+                del self.buckets[key]
+        self.purge_size = max(PURGE_SIZE, len(self.buckets) * 2)
+
+
+def load_limits(path: str):
+    # 設定ファイルを読み、{名前: 値} を返す
+    limits = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            name, value = line.split()
+            if name not in LIMIT_NAMES:
+                raise ValueError("unknown rate limit {} in {}".format(name, path))
+            limits[name] = float(value)
+    return limits
@@ -1,24 +1,90 @@
+import asyncio
+import argparse
+import base64
+import binascii
+import bisect
+import collections
+import heapq
+import hmac
+import logging
 import socket
 import time
 import threading
+import multiprocessing
+import os
+import pickle
 import secrets
+import selectors
+import signal
+import struct
+import zlib
+
+import control
+import federation
+import journal
+import metrics as metrics_module
+import protocol
+import ratelimit
+import tokens
+
+
+# トークンの生成に使うランダムなバイト数
+# サーバ内では生のバイト列（32バイト）のまま持ち、クライアントには base64 の文字列（43文字）で渡す
+TOKEN_LENGTH = 32
+# 受け付けるトークンの最小・最大バイト数（署名付きトークンはルーム名を含むので長さが変わり、
+# ルーム名が空なら TOKEN_LENGTH より短い）
+MIN_TOKEN_LENGTH = min(TOKEN_LENGTH, tokens.MIN_TOKEN_SIZE)
+MAX_TOKEN_LENGTH = 64
 
 
 def generate_token(length):
     # 安全なランダムトークンを生成
-    return secrets.token_urlsafe(length)
+    return secrets.token_bytes(length)
+
+
+# URL-safe な base64 を標準の base64 に戻すための変換表
+URLSAFE_TO_STANDARD = bytes.maketrans(b"-_", b"+/")
+
+
+def encode_token(token: bytes) -> str:
+    return base64.urlsafe_b64encode(token).rstrip(b"=").decode("ascii")
+
+
+def decode_token(text):
+    # クライアントから届いたトークン（str または bytes）を生のバイト列に戻す。形式が違えば None
+    if isinstance(text, str):
+        text = text.encode("ascii", "replace")
+    try:
+        token = binascii.a2b_base64(
+            bytes(text).translate(URLSAFE_TO_STANDARD) + b"=" * (-len(text) % 4)
+        )
+    except (binascii.Error, ValueError):
+        return None
+    if not MIN_TOKEN_LENGTH <= len(token) <= MAX_TOKEN_LENGTH:
+        return None
+    return token
 
 
 class Chatclient:
+    # ユーザー数が多い時のメモリを抑えるため、インスタンスごとの __dict__ を持たせない
+    __slots__ = ("userid", "token", "user_name", "address", "last_activity", "room")
+
     def __init__(
-        self, userid: int, token: str, address=None, last_activity: float = None
+        self,
+        userid: int,
+        token: bytes,
+        user_name: str = "",
+        address=None,
+        last_activity: float = None,
     ):
         self.userid = userid
         self.token = token
+        self.user_name = user_name
         self.address = address
         self.last_activity = (
             last_activity if last_activity is not None else time.time()
         )  # ユーザーが最後にメンションした時刻
+        self.room = None  # 参加しているChatroom（索引に (ルーム, クライアント) のタプルを持たなくて済むように）
 
     def update_last_activity(self):
         self.last_activity = time.time()
@@ -27,257 +93,1984 @@ class Chatclient:
         self.address = address
 
 
+class MessageHistory:
+    # ルームの最近のメッセージのリングバッファと、メッセージの通し番号
+    # リレーしたフレームをエンコード済みのまま入れるので、記録のためのエンコードやコピーはしない
+    # スロットはルームを作る時に容量分だけ確保しておき、古いものから上書きする
+    __slots__ = ("frames", "next_seq")
+
+    def __init__(self, capacity: int):
+        self.frames = [None] * capacity
+        self.next_seq = 1
+
+    def append(self, frame: bytes):
+        frames = self.frames
+        if frames:
+            frames[self.next_seq % len(frames)] = frame
+        self.next_seq += 1
+
+    def since(self, last_seen: int, unsent: int = 0):
+        # last_seen より後で、まだ残っているフレームを古い順に返す
+        # 末尾の unsent 件はまだリレーしていない（まとめ送りでためている）ので除く
+        if last_seen >= self.next_seq:
+            # 作り直される前の同じ名前のルームの番号なので、最初から送る
+            last_seen = 0
+        capacity = len(self.frames)
+        first = max(last_seen + 1, self.next_seq - capacity)
+        end = self.next_seq - unsent
+        return [self.frames[seq % capacity] for seq in range(first, end)]
+
+    def select(self, ranges):
+        # NACK の範囲 [(最初の番号, 個数), ...] のうち、まだ残っているフレームを、番号が連続している
+        # ひとまとまりごとのリストにして古い順に返す（再送用。KIND_MESSAGES には連続した番号しか入らない）
+        # 範囲は履歴に残っている番号に切り詰めてからつなげるので、重なっていても返すのは合計で最大で容量分
+        capacity = len(self.frames)
+        low = max(self.next_seq - capacity, 1)
+        high = self.next_seq
+        clamped = sorted(
+            (max(first, low), min(first + count, high))
+            for first, count in ranges
+            if first < high and first + count > low
+        )
+        runs = []
+        end = low
+        for first, last in clamped:
+            first = max(first, end)
+            if first >= last:
+                continue
+            frames = [self.frames[seq % capacity] for seq in range(first, last)]
+            if first == end and runs:
+                # 前の範囲とつながっている
+                runs[-1].extend(frames)
+            else:
+                runs.append(frames)
+            end = last
+        return runs
+
+
 class Chatroom:
-    def __init__(self, room_name: str, owner_token: str, owner_info: Chatclient):
+    # メンバーの一覧（active_clients）とリレー先アドレスの一覧（addresses）はコピーオンライトにする。
+    # 書き込み（参加・退出・タイムアウト・アドレス登録）は Registry.lock を取ってから新しい dict / タプルを作って
+    # 属性ごと差し替え、一度公開したものは変更しない。リレーやタイムアウトのチェックはロックを取らずに
+    # その時点の一覧を読めば、途中で変わることも、登録が途中のクライアントが見えることもない。
+    # （属性の差し替えは1回の参照の書き込みなので、GIL のないビルドでも読み手は古いか新しいかのどちらかを見る）
+    __slots__ = (
+        "room_name",
+        "active_clients",
+        "user_ids",
+        "addresses",
+        "history",
+        "bucket",
+        "pending",
+        "pending_size",
+    )
+
+    def __init__(
+        self,
+        room_name: str,
+        owner_token: bytes,
+        owner_info: Chatclient,
+        history_size: int = 0,
+    ):
         self.room_name = room_name
         active_clients = {}  # Chatclientのデータが入っていく
         # まず、作成者を入れておく owner_infoはChatclientである
         active_clients[owner_info.userid] = owner_info
+        owner_info.room = self
+        self.active_clients = active_clients
+        # ユーザー名 → ユーザーID（同じ名前で参加し直した時に同じクライアントを返すため）
+        # 参加の処理の中でだけ使うので、Registry.lock を取ってそのまま変更する
+        self.user_ids = {owner_info.user_name: owner_info.userid}
+        # リレー先アドレスの一覧。メッセージごとに作り直さず、参加・退出・タイムアウト・アドレス登録の時だけ更新する
+        self.addresses = ()
+        self.rebuild_addresses()
+        # 参加した時や再接続した時に送り直すための履歴
+        self.history = MessageHistory(history_size)
+        # ルーム全体の送信レートの制限（room_limit）に使うバケット
+        self.bucket = ratelimit.TokenBucket()
+        # まとめ送り（RelayCoalescer）を待っているフレームと、まとめた時のバイト数
+        self.pending = None
+        self.pending_size = 0
+
+    def rebuild_addresses(self):
+        # アドレスがまだ登録されていない（一度もメッセージを送っていない）クライアントには送らない
+        self.addresses = tuple(
+            [
+                client.address
+                for client in self.active_clients.values()
+                if client.address is not None
+            ]
+        )
+
+    def set_client_address(self, userid, address):
+        # Registry.lock を取ってから呼ぶ
+        client = self.active_clients[userid]
+        if client.address != address:
+            client.set_address(address)
+            self.rebuild_addresses()
+
+    def add_client(self, client: Chatclient):
+        # アドレスは最初のメッセージで登録されるので、リレー先一覧はここでは変わらない
+        # 一覧に見えた時には client.room が設定済みになっているよう、先に設定してから公開する
+        client.room = self
+        active_clients = dict(self.active_clients)
+        active_clients[client.userid] = client
         self.active_clients = active_clients
+        self.user_ids[client.user_name] = client.userid
 
     def del_userlist(self, userid):
-        self.active_clients.pop(userid, None)
-
-    def update_active_clients(self, userid):
-        # アクティブなクライアントのマップに既に存在するか確認
-        if userid not in self.active_clients:
-            # トークン生成
-            secret_num = secrets.token_urlsafe(255 - userid)
-            token = str(userid) + secret_num
-            # なかったら新たにクライアントのデータを作って入れる
-            self.active_clients[userid] = Chatclient(userid, token)
+        removed = self.active_clients.get(userid)
+        if removed is None:
+            return None
+        active_clients = dict(self.active_clients)
+        del active_clients[userid]
+        self.active_clients = active_clients
+        if self.user_ids.get(removed.user_name) == userid:
+            del self.user_ids[removed.user_name]
+        if removed.address is not None:
+            self.rebuild_addresses()
+        return removed
+
+    def del_clients(self, clients):
+        # まとめて削除する（タイムアウト）。一覧のコピーとリレー先の作り直しは1回だけにする
+        # 実際に削除したクライアントのリストを返す
+        active_clients = dict(self.active_clients)
+        removed = []
+        rebuild = False
+        for client in clients:
+            if active_clients.get(client.userid) is not client:
+                continue
+            del active_clients[client.userid]
+            if self.user_ids.get(client.user_name) == client.userid:
+                del self.user_ids[client.user_name]
+            rebuild = rebuild or client.address is not None
+            removed.append(client)
+        self.active_clients = active_clients
+        if rebuild:
+            self.rebuild_addresses()
+        return removed
+
+    def find_client(self, user_name: str):
+        userid = self.user_ids.get(user_name)
+        if userid is None:
+            return None
+        return self.active_clients[userid]
+
+
+class Registry:
+    # 全チャットルームと全クライアントの索引
+    #   rooms:     ルーム名 → Chatroom
+    #   tokens:    トークン → Chatclient（署名付きトークンの場合はユーザーID → Chatclient）
+    #   addresses: UDPアドレス → Chatclient
+    # クライアントが参加しているルームは Chatclient.room から分かる
+    # 参加・退出・タイムアウトは必ずこのクラスを通して、3つの索引を常に一致させる
+    #
+    # ハンドシェイクのスレッドとUDPのスレッド（マルチプロセスモードでは振り分けのスレッド）の両方から使う。
+    # 書き込みは self.lock で1つずつ行い、読み込み（認証・リレー）はロックを取らない。
+    # 3つの索引の dict は1回の get() でだけ読み、全体をたどる時は list() でコピーしてからたどる。
+    # ルームのメンバーの一覧はコピーオンライト（Chatroom を参照）
+    def __init__(self):
+        self.rooms = {}
+        self.tokens = {}
+        self.addresses = {}
+        # ルーム名のソート済みの一覧（前方一致での一覧表示に使う。ルームは削除しないので追加だけ）
+        self.room_names = []
+        self.next_userid = 1
+        # マルチプロセスモードでのワーカー数。ユーザーIDを「ID % shard_count == ルームのシャード」になるよう割り当てる
+        self.shard_count = 1
+        # ルームごとに残しておくメッセージの数（リレーを行うプロセスでだけ使う）
+        self.history_size = 0
+        # 参加・退出・アドレス登録を記録するジャーナル（append() を持つもの。使わない場合は None）
+        self.journal = None
+        # 署名付きトークンを使う場合の tokens.TokenSigner
+        # その場合クライアントごとのトークンは持たず、認証は署名の確認とユーザーIDの索引で行う
+        self.signer = None
+        # 書き込み（ルームの作成・参加・退出・アドレス登録）を1つずつ行うためのロック
+        self.lock = threading.Lock()
+
+    def index_client(self, client: Chatclient):
+        if self.signer is None:
+            self.tokens[client.token] = client
         else:
-            # あったら最終メンション時刻を更新
-            self.active_clients[userid].update_last_activity()
+            self.tokens[client.userid] = client
 
+    def unindex_client(self, client: Chatclient):
+        if self.signer is None:
+            self.tokens.pop(client.token, None)
+        else:
+            self.tokens.pop(client.userid, None)
+            # 署名付きトークンは期限まで使えてしまうので、発行済みのものを無効にしておく
+            self.signer.revoke(client.userid)
 
-# チャットルームのマップ
-chatrooms: {int: Chatroom} = {}
+    def issue_token(self, client: Chatclient) -> bytes:
+        # クライアントに渡すトークン（生のバイト列）
+        if self.signer is None:
+            return client.token
+        return self.signer.issue(client.userid, client.room.room_name)
 
+    def new_client(self, user_name: str, room_name: str):
+        # ユーザーIDはセッションIDとしても使うので、IDだけでルームを担当するワーカーが分かるようにしておく
+        userid = self.next_userid * self.shard_count + shard_of_room(
+            room_name, self.shard_count
+        )
+        self.next_userid += 1
+        token = generate_token(TOKEN_LENGTH) if self.signer is None else None
+        return Chatclient(userid, token, user_name)
 
-def enter_chatroom():
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_address = "0.0.0.0"
-    server_port = 9002
-    # 次に、サーバは bind()関数を使用して、ソケットをサーバのアドレスとポートに紐付けします。その後、listen()関数を呼び出すことで、サーバは着信接続の待ち受けを開始します。サーバは一度に最大1つの接続を受け入れることができます。
-    sock.bind((server_address, server_port))
+    def create_room(self, room_name: str, user_name: str):
+        # 同じ名前のルームがすでにある場合は作成しない（既存メンバーのトークンが宙に浮くため）
+        with self.lock:
+            if room_name in self.rooms:
+                return None
+            owner_info = self.new_client(user_name, room_name)
+            room = Chatroom(room_name, owner_info.token, owner_info, self.history_size)
+            self.rooms[room_name] = room
+            bisect.insort(self.room_names, room_name)
+            self.index_client(owner_info)
+            if self.journal is not None:
+                self.journal.append(
+                    journal.KIND_CREATE,
+                    owner_info.userid,
+                    room_name,
+                    user_name,
+                    owner_info.token,
+                )
+        return room, owner_info
+
+    def join_room(self, room_name: str, user_name: str):
+        # 戻り値は (ルーム, クライアント, 新規かどうか)。ルームがなければ None
+        with self.lock:
+            room = self.rooms.get(room_name)
+            if room is None:
+                return None
+            client = room.find_client(user_name)
+            if client is not None:
+                # 同じ名前ですでに参加している場合は最終メンション時刻を更新して同じトークンを返す
+                client.update_last_activity()
+                return room, client, False
+            client = self.new_client(user_name, room_name)
+            room.add_client(client)
+            self.index_client(client)
+            if self.journal is not None:
+                self.journal.append(
+                    journal.KIND_JOIN, client.userid, room_name, user_name, client.token
+                )
+        return room, client, True
 
-    sock.listen(1)
+    def insert_client(self, room_name: str, client: Chatclient):
+        # 他のプロセスで作られたクライアントを、IDとトークンはそのままで登録する
+        # ルームがなければ、そのクライアントを作成者としてルームを作る
+        with self.lock:
+            room = self.rooms.get(room_name)
+            if room is None:
+                room = Chatroom(room_name, client.token, client, self.history_size)
+                self.rooms[room_name] = room
+                bisect.insort(self.room_names, room_name)
+            else:
+                room.add_client(client)
+            self.index_client(client)
+        return room
 
-    print("starting up on port {}".format(server_port))
+    def rooms_with_prefix(self, prefix: str, limit: int):
+        # 名前が prefix で始まるルームを名前順に最大 limit 個返す（ソート済みの一覧を二分探索する）
+        # 一覧の挿入と重ならないよう、ここはロックを取って読む
+        with self.lock:
+            names = self.room_names
+            start = bisect.bisect_left(names, prefix)
+            found = []
+            for room_name in names[start : start + limit]:
+                if not room_name.startswith(prefix):
+                    break
+                found.append(room_name)
+        return [self.rooms[room_name] for room_name in found]
 
-    while True:
-        # その後、サーバは無限ループに入り、クライアントからの着信接続を継続的に受け付けます。このコードでは、accept()関数を使用して、着信接続を受け入れ、クライアントのアドレスを取得します。
-        connection, client_address = sock.accept()
-        try:
-            print("connection from", client_address)
-            reaction = 0
-            # サーバの初期化（0）: クライアントが新しいチャットルームを作成するリクエストを送信します。ペイロードには希望するユーザー名が含まれます。
-            connection.sendall(reaction.to_bytes(1, "big"))
-
-            # 次に、クライアントから受信したデータのヘッダを読み取り、変数headerに格納します。
-            # ヘッダー（32 バイト）: RoomNameSize（1 バイト） | Operation（1 バイト） | State（1 バイト） | OperationPayloadSize（29 バイト）
-            # 重要：ユーザー名はペイロードの中！
-
-            header = connection.recv(32)
-
-            # 長さはヘッダから抽出され、別々の変数に格納されます。
-            roomname_size = int.from_bytes(header[:1], "big")
-            operation = int.from_bytes(header[1:2], "big")
-            state = int.from_bytes(header[2:3], "big")
-            operation_payload_size = int.from_bytes(header[3:32], "big")
-            print("roomname_size", roomname_size)
-            print("operation", operation)
-            print("state", state)
-            print("operation_payload_size", operation_payload_size)
-
-            # ルーム名の最大バイト数は 28 バイトであり、OperationPayloadSize の最大バイト数は 229 バイトです。
-            if roomname_size > 28 or operation_payload_size > 229:
-                raise Exception(
-                    "roomname_size should be under 28 bytes and operation_payload_size should be under 229 bytes"
+    def find_client(self, room_name: str, userid: int):
+        room = self.rooms.get(room_name)
+        if room is None:
+            return None
+        client = room.active_clients.get(userid)
+        if client is None:
+            return None
+        return room, client
+
+    def remove_client(self, room: Chatroom, client: Chatclient, expired=False):
+        with self.lock:
+            if room.active_clients.get(client.userid) is not client:
+                return
+            room.del_userlist(client.userid)
+            self.unindex_client(client)
+            self.unbind_address(client)
+            if self.journal is not None:
+                kind = journal.KIND_EXPIRE if expired else journal.KIND_LEAVE
+                self.journal.append(kind, client.userid, room.room_name)
+
+    def remove_clients(self, room: Chatroom, clients, expired=False):
+        # 同じルームの複数のクライアントをまとめて削除し、実際に削除したもののリストを返す
+        with self.lock:
+            removed = room.del_clients(clients)
+            for client in removed:
+                self.unindex_client(client)
+                self.unbind_address(client)
+                if self.journal is not None:
+                    kind = journal.KIND_EXPIRE if expired else journal.KIND_LEAVE
+                    self.journal.append(kind, client.userid, room.room_name)
+        return removed
+
+    def unbind_address(self, client: Chatclient):
+        # self.lock を取ってから呼ぶ
+        if client.address is None:
+            return
+        if self.addresses.get(client.address) is client:
+            del self.addresses[client.address]
+
+    def bind_address(self, room: Chatroom, client: Chatclient, address):
+        if client.address == address:
+            return
+        with self.lock:
+            if room.active_clients.get(client.userid) is not client:
+                # 認証した後、ロックを取るまでの間に退出・タイムアウトした
+                return
+            self.unbind_address(client)
+            self.addresses[address] = client
+            room.set_client_address(client.userid, address)
+            if self.journal is not None:
+                self.journal.append(
+                    journal.KIND_BIND, client.userid, room.room_name, address=address
                 )
 
-            # ボディ: 最初の RoomNameSize バイトがルーム名で、その後にユーザー名、 OperationPayloadSize バイトが続きます。
-            # 次に、クライアントからチャットルーム名とユーザー名とoperation_payloadを読み取り、変数に格納します。
-            body = connection.recv(roomname_size + operation_payload_size)
-            # RoomNamesとユーザー名 は UTF-8 でエンコード/デコードされます。
-            room_name = body[:roomname_size].decode("utf-8")
+    def authenticate(self, token: bytes, room_name: str = None):
+        # トークンの索引を1回引くだけで認証し、(ルーム, クライアント) を返す。見つからなければ None
+        # テキスト形式ではルーム名も送られてくるので、一致するかも確認する
+        if self.signer is not None:
+            return self.authenticate_signed(token, room_name)
+        client = self.tokens.get(token)
+        if client is None:
+            return None
+        # 念のためトークン自体も定数時間で比較しておく
+        if not hmac.compare_digest(client.token, token):
+            return None
+        if room_name is not None and client.room.room_name != room_name:
+            return None
+        return client.room, client
 
-            # OperationPayload は、操作と状態に応じて異なる方法でデコードされる可能性があります（整数、文字列、JSON ファイルなど）
-            operation_payload = body[
-                roomname_size : roomname_size + operation_payload_size
-            ]
-            # ペイロードの中にユーザー名が入っている
-            user_name = operation_payload.decode("utf-8")
+    def authenticate_signed(self, token: bytes, room_name: str = None):
+        # 署名を確認してから、トークンに入っているユーザーIDで索引を引く
+        claims = self.signer.verify(token)
+        if claims is None:
+            return None
+        userid, token_room = claims
+        client = self.tokens.get(userid)
+        if client is None or client.room.room_name != token_room:
+            return None
+        if room_name is not None and token_room != room_name:
+            return None
+        return client.room, client
+
+    def authenticate_session(self, session_id: int, address):
+        # トークンを付けないバイナリフレームは、登録済みの送信元アドレスとセッションIDで認証する
+        # セッションIDにはユーザーIDを使っている
+        client = self.addresses.get(address)
+        if client is None or client.userid != session_id:
+            return None
+        return client.room, client
+
+    def dump(self):
+        # ジャーナルのスナップショット用に、今の状態を (次のユーザーID, イベントの列) で返す
+        # 書き込みスレッドから呼ばれるので、ルームの一覧はコピーしてからたどる
+        # （メンバーの一覧は変更されないスナップショットなので、そのままたどれる）
+        def events():
+            for room in list(self.rooms.values()):
+                for client in room.active_clients.values():
+                    yield (
+                        journal.KIND_JOIN,
+                        client.userid,
+                        room.room_name,
+                        client.user_name,
+                        client.token,
+                        None,
+                    )
+                    if client.address is not None:
+                        yield (
+                            journal.KIND_BIND,
+                            client.userid,
+                            room.room_name,
+                            "",
+                            b"",
+                            client.address,
+                        )
+
+        return self.next_userid, events()
+
+    def restore(self, events):
+        # ジャーナルのイベントを再生して索引を組み立て直す（self.journal が None の状態で呼ぶ）
+        # 同じイベントを2回再生しても結果は変わらない
+        for kind, userid, room_name, user_name, token, address in events:
+            if kind == journal.KIND_CREATE or kind == journal.KIND_JOIN:
+                if self.find_client(room_name, userid) is not None:
+                    continue
+                if self.signer is not None:
+                    token = None
+                self.insert_client(room_name, Chatclient(userid, token, user_name))
+                self.next_userid = max(
+                    self.next_userid, userid // self.shard_count + 1
+                )
+                continue
+            found = self.find_client(room_name, userid)
+            if found is None:
+                continue
+            if kind == journal.KIND_BIND:
+                self.bind_address(*found, address)
+            else:
+                self.remove_client(*found)
+
+
+def shard_of_room(room_name: str, shard_count: int) -> int:
+    # ルーム名から担当するワーカーを決める（プロセスをまたいでも同じ値になるよう crc32 を使う）
+    if shard_count == 1:
+        return 0
+    return zlib.crc32(room_name.encode("utf-8")) % shard_count
+
+
+def relay_message(sock, payload: bytes, addresses):
+    # エンコード済みのペイロードを、事前に作ってあるアドレス一覧へまとめて送る
+    # ループ内で属性参照やエンコードをしないよう、sendtoはローカル変数に取り出しておく
+    sendto = sock.sendto
+    failed = 0
+    for address in addresses:
+        try:
+            sendto(payload, address)
+        except OSError:
+            failed += 1
+    return failed
+
+
+class ExpiryScheduler:
+    # 無操作のクライアントを期限順に取り出すための遅延削除つき最小ヒープ
+    # (期限, ユーザーID, クライアント) を入れておき、取り出した時点で本当に期限切れかを確認する
+    # メッセージのたびにヒープを更新しないので、last_activityの更新はO(1)のまま
+    # ユーザーIDは重複しないので、期限が同じ時の順序付けにそのまま使える
+    def __init__(self, timeout_period: float):
+        self.timeout_period = timeout_period
+        self.heap = []
+        self.lock = threading.Lock()  # ハンドシェイクのスレッドとUDPのスレッドの両方から触るため
+
+    def schedule(self, room: Chatroom, client: Chatclient):
+        with self.lock:
+            heapq.heappush(
+                self.heap,
+                (client.last_activity + self.timeout_period, client.userid, client),
+            )
+
+    def expire(self, now: float):
+        # 期限切れになったクライアントの (ルーム, クライアント) のリストを返す
+        # ルームや索引からの削除は呼び出し側で Registry.remove_client を使って行う
+        expired = []
+        with self.lock:
+            heap = self.heap
+            while heap and heap[0][0] <= now:
+                _, _, client = heapq.heappop(heap)
+                room = client.room
+                if room.active_clients.get(client.userid) is not client:
+                    # すでに退出済み、または同じIDで参加し直している
+                    continue
+                deadline = client.last_activity + self.timeout_period
+                if deadline > now:
+                    # その後にメッセージを送っているので、新しい期限で入れ直す
+                    heapq.heappush(heap, (deadline, client.userid, client))
+                    continue
+                expired.append((room, client))
+        return expired
+
+
+class RelayCoalescer:
+    # 同じ受信者へのメッセージを window 秒の間ためて、1つのデータグラムにまとめて送る（--coalesce-ms）
+    # クライアントは1つのルームにしか参加しないので、受信者ごとにまとめるのはルームごとにまとめるのと同じになる。
+    # ルームにためた1件ずつのフレームは、送る時に KIND_MESSAGES 1つ（番号が連続している）に詰め直し、
+    # メンバー全員に同じバイト列を送る。MAX_DATAGRAM_SIZE に入らなくなったら期限を待たずに送る。
+    # テキスト形式には複数のメッセージを入れる形式がないので、バイナリフレームの時だけ使う
+    def __init__(self, window: float):
+        self.window = window
+        # (送る時刻, ルーム) を時刻順に入れておく（window が一定なので後から入れたものほど遅い）
+        self.due = collections.deque()
+
+    def add(self, sock, room: Chatroom, payload: bytes):
+        entry_size = len(payload) - protocol.MESSAGES_HEADER.size
+        pending = room.pending
+        if pending is not None and (
+            room.pending_size + entry_size > protocol.MAX_DATAGRAM_SIZE
+            or len(pending) == protocol.MAX_ENTRIES
+        ):
+            self.flush(sock, room)
+            pending = None
+        if pending is None:
+            room.pending = [payload]
+            room.pending_size = len(payload)
+            self.due.append((time.perf_counter() + self.window, room))
+        else:
+            pending.append(payload)
+            room.pending_size += entry_size
+
+    def flush(self, sock, room: Chatroom):
+        frames = room.pending
+        if frames is None:
+            return
+        room.pending = None
+        for frame in protocol.pack_batches(frames):
+            coalesced_batches.inc()
+            send_to_room(sock, frame, room)
+
+    def flush_due(self, sock, now: float):
+        # 期限が来たルームを送る。期限より前に送ってあったルームは、その後にたまった分を送る
+        due = self.due
+        while due and due[0][0] <= now:
+            self.flush(sock, due.popleft()[1])
+
+
+# チャットルームとクライアントの索引
+registry = Registry()
+
+# タイムアウト期間（秒）
+DEFAULT_CLIENT_TIMEOUT = 60 * 5  # とりあえずタイムアウト５分に設定
+# 期限切れのチェックを行う間隔（秒）。メッセージがなくてもこの間隔でチェックする
+EXPIRY_INTERVAL = 1.0
+
+expiry_scheduler = ExpiryScheduler(DEFAULT_CLIENT_TIMEOUT)
+
+# ログ。メッセージごとの print() はやめて、レベル付きのロガーを使う
+logger = logging.getLogger("chat_server")
+# デバッグログを出すかどうか。ホットパスでは logger.debug() を呼ぶ前にこのフラグだけを見る
+log_debug = False
+
+# メッセージの番号の Epoch。起動するたびに変え、再起動で番号が振り直されたことをクライアントに知らせる
+# （ワーカーは fork した時にこの値を引き継ぐ）
+server_epoch = secrets.randbits(32)
+
+# 計測値
+metrics = metrics_module.Metrics()
+datagrams_in = metrics.counter("datagrams_in")
+datagrams_out = metrics.counter("datagrams_out")
+malformed_datagrams = metrics.counter("malformed_datagrams")
+auth_failures = metrics.counter("auth_failures")
+send_errors = metrics.counter("send_errors")
+expiries = metrics.counter("expiries")
+handshakes = metrics.counter("handshakes")
+handshake_errors = metrics.counter("handshake_errors")
+control_sessions = metrics.counter("control_sessions")
+control_requests = metrics.counter("control_requests")
+forward_drops = metrics.counter("forward_drops")
+history_requests = metrics.counter("history_requests")
+history_batches = metrics.counter("history_batches")
+nack_requests = metrics.counter("nack_requests")
+retransmitted = metrics.counter("retransmitted")
+coalesced_batches = metrics.counter("coalesced_batches")
+rate_limited_clients = metrics.counter("rate_limited_clients")
+rate_limited_rooms = metrics.counter("rate_limited_rooms")
+throttle_replies = metrics.counter("throttle_replies")
+federation_in = metrics.counter("federation_in")
+federation_out = metrics.counter("federation_out")
+parse_seconds = metrics.histogram("parse_seconds")
+auth_seconds = metrics.histogram("auth_seconds")
+fanout_seconds = metrics.histogram("fanout_seconds")
+
+
+# 送信レートの制限（0 の場合は制限しない）
+# 送信元アドレスごとの制限は、デコードや認証より前（ワーカーモードではワーカーに転送する前）にかける。
+# ルームごとの制限は、認証した後、エンコードとリレー（ファンアウト）の前にかける。
+client_limiter = ratelimit.RateLimiter()
+room_limit = ratelimit.RateLimit()
+# フェデレーションの時だけ使う federation.Federation
+federation_node = None
+
+# まとめ送りをする時だけ使う RelayCoalescer
+coalescer = None
+
+# 制限を超えた時に、送信者に KIND_THROTTLE（テキスト形式では "Rate limited"）を返すかどうか
+send_throttle_replies = False
+
+
+def room_sizes():
+    # 集計用のスレッドから呼ばれるので、先に一覧をコピーしてから数える
+    return [len(room.active_clients) for room in list(registry.rooms.values())]
+
+
+metrics.gauge("rooms", lambda: len(registry.rooms))
+metrics.gauge("members", lambda: sum(room_sizes()))
+metrics.gauge("members_per_room_max", lambda: max(room_sizes(), default=0))
+
+
+# ハンドシェイク（TCP）の設定
+HEADER_SIZE = 32
+MAX_ROOMNAME_SIZE = 28
+MAX_OPERATION_PAYLOAD_SIZE = 229
+DEFAULT_BACKLOG = 1024  # listen()のバックログ。ログインが集中しても接続拒否にならないよう大きめにする
+DEFAULT_READ_TIMEOUT = 10.0  # 1接続あたりの読み込みタイムアウト（秒）
+DEFAULT_HISTORY_SIZE = 100  # ルームごとに残しておくメッセージの数
+# ハンドシェイクの Operation。接続を閉じずに制御用の接続（control.py）として使う
+OPERATION_CONTROL = 3
+DEFAULT_CONTROL_IDLE_TIMEOUT = 300.0  # 制御用の接続でリクエストが来ないまま待つ時間（秒）
+# 制御用の接続で1回に読むバイト数（パイプラインで届いたリクエストをまとめて処理する）
+CONTROL_READ_SIZE = 65536
+
+
+def register_client(room: Chatroom, client: Chatclient):
+    # 新しいクライアントをリレー側に知らせる
+    # マルチプロセスモードではルームを担当するワーカーに送り、タイムアウトの管理もワーカーが行う
+    if shard_router is not None:
+        shard_router.register(room, client)
+    else:
+        expiry_scheduler.schedule(room, client)
+
+
+def parse_header(header: bytes):
+    # ヘッダー（32 バイト）: RoomNameSize（1 バイト） | Operation（1 バイト） | State（1 バイト） | OperationPayloadSize（29 バイト）
+    roomname_size = header[0]
+    operation = header[1]
+    state = header[2]
+    operation_payload_size = int.from_bytes(header[3:HEADER_SIZE], "big")
+    return roomname_size, operation, state, operation_payload_size
+
+
+def process_operation(operation: int, room_name: str, user_name: str):
+    # 操作を処理して、(最終的なリアクション, クライアント) を返す
+    # TCPの読み書きとは切り離してあるので、asyncio版でも同期版でも同じ処理を使える
+    if operation == 1:
+        # 新しいチャットルームを作成
+        # トークンを生成
+        # なおかつ、ユーザーをチャットルームのメンバーに入れる
+        if federation_node is not None and federation_node.has_room(room_name):
+            # 他のノードにすでにある
+            logger.debug("this chat room already exists on a peer: %s", room_name)
+            return 3, None
+        created = registry.create_room(room_name, user_name)
+        if created is None:
+            logger.debug("this chat room already exists: %s", room_name)
+            return 3, None
+        newroom, owner_info = created
+        register_client(newroom, owner_info)
+        announce_room(newroom)
+
+        # リクエストの完了（2）: サーバは特定の生成されたユニークなトークンをクライアントに送り、このトークンにユーザー名を割り当てます。
+        # このトークンはクライアントをチャットルームのホストとして識別します。
+        return 2, owner_info
+
+    if operation == 2:
+        # 既存のチャットルームに参加
+        # 全チャットルームのマップの中から該当のチャットルームがあるか確認する
+        joined = registry.join_room(room_name, user_name)
+        if (
+            joined is None
+            and federation_node is not None
+            and federation_node.has_room(room_name)
+        ):
+            # 他のノードにあるルームなので、このノードにも同じ名前のルームを作って参加する
+            created = registry.create_room(room_name, user_name)
+            if created is not None:
+                joined = created + (True,)
+        if joined is None:
+            logger.debug("this chat room does not exist: %s", room_name)
+            return 3, None
+
+        selected_room, client, is_new = joined
+        if is_new:
+            register_client(selected_room, client)
+            announce_room(selected_room)
+        else:
+            # 同じ名前で参加し直した。期限切れの確認はワーカーのクライアントで行うので、そちらも更新する
+            touch_client(selected_room, client)
+        return 2, client
+
+    raise Exception("unknown operation: {}".format(operation))
+
+
+def unregister_client(room: Chatroom, client: Chatclient):
+    # 退出したクライアントをリレー側からも外す（タイムアウトの管理はクライアントが残っていないことを確認して飛ばす）
+    if shard_router is not None:
+        shard_router.unregister(room, client)
+
+
+def touch_client(room: Chatroom, client: Chatclient):
+    # 最終メンション時刻を更新する。マルチプロセスモードでは期限切れの確認はワーカーの
+    # クライアントで行うので、担当のワーカーにも知らせる
+    client.update_last_activity()
+    if shard_router is not None:
+        shard_router.touch(room, client)
+
+
+def authenticate_control(body: bytes):
+    # 制御用の接続の SessionID | Token を確認して (ルーム, クライアント) を返す。認証できなければ None
+    # SessionID が 0 の場合はトークンだけで認証する（テキスト形式のハンドシェイクは SessionID を返さないため。
+    # ユーザーIDは1から振るので、0 のクライアントはいない）
+    session_id, token = control.unpack_session(body)
+    raw_token = decode_token(token)
+    entry = registry.authenticate(raw_token) if raw_token else None
+    if entry is None or (session_id and entry[1].userid != session_id):
+        auth_failures.inc()
+        return None
+    return entry
+
+
+def process_control_request(operation: int, body: bytes):
+    # 制御用の接続のリクエストを1つ処理して、(Status, レスポンスの Body) を返す
+    # 形式が正しくない場合は ValueError（UnicodeDecodeError を含む）
+    if operation == control.OP_CREATE or operation == control.OP_JOIN:
+        room_name, user_name = control.unpack_room_request(body)
+        if (
+            len(room_name.encode("utf-8")) > MAX_ROOMNAME_SIZE
+            or len(user_name.encode("utf-8")) > MAX_OPERATION_PAYLOAD_SIZE
+        ):
+            raise ValueError("room name or user name is too long")
+        reaction, client = process_operation(operation, room_name, user_name)
+        if client is None:
+            return control.STATUS_FAILED, b""
+        token = encode_token(registry.issue_token(client))
+        return control.STATUS_OK, control.pack_session(client.userid, token)
+
+    if operation == control.OP_LEAVE:
+        entry = authenticate_control(body)
+        if entry is None:
+            return control.STATUS_INVALID_TOKEN, b""
+        room, client = entry
+        registry.remove_client(room, client)
+        unregister_client(room, client)
+        announce_room(room)
+        return control.STATUS_OK, b""
+
+    if operation == control.OP_RENEW:
+        # 最終メンション時刻を更新し、署名付きトークンの場合は有効期限を延ばした新しいトークンを返す
+        # （ランダムなトークンは退出するまで変わらないので、同じトークンを返す）
+        entry = authenticate_control(body)
+        if entry is None:
+            return control.STATUS_INVALID_TOKEN, b""
+        room, client = entry
+        touch_client(room, client)
+        token = encode_token(registry.issue_token(client))
+        return control.STATUS_OK, control.pack_session(client.userid, token)
+
+    if operation == control.OP_LIST_ROOMS:
+        limit, prefix = control.unpack_list_request(body)
+        rooms = registry.rooms_with_prefix(prefix, limit)
+        entries = [(room.room_name, len(room.active_clients)) for room in rooms]
+        return control.STATUS_OK, control.pack_rooms(entries)
+
+    if operation == control.OP_LIST_MEMBERS:
+        limit, room_name = control.unpack_list_request(body)
+        room = registry.rooms.get(room_name)
+        if room is None:
+            return control.STATUS_FAILED, b""
+        clients = list(room.active_clients.values())[:limit]
+        return control.STATUS_OK, control.pack_names(
+            client.user_name for client in clients
+        )
+
+    return control.STATUS_BAD_REQUEST, b""
+
+
+async def serve_control(reader, writer, read_timeout, idle_timeout):
+    # 制御用の接続。届いている分のリクエストをまとめて処理し、応答もまとめて1回で書く
+    # 操作はどれもイベントループを止めずにすぐ終わるので、その場で処理する
+    client_address = writer.get_extra_info("peername")
+    control_sessions.inc()
+    buffer = bytearray()
+    try:
+        while True:
+            # フレームの途中なら read_timeout、リクエストの合間なら idle_timeout まで待つ
+            timeout = read_timeout if buffer else idle_timeout
+            data = await asyncio.wait_for(reader.read(CONTROL_READ_SIZE), timeout)
+            if not data:
+                return
+            buffer += data
+            frames, consumed = control.unpack_frames(buffer, control.MAX_REQUEST_SIZE)
+            del buffer[:consumed]
+            responses = []
+            for request_id, operation, body in frames:
+                try:
+                    status, response = process_control_request(operation, body)
+                except ValueError:
+                    status, response = control.STATUS_BAD_REQUEST, b""
+                responses.append(control.pack_frame(request_id, status, response))
+            control_requests.inc(len(frames))
+            if responses:
+                writer.write(b"".join(responses))
+                await asyncio.wait_for(writer.drain(), read_timeout)
+    except asyncio.TimeoutError:
+        logger.info("control connection from %s timed out", client_address)
+    except ValueError as e:
+        logger.warning("control connection from %s failed: %s", client_address, e)
+    except OSError as e:
+        logger.info("control connection from %s closed: %s", client_address, e)
+
+
+async def handle_handshake(
+    reader,
+    writer,
+    read_timeout=DEFAULT_READ_TIMEOUT,
+    text_frames=False,
+    control_idle_timeout=DEFAULT_CONTROL_IDLE_TIMEOUT,
+):
+    client_address = writer.get_extra_info("peername")
+    try:
+        # サーバの初期化（0）
+        writer.write((0).to_bytes(1, "big"))
 
-            print("room_name", room_name)
-            print("user_name", user_name)
+        # recv()は要求したバイト数より短く返ることがあるので、readexactly()で必要なバイト数を確実に読む
+        # 応答しないクライアントが他の接続を止めないよう、読み込みごとにタイムアウトを設定する
+        header = await asyncio.wait_for(reader.readexactly(HEADER_SIZE), read_timeout)
+        roomname_size, operation, state, operation_payload_size = parse_header(header)
 
-            # 新しいチャットルームを作成する場合、操作コードは 1 です。0 はリクエスト、1 は準拠、2 は完了です。TCP は完全なトランザクションを保証するために使用されます。
-            if operation == 1:
-                # 新しいチャットルームを作成
+        # ルーム名の最大バイト数は 28 バイトであり、OperationPayloadSize の最大バイト数は 229 バイトです。
+        if (
+            roomname_size > MAX_ROOMNAME_SIZE
+            or operation_payload_size > MAX_OPERATION_PAYLOAD_SIZE
+        ):
+            raise Exception(
+                "roomname_size should be under 28 bytes and operation_payload_size should be under 229 bytes"
+            )
 
-                # クライアントにリクエストを処理していることを伝える
-                reaction = 1
-                connection.sendall(reaction.to_bytes(1, "big"))
+        # ボディ: 最初の RoomNameSize バイトがルーム名で、その後にユーザー名、 OperationPayloadSize バイトが続きます。
+        body = await asyncio.wait_for(
+            reader.readexactly(roomname_size + operation_payload_size), read_timeout
+        )
+        # RoomNamesとユーザー名 は UTF-8 でエンコード/デコードされます。
+        room_name = body[:roomname_size].decode("utf-8")
+        # ペイロードの中にユーザー名が入っている
+        user_name = body[roomname_size:].decode("utf-8")
 
-                # 新しいチャットルームを作成開始
-                # トークンを生成
-                # なおかつ、ユーザーをチャットルームのメンバーに入れる
-                owner_token = secrets.token_urlsafe(255)
-                owner_info = Chatclient(
-                    operation_payload_size, owner_token
-                )  # operation_payload_sizeにはユーザー名のバイトサイズが入っている
-                newroom = Chatroom(room_name, owner_token, owner_info)
+        # クライアントにリクエストを処理していることを伝える
+        writer.write((1).to_bytes(1, "big"))
 
-                # 作成したチャットルームを全チャットルームのマップに入れておく
-                chatrooms[roomname_size] = newroom
+        if operation == OPERATION_CONTROL:
+            # 完了（2）を返した後は、この接続を制御用の接続として使う
+            writer.write((2).to_bytes(1, "big"))
+            handshakes.inc()
+            await serve_control(reader, writer, read_timeout, control_idle_timeout)
+            return
 
-                # リクエストの完了（2）: サーバは特定の生成されたユニークなトークンをクライアントに送り、このトークンにユーザー名を割り当てます。
-                # クライアントにリクエストが完了したことを伝える
-                reaction = 2
-                connection.sendall(reaction.to_bytes(1, "big"))
+        reaction, client = process_operation(operation, room_name, user_name)
+        writer.write(reaction.to_bytes(1, "big"))
+        if client is not None:
+            if not text_frames:
+                # バイナリフレームで使うセッションID（4バイト）をトークンの前に付ける
+                writer.write(protocol.SESSION_ID.pack(client.userid))
+            # トークンを返す
+            writer.write(encode_token(registry.issue_token(client)).encode("ascii"))
+        await asyncio.wait_for(writer.drain(), read_timeout)
+        handshakes.inc()
 
-                # クライアントにトークンを送る
-                print("owner_token", owner_token)
-                connection.sendall(owner_token.encode("utf-8"))
+    except asyncio.TimeoutError:
+        handshake_errors.inc()
+        logger.info("handshake from %s timed out", client_address)
+    except asyncio.IncompleteReadError:
+        handshake_errors.inc()
+        logger.info("connection from %s closed during handshake", client_address)
+    except Exception as e:
+        handshake_errors.inc()
+        logger.warning("handshake from %s failed: %s", client_address, e)
+
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+
+async def serve_handshake(
+    server_address="0.0.0.0",
+    server_port=9002,
+    backlog=DEFAULT_BACKLOG,
+    read_timeout=DEFAULT_READ_TIMEOUT,
+    text_frames=False,
+    control_idle_timeout=DEFAULT_CONTROL_IDLE_TIMEOUT,
+):
+    # 1つのイベントループで多数のハンドシェイクを同時に処理する
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_handshake(
+            reader, writer, read_timeout, text_frames, control_idle_timeout
+        ),
+        server_address,
+        server_port,
+        backlog=backlog,
+        reuse_address=True,
+    )
+    logger.info("starting up on port %d", server_port)
+    return server
+
+
+def enter_chatroom(
+    server_address="0.0.0.0",
+    server_port=9002,
+    backlog=DEFAULT_BACKLOG,
+    read_timeout=DEFAULT_READ_TIMEOUT,
+    text_frames=False,
+    control_idle_timeout=DEFAULT_CONTROL_IDLE_TIMEOUT,
+):
+    async def run():
+        server = await serve_handshake(
+            server_address,
+            server_port,
+            backlog,
+            read_timeout,
+            text_frames,
+            control_idle_timeout,
+        )
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(run())
+
+
+def encode_relay(room: Chatroom, name: bytes, body, text_frames: bool) -> bytes:
+    # リレーするペイロードを組み立てる（メッセージごとに1回だけ呼ぶ）
+    # バイナリフレームではルームの通し番号を付け、同じバイト列を履歴にも残す
+    if text_frames:
+        return b"".join((name, b":", body))
+    history = room.history
+    payload = protocol.pack_message(name, body, history.next_seq, server_epoch)
+    history.append(payload)
+    return payload
+
+
+def announce_room(room: Chatroom):
+    # このノードのルームの参加者が0人から1人になった時と、0人になった時に他のノードへ知らせる
+    if federation_node is None:
+        return
+    count = len(room.active_clients)
+    if count == 1:
+        federation_node.announce(federation.KIND_ROOMS, [room.room_name])
+    elif count == 0:
+        federation_node.announce(federation.KIND_ROOMS_GONE, [room.room_name])
+
+
+def forward_to_peers(room: Chatroom, name: bytes, body):
+    # ローカルにリレーしたメッセージを、そのルームの参加者がいる他のノードに送る
+    if federation_node is not None:
+        federation_out.inc(federation_node.forward(room.room_name, name, body))
+
+
+def gossip_rooms():
+    # 参加者がいるルームの一覧を全部送り直す（取りこぼした通知や、再起動したノードのため）
+    rooms = list(registry.rooms.values())
+    federation_node.announce(
+        federation.KIND_ROOMS,
+        [room.room_name for room in rooms if room.active_clients],
+    )
+
+
+def handle_federation_datagram(sock, data: bytes, address, text_frames: bool):
+    # 他のノードからのフレーム。メッセージならこのノードの参加者にリレーする（他のノードには送り直さない）
+    try:
+        message = federation_node.receive(data, address, time.monotonic())
+    except (ValueError, struct.error):
+        # 壊れたフレーム（送信元は偽装できるので、受信ループを止めずに捨てる）
+        malformed_datagrams.inc()
+        return
+    if message is None:
+        return
+    room_name, name, body = message
+    room = registry.rooms.get(room_name)
+    if room is None:
+        return
+    federation_in.inc()
+    relay_to_room(sock, encode_relay(room, name, body, text_frames), room)
+
+
+def encode_error(text: str, text_frames: bool) -> bytes:
+    if text_frames:
+        return text.encode("utf-8")
+    return protocol.pack_error(text)
+
+
+def allow_datagram(sock, address, now: float, text_frames: bool) -> bool:
+    # 送信元アドレスごとの制限。受信ループでデータグラムを見る前に呼ぶ
+    if client_limiter.limit.rate and not client_limiter.allow(address, now):
+        rate_limited_clients.inc()
+        bucket = client_limiter.buckets[address]
+        throttle(sock, client_limiter.limit, bucket, address, text_frames)
+        return False
+    return True
+
+
+def allow_relay(sock, room: Chatroom, address, now: float, text_frames: bool) -> bool:
+    # ルームごとの制限。1つのルームが溢れても、他のルームのリレーが止まらないようにする
+    if room_limit.rate and not room_limit.allow(room.bucket, now):
+        rate_limited_rooms.inc()
+        throttle(sock, room_limit, room.bucket, address, text_frames)
+        return False
+    return True
+
+
+def throttle(sock, limit, bucket, address, text_frames: bool):
+    # 制限を超えたことを送信者に知らせる。応答で送信量が増えないよう、制限中は1回だけにする
+    if not send_throttle_replies or bucket.notified:
+        return
+    bucket.notified = True
+    if text_frames:
+        reply = b"Rate limited"
+    else:
+        reply = protocol.pack_throttle(limit.retry_after(bucket))
+    try:
+        sock.sendto(reply, address)
+    except OSError:
+        send_errors.inc()
+        return
+    throttle_replies.inc()
+
+
+def set_rate_limits(limits):
+    # limits は {名前: 値}（ratelimit.LIMIT_NAMES）。実行中に変えても、すでにあるバケットにそのまま効く
+    client_limiter.limit.set(limits["client_rate"], limits["client_burst"])
+    room_limit.set(limits["room_rate"], limits["room_burst"])
+
+
+def expire_idle_clients(sock, now: float, text_frames=False):
+    # 期限切れのクライアントを全ルームから削除し、残っているメンバーに通知する
+    # 削除と通知はルームごとにまとめる（1人ずつだと一覧のコピーと通知がルームの人数分ずつになる）
+    # (ルーム, 削除したクライアントのリスト) のリストを返す
+    by_room = {}
+    for room, client in expiry_scheduler.expire(now):
+        by_room.setdefault(room, []).append(client)
+    expired = []
+    for room, clients in by_room.items():
+        removed = registry.remove_clients(room, clients, expired=True)
+        if not removed:
+            continue
+        expiries.inc(len(removed))
+        logger.info(
+            "%d clients have timed out in %s: %s",
+            len(removed),
+            room.room_name,
+            " ".join(str(client.userid) for client in removed),
+        )
+        for notice in timeout_notices(removed):
+            relay_to_room(
+                sock, encode_relay(room, b"server", notice, text_frames), room
+            )
+            forward_to_peers(room, b"server", notice)
+        announce_room(room)
+        expired.append((room, removed))
+    return expired
 
-                # このトークンはクライアントをチャットルームのホストとして識別します。トークンは最大 255 バイトです。
-            elif operation == 2:
-                # 既存のチャットルームに参加
-                # クライアントにリクエストを処理していることを伝える
-                reaction = 1
-                connection.sendall(reaction.to_bytes(1, "big"))
 
-                # 全チャットルームのマップの中から該当のチャットルームがあるか確認する
-                if roomname_size in chatrooms:
-                    selected_room: Chatroom = chatrooms[roomname_size]
-                    print(selected_room.room_name)
+# タイムアウトの通知1件の本文の最大バイト数（1つのデータグラムに収まるように）
+MAX_NOTICE_SIZE = protocol.MAX_DATAGRAM_SIZE - protocol.relayed_size(b"server", 0)
 
-                    # ユーザーをそのチャットルームのユーザーリストの中に入れる
-                    user_id = operation_payload_size
-                    selected_room.update_active_clients(user_id)
-                    print(selected_room.active_clients)
 
-                    token = selected_room.active_clients[user_id].token
-                    print(token)
-                    # クライアントにリクエストが完了したことを伝える
-                    reaction = 2
-                    connection.sendall(reaction.to_bytes(1, "big"))
+def timeout_notices(clients):
+    # 「alice, bob have timed out」のように名前をまとめた通知を、MAX_NOTICE_SIZE に収まる分ずつ返す
+    suffix = b" have timed out"
+    names = []
+    size = len(suffix)
+    for client in clients:
+        name = client.user_name.encode("utf-8")
+        if names and size + 2 + len(name) > MAX_NOTICE_SIZE:
+            yield b", ".join(names) + suffix
+            names = []
+            size = len(suffix)
+        size += len(name) + (2 if names else 0)
+        names.append(name)
+    if len(names) == 1:
+        yield names[0] + b" has timed out"
+    elif names:
+        yield b", ".join(names) + suffix
 
-                    # トークンを返す
-                    connection.sendall(token.encode("utf-8"))
 
-                else:
-                    print("this chat room does not exist")
+def relay_to_room(sock, payload: bytes, room: Chatroom):
+    # ルームのメンバーにリレーする（まとめ送りの場合は、ためておいて後で送る）
+    if coalescer is not None:
+        coalescer.add(sock, room, payload)
+        return
+    send_to_room(sock, payload, room)
 
-                    reaction = 3
-                    connection.sendall(reaction.to_bytes(1, "big"))
 
-        # 新しいチャットルームに参加しようとするとき、操作コードは 2 です。状態は作成時と同様で、クライアントも生成されたトークンを受け取りますが、ホストではありません。
-        # チャットルームごとに、サーバは許可されたリストトークンのリストを追跡する必要があります。ユーザーがそのトークンで参加すると、トークンの所有者として設定されます。メッセージがチャットルーム内の他のすべての人にリレーされるためには、トークンと IP アドレスが一致しなければなりません。
+def send_to_room(sock, payload: bytes, room: Chatroom):
+    # relay_message に計測を付けたもの
+    addresses = room.addresses
+    failed = relay_message(sock, payload, addresses)
+    datagrams_out.inc(len(addresses) - failed)
+    if failed:
+        send_errors.inc(failed)
+        if log_debug:
+            logger.debug("sending message to %d clients failed", failed)
 
-        except Exception as e:
-            print("Error: " + str(e))
 
-        finally:
-            print("Closing current connection")
-            connection.close()
+def handle_text_datagram(sock, data: bytes, address):
+    # 従来のテキスト形式「ルーム名:トークン:ユーザー名:メッセージ」（--text-frames の時だけ使う）
+    datagrams_in.inc()
+    started = time.perf_counter()
+    # 受信データのデコード
+    try:
+        decoded_data = data.decode("utf-8")
+        # チャットルーム名、トークン、ユーザー名、メッセージの分解
+        room_name, token, user_name, message = decoded_data.split(":", 3)
+    except (UnicodeDecodeError, ValueError):
+        malformed_datagrams.inc()
+        return
+    parsed = time.perf_counter()
+    parse_seconds.observe(parsed - started)
 
+    # トークンの索引を1回引いて、チャットルームとクライアントを取り出す
+    raw_token = decode_token(token)
+    entry = registry.authenticate(raw_token, room_name) if raw_token else None
+    if entry is None:
+        # 認証できなかったメッセージはリレーしない
+        auth_failures.inc()
+        sock.sendto(encode_error("Invalid token", True), address)
+        return
+    chatroom_info, userinfo = entry
 
-def send_chat():
-    # タイムアウト期間（秒）
-    timeout_period = 60 * 5  # とりあえずタイムアウト５分に設定
+    # トークンが一致＝認証OK
+    # アドレスを入れる（変わった時だけリレー先一覧を更新する）
+    registry.bind_address(chatroom_info, userinfo, address)
+    # あったら最終メンション時刻を更新
+    userinfo.update_last_activity()
+    authenticated = time.perf_counter()
+    auth_seconds.observe(authenticated - parsed)
+    if not allow_relay(sock, chatroom_info, address, authenticated, True):
+        return
 
+    # 現在アクティブなユーザーにのみメッセージを送る
+    # エンコードはメッセージごとに1回だけ
+    # 送信者名はクライアントが送ってきたものではなく、登録されている名前を使う
+    name = userinfo.user_name.encode("utf-8")
+    body = message.encode("utf-8")
+    relay_to_room(sock, encode_relay(chatroom_info, name, body, True), chatroom_info)
+    forward_to_peers(chatroom_info, name, body)
+    fanout_seconds.observe(time.perf_counter() - authenticated)
+
+
+def handle_binary_datagram(sock, view: memoryview, nbytes: int, address):
+    # バイナリフレーム。受信バッファの memoryview から struct で読み、コピーもデコードもしない
+    datagrams_in.inc()
+    started = time.perf_counter()
+    parsed = protocol.parse_chat(view, nbytes)
+    if parsed is None:
+        malformed_datagrams.inc()
+        return
+    kind, session_id, token, body = parsed
+    authenticating = time.perf_counter()
+    parse_seconds.observe(authenticating - started)
+
+    if kind == protocol.KIND_NACK:
+        # 再送は登録済みのアドレスにだけ送る（トークン付きの NACK で、送信元を偽った別のアドレスに送らせないため）
+        token = None
+    if token:
+        # 最初のメッセージにはトークンが付いている。認証できたら送信元アドレスを登録する
+        raw_token = decode_token(token)
+        entry = registry.authenticate(raw_token) if raw_token else None
+        if entry is not None and entry[1].userid != session_id:
+            entry = None
+    else:
+        entry = registry.authenticate_session(session_id, address)
+    if entry is None:
+        # 認証できなかったメッセージはリレーしない
+        auth_failures.inc()
+        if log_debug:
+            logger.debug("invalid token from %s", address)
+        sock.sendto(encode_error("Invalid token", False), address)
+        return
+    chatroom_info, userinfo = entry
+    if token:
+        registry.bind_address(chatroom_info, userinfo, address)
+    userinfo.update_last_activity()
+    authenticated = time.perf_counter()
+    auth_seconds.observe(authenticated - authenticating)
+
+    if kind != protocol.KIND_CHAT:
+        # 履歴と再送の要求も1回で最大で履歴の容量分を送るので、リレーと同じくルームごとの制限にかける
+        if not allow_relay(sock, chatroom_info, address, authenticated, False):
+            return
+    if kind == protocol.KIND_HISTORY:
+        if len(body) != protocol.HISTORY_REQUEST.size:
+            malformed_datagrams.inc()
+            return
+        last_seen, epoch = protocol.HISTORY_REQUEST.unpack(body)
+        if epoch != server_epoch:
+            # 再起動する前の番号なので、残っている履歴を最初から送る
+            last_seen = 0
+        send_history(sock, chatroom_info, last_seen, address)
+        return
+    if kind == protocol.KIND_NACK:
+        ranges = protocol.unpack_nack(body)
+        if ranges is None:
+            malformed_datagrams.inc()
+            return
+        send_retransmit(sock, chatroom_info, ranges, address)
+        return
+
+    if not allow_relay(sock, chatroom_info, address, authenticated, False):
+        return
+    name = userinfo.user_name.encode("utf-8")
+    if protocol.relayed_size(name, len(body)) > protocol.MAX_DATAGRAM_SIZE:
+        malformed_datagrams.inc()
+        return
+    # ユーザー名とメッセージ本体をそのまま詰めて、全員に同じバイト列を送る
+    relay_to_room(sock, encode_relay(chatroom_info, name, body, False), chatroom_info)
+    forward_to_peers(chatroom_info, name, body)
+    fanout_seconds.observe(time.perf_counter() - authenticated)
+
+
+def send_history(sock, room: Chatroom, last_seen: int, address):
+    # last_seen より後の履歴を、1つのデータグラムに収まる分ずつまとめて送る
+    history_requests.inc()
+    # まとめ送りでためているメッセージは、アドレスを登録した後なのでこのクライアントにも送られる。
+    # 履歴にも入れると、参加した直後のクライアントに同じメッセージが2回届く
+    unsent = len(room.pending) if room.pending is not None else 0
+    frames = protocol.pack_batches(
+        room.history.since(last_seen, unsent), protocol.KIND_HISTORY
+    )
+    for frame in frames:
+        try:
+            sock.sendto(frame, address)
+        except OSError:
+            send_errors.inc()
+            return
+        datagrams_out.inc()
+        history_batches.inc()
+
+
+def send_retransmit(sock, room: Chatroom, ranges, address):
+    # NACK で知らされた届かなかったメッセージを、履歴に残っている分だけ送り直す
+    # 範囲をつなげて重複を除くので、1回の NACK で送るのは最大で履歴の容量分のフレーム
+    nack_requests.inc()
+    for frames in room.history.select(ranges):
+        for frame in protocol.pack_batches(frames, protocol.KIND_HISTORY):
+            try:
+                sock.sendto(frame, address)
+            except OSError:
+                send_errors.inc()
+                return
+            datagrams_out.inc()
+        retransmitted.inc(len(frames))
+
+
+def receive_timeout() -> float:
+    # まとめ送りの場合は、メッセージが来なくても期限までに送れるよう短くする
+    if coalescer is not None:
+        return min(coalescer.window, EXPIRY_INTERVAL)
+    return EXPIRY_INTERVAL
+
+
+def send_chat(server_address="0.0.0.0", server_port=9001, text_frames=False):
     # AF_INETを使用し、UDPソケットを作成
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
-    server_address = "0.0.0.0"
-    server_port = 9001
-    print("starting up on port {}".format(server_port))
+    logger.info("starting up on port %d", server_port)
 
     # ソケットを特殊なアドレス0.0.0.0とポート9001に紐付け
     sock.bind((server_address, server_port))
+    # メッセージが来ない間も期限切れのチェックができるよう、受信にタイムアウトを設定する
+    sock.settimeout(receive_timeout())
+    next_expiry_check = time.time() + EXPIRY_INTERVAL
+
+    # メッセージ送信時、サーバとクライアントは一度に最大で 4096 バイトのメッセージを処理します。
+    # 受信バッファは使い回し、recvfrom_into()で毎回新しいbytesを作らないようにする
+    # （ノード間のフレームはルーム名などが付く分だけ大きい）
+    buffer_size = protocol.MAX_DATAGRAM_SIZE
+    peers = frozenset()
+    next_gossip = 0.0
+    if federation_node is not None:
+        federation_node.sock = sock
+        buffer_size = federation.MAX_FRAME_SIZE
+        peers = federation_node.peers
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
 
     while True:
-        print("\nwaiting to receive message")
-        # メッセージ送信時、サーバとクライアントは一度に最大で 4096 バイトのメッセージを処理します。
-        # これは、クライアントが送信できるメッセージの最大サイズです。
-        # 同じく、最大 4096 バイトのメッセージが他の全クライアントに転送されます。
+        # タイムアウトチェックはメッセージごとではなく、EXPIRY_INTERVALごとにまとめて行う
+        now = time.time()
+        if now >= next_expiry_check:
+            expire_idle_clients(sock, now, text_frames)
+            client_limiter.purge(time.perf_counter())
+            next_expiry_check = now + EXPIRY_INTERVAL
+            if federation_node is not None:
+                federation_node.expire(time.monotonic())
+        if federation_node is not None and now >= next_gossip:
+            gossip_rooms()
+            next_gossip = now + federation.GOSSIP_INTERVAL
+        if coalescer is not None:
+            coalescer.flush_due(sock, time.perf_counter())
 
-        # メッセージの最初の 1 バイト、usernamelen は、ユーザー名の全バイトサイズを示し、これは最大で 255バイト（28 - 1 バイト）
-        # サーバはこの初めの usernamelen バイトを読み、送信者のユーザー名を特定します。
-        data, address = sock.recvfrom(4096)
+        try:
+            nbytes, address = sock.recvfrom_into(buffer)
+        except socket.timeout:
+            continue
+        if not nbytes:
+            continue
+        if address in peers:
+            data = bytes(view[:nbytes])
+            handle_federation_datagram(sock, data, address, text_frames)
+            continue
+        # 制限を超えた送信元のデータグラムは、デコードする前に捨てる
+        if not allow_datagram(sock, address, time.perf_counter(), text_frames):
+            continue
 
         # サーバにはリレーシステムが組み込まれており、現在接続中のすべてのクライアントの情報を一時的にメモリ上に保存します。新しいメッセージがサーバに届くと、そのメッセージは現在接続中の全クライアントにリレーされます。
-        print("received {} bytes from {}".format(len(data), address))
-        print(data.decode())
-
-        if data:
-            # 受信データのデコード
-            decoded_data = data.decode("utf-8")
-
-            # チャットルーム名、トークン、ユーザー名、メッセージの分解
-            room_name, token, user_name, message = decoded_data.split(":", 3)
-
-            # チャットルームの情報を取り出す
-            chatroom_info = chatrooms[len(room_name)]
-            print("chatroom_info", chatroom_info)
-
-            # 認証されているユーザーであるか確認
-            active_clients = chatroom_info.active_clients
-            print("active_clients", active_clients)
-
-            # タイムアウトチェック→タイムアウトしたユーザーはアクティブユーザーリストから削除する
-            current_time = time.time()
-            for userid in list(active_clients):
-                if current_time - active_clients[userid].last_activity > timeout_period:
-                    print(f"Client {userid} has timed out and will be removed.")
-                    del active_clients[userid]
-            # バイトからintに変換
-            userid_int = len(user_name)
-            # アクティブなクライアントのマップに既に存在するか確認
-            if userid_int not in active_clients:
-                # raise Exception("this user is not authorized")
-                sock.sendto("Invalid token".encode("utf-8"), address)
+        if text_frames:
+            handle_text_datagram(sock, bytes(view[:nbytes]), address)
+        else:
+            handle_binary_datagram(sock, view, nbytes, address)
 
-            else:
-                # チャットルーム内にあったら、トークンが一致するか確認
-                userinfo = active_clients[userid_int]
-                print("userinfo address", userinfo.address)
-                if token == userinfo.token:
-                    # トークンが一致＝認証OK
-                    # アドレスを入れる
-                    active_clients[userid_int].set_address(address)
-                    # あったら最終メンション時刻を更新
-                    active_clients[userid_int].update_last_activity()
-                else:
-                    # raise Exception("this user is not authorized")
-                    sock.sendto("Invalid token".encode("utf-8"), address)
-
-            # 現在アクティブなユーザーにのみメッセージを送る
-            all_message = user_name + ":" + message
-            for userid in list(active_clients):
-                # アクティブなユーザーのアドレスにメッセージを送る
+
+# マルチプロセスモード
+# メインプロセスが9001番で受信し、ルームのシャードごとにワーカープロセスへ振り分ける。
+# リレー（ファンアウト）とタイムアウトの管理は各ワーカーが自分の担当するルームについて行う。
+# メインプロセスとワーカーの間は Unix ドメインの SOCK_SEQPACKET でつなぎ、先頭1バイトで種類を分ける。
+# （メッセージの区切りが保たれ、メインプロセスが終了するとワーカー側で EOF になる）
+# メインプロセスからワーカーへの操作（join / leave など）は、データグラムとは別のチャンネルで送る。
+# データグラムのチャンネルはワーカーが詰まると満杯になるので、同じチャンネルで送ると
+# ハンドシェイクのスレッドが止まり、他のシャードのハンドシェイクも進まなくなる
+IPC_DATAGRAM = ord("D")  # D | 送信元アドレス（6バイト） | 受信したデータグラム
+IPC_CONTROL = ord("C")  # C | pickle化した操作（join / leave / touch / expire / metrics）
+IPC_ADDRESS = struct.Struct("!4sH")
+IPC_BUFFER_SIZE = 1 + IPC_ADDRESS.size + protocol.MAX_DATAGRAM_SIZE
+
+
+class ShardRouter:
+    # メインプロセス側で、ワーカーへの振り分けと登録を行う
+    def __init__(self, channels, controls):
+        self.channels = channels  # データグラムの転送と、ワーカーからの通知
+        self.controls = controls  # ワーカーへの操作
+
+    def shard_count(self):
+        return len(self.channels)
+
+    def register(self, room: Chatroom, client: Chatclient):
+        # ハンドシェイクの応答より先に送るので、クライアントの最初のメッセージより必ず先にワーカーに届く
+        shard = shard_of_room(room.room_name, len(self.channels))
+        control = (
+            "join",
+            room.room_name,
+            client.userid,
+            client.token,
+            client.user_name,
+            client.address,
+        )
+        self.send_control(shard, control)
+
+    def unregister(self, room: Chatroom, client: Chatclient):
+        # 制御用の接続から退出した
+        shard = shard_of_room(room.room_name, len(self.channels))
+        control = ("leave", room.room_name, client.userid)
+        self.send_control(shard, control)
+
+    def touch(self, room: Chatroom, client: Chatclient):
+        # 制御用の接続から更新した（OP_RENEW）
+        shard = shard_of_room(room.room_name, len(self.channels))
+        control = ("touch", room.room_name, client.userid)
+        self.send_control(shard, control)
+
+    def broadcast(self, control):
+        for shard in range(len(self.controls)):
+            self.send_control(shard, control)
+
+    def send_control(self, shard: int, control):
+        try:
+            self.controls[shard].send(bytes([IPC_CONTROL]) + pickle.dumps(control))
+        except OSError:
+            worker_exited(shard)
+
+    def route(self, view: memoryview, nbytes: int, text_frames: bool):
+        # データグラムの先頭だけを見て担当のワーカーを決める
+        if text_frames:
+            room_name = bytes(view[:nbytes]).split(b":", 1)[0]
+            return zlib.crc32(room_name) % len(self.channels)
+        if nbytes < protocol.CHAT_HEADER.size:
+            return None
+        # セッションID（=ユーザーID）は ID % ワーカー数 がシャードになるよう割り当ててある
+        session_id = protocol.CHAT_HEADER.unpack_from(view)[3]
+        return session_id % len(self.channels)
+
+
+# マルチプロセスモードの時だけ使う
+shard_router = None
+
+
+class BindNotifier:
+    # ワーカーの Registry.journal として置き、UDPアドレスの登録をメインプロセスに知らせる
+    # （メインプロセスの索引とジャーナルにもアドレスを残すため。タイムアウトは "expire" で別に送っている）
+    def __init__(self, channel):
+        self.channel = channel
+
+    def append(self, kind, userid, room_name, user_name="", token=b"", address=None):
+        if kind == journal.KIND_BIND:
+            control = ("bind", room_name, userid, address)
+            self.channel.send(bytes([IPC_CONTROL]) + pickle.dumps(control))
+
+
+def run_worker(
+    sock,
+    channel,
+    controls,
+    inherited,
+    text_frames: bool,
+    client_timeout: float,
+    history_size: int,
+    signer,
+    limits,
+    throttle_replies: bool,
+    coalesce_window: float,
+):
+    # ワーカープロセス。メインプロセスから受け取ったデータグラムを処理して、リレーする
+    # （送信元アドレスごとの制限はメインプロセスでかけてあるので、ここではルームごとの制限だけ）
+    # sock はメインプロセスが9001番に bind したソケット。送信だけに使い、応答がすべて9001番から届くようにする
+    # （NAT やファイアウォールの内側のクライアントは、送った先以外のポートからのデータグラムを受け取れない）
+    # channel はデータグラムの受信とメインプロセスへの通知、controls はメインプロセスからの操作の受信に使う
+    global registry, expiry_scheduler, send_throttle_replies, coalescer
+    # fork で引き継いだメインプロセス側のソケットを閉じておかないと、メインプロセスが終了しても EOF にならない
+    for other in inherited:
+        other.close()
+    registry = Registry()
+    registry.history_size = history_size
+    registry.journal = BindNotifier(channel)
+    registry.signer = signer
+    expiry_scheduler = ExpiryScheduler(client_timeout)
+    set_rate_limits(limits)
+    send_throttle_replies = throttle_replies
+    coalescer = RelayCoalescer(coalesce_window) if coalesce_window > 0 else None
+
+    selector = selectors.DefaultSelector()
+    selector.register(channel, selectors.EVENT_READ)
+    selector.register(controls, selectors.EVENT_READ)
+    next_expiry_check = time.time() + EXPIRY_INTERVAL
+
+    buffer = bytearray(IPC_BUFFER_SIZE)
+    view = memoryview(buffer)
+    payload = view[1 + IPC_ADDRESS.size :]
+
+    while True:
+        now = time.time()
+        if now >= next_expiry_check:
+            # タイムアウトしたクライアントはメインプロセスの索引からも削除してもらう
+            for room, clients in expire_idle_clients(sock, now, text_frames):
+                userids = [client.userid for client in clients]
+                control = ("expire", room.room_name, userids)
+                channel.send(bytes([IPC_CONTROL]) + pickle.dumps(control))
+            # 計測値もメインプロセスに送って、まとめて公開してもらう
+            control = ("metrics", metrics.snapshot())
+            channel.send(bytes([IPC_CONTROL]) + pickle.dumps(control))
+            next_expiry_check = now + EXPIRY_INTERVAL
+        if coalescer is not None:
+            coalescer.flush_due(sock, time.perf_counter())
+
+        # 操作をデータグラムより先に読む。参加はハンドシェイクの応答より先に送ってあるので、
+        # チャンネルが別でも、そのクライアントの最初のデータグラムより必ず先に処理される
+        try:
+            while True:
+                data = controls.recv(IPC_BUFFER_SIZE, socket.MSG_DONTWAIT)
+                if not data:
+                    # メインプロセスが終了した
+                    return
+                apply_main_control(data[1:])
+        except BlockingIOError:
+            pass
+
+        try:
+            nbytes = channel.recv_into(buffer, 0, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            selector.select(receive_timeout())
+            continue
+        if not nbytes:
+            return
+
+        ip, port = IPC_ADDRESS.unpack_from(buffer, 1)
+        address = (socket.inet_ntoa(ip), port)
+        size = nbytes - 1 - IPC_ADDRESS.size
+        if text_frames:
+            handle_text_datagram(sock, bytes(payload[:size]), address)
+        else:
+            handle_binary_datagram(sock, payload, size, address)
+
+
+def apply_main_control(data: bytes):
+    # メインプロセスからの操作（参加・退出・更新、鍵やレート制限の読み直し）をワーカーに反映する
+    operation, *control = pickle.loads(data)
+    if operation == "join":
+        room_name, userid, token, user_name, address = control
+        client = Chatclient(userid, token, user_name)
+        room = registry.insert_client(room_name, client)
+        if address is not None:
+            # ジャーナルから復元したクライアント
+            registry.bind_address(room, client, address)
+        expiry_scheduler.schedule(room, client)
+    elif operation == "leave":
+        # メインプロセスの制御用の接続から退出した
+        found = registry.find_client(*control)
+        if found is not None:
+            registry.remove_client(*found)
+    elif operation == "touch":
+        # メインプロセスの制御用の接続から更新した
+        found = registry.find_client(*control)
+        if found is not None:
+            found[1].update_last_activity()
+    elif operation == "keys":
+        # メインプロセスで鍵ファイルが読み直された
+        registry.signer.set_keys(control[0])
+    elif operation == "limits":
+        # メインプロセスでレート制限の設定が読み直された
+        set_rate_limits(control[0])
+
+
+def worker_exited(shard: int):
+    # ワーカーのプロセスが終了した（kill された、例外で落ちたなど）。そのシャードのルームの
+    # メンバーとリレーが失われ、以降のメッセージも届かなくなるので、サーバごと止めて知らせる
+    # （--state-dir があれば、再起動した時にジャーナルからセッションを復元する）
+    logger.error("worker for shard %d has exited; stopping the server", shard)
+    logging.shutdown()
+    os._exit(1)
+
+
+# ワーカーから最後に届いた計測値（チャンネルのファイル番号ごと）
+worker_snapshots = {}
+
+
+def apply_worker_control(channel, data: bytes):
+    # ワーカーからの通知（タイムアウトによる退出、アドレスの登録、計測値）をメインプロセスに反映する
+    operation, *payload = pickle.loads(data)
+    if operation == "expire":
+        room_name, userids = payload
+        room = registry.rooms.get(room_name)
+        if room is not None:
+            active_clients = room.active_clients
+            clients = [
+                active_clients[userid]
+                for userid in userids
+                if userid in active_clients
+            ]
+            registry.remove_clients(room, clients, expired=True)
+    elif operation == "bind":
+        room_name, userid, address = payload
+        found = registry.find_client(room_name, userid)
+        if found is not None:
+            registry.bind_address(*found, address)
+    elif operation == "metrics":
+        worker_snapshots[channel.fileno()] = payload[0]
+
+
+def collect_metrics():
+    # このプロセスの計測値とワーカーの計測値をまとめる
+    snapshots = [metrics.snapshot()]
+    for snapshot in list(worker_snapshots.values()):
+        # ルーム数と人数はメインプロセスの索引で数えるので、ワーカーのゲージは使わない
+        snapshots.append(dict(snapshot, gauges={}))
+    return metrics_module.merge(snapshots)
+
+
+def dispatch_datagrams(sock, router: ShardRouter, text_frames):
+    # メインプロセスで9001番を受信し、ワーカーへ転送する
+    # ソケットはワーカーも送信に使うので、ブロッキングのままにして受信の時だけ MSG_DONTWAIT を付ける
+    logger.info(
+        "starting up on port %d with %d workers",
+        sock.getsockname()[1],
+        router.shard_count(),
+    )
+
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ, None)
+    for shard, channel in enumerate(router.channels):
+        selector.register(channel, selectors.EVENT_READ, shard)
+
+    buffer = bytearray(IPC_BUFFER_SIZE)
+    view = memoryview(buffer)
+    buffer[0] = IPC_DATAGRAM
+    payload = view[1 + IPC_ADDRESS.size :]
+
+    next_purge = time.perf_counter() + EXPIRY_INTERVAL
+    while True:
+        events = selector.select(EXPIRY_INTERVAL)
+        now = time.perf_counter()
+        if now >= next_purge:
+            client_limiter.purge(now)
+            next_purge = now + EXPIRY_INTERVAL
+        for key, _ in events:
+            if key.data is not None:
+                data = key.fileobj.recv(IPC_BUFFER_SIZE)
+                if not data:
+                    worker_exited(key.data)
+                apply_worker_control(key.fileobj, data[1:])
+                continue
+            # 受信できるだけ受信して振り分ける
+            while True:
                 try:
-                    print(active_clients[userid].address)
-                    sent = sock.sendto(
-                        all_message.encode("utf-8"), active_clients[userid].address
+                    nbytes, address = sock.recvfrom_into(
+                        payload, 0, socket.MSG_DONTWAIT
                     )
-                except:
-                    print(
-                        "sending message to "
-                        + str(active_clients[userid].userid)
-                        + "failed"
+                except BlockingIOError:
+                    break
+                # 制限を超えた送信元のデータグラムは、ワーカーに転送する前に捨てる
+                now = time.perf_counter()
+                if not allow_datagram(sock, address, now, text_frames):
+                    continue
+                shard = router.route(payload, nbytes, text_frames)
+                if shard is None:
+                    malformed_datagrams.inc()
+                    continue
+                IPC_ADDRESS.pack_into(buffer, 1, socket.inet_aton(address[0]), address[1])
+                try:
+                    # ワーカーが詰まっている時はUDPと同じく捨てる（他のシャードを止めないため）
+                    router.channels[shard].send(
+                        view[: 1 + IPC_ADDRESS.size + nbytes], socket.MSG_DONTWAIT
                     )
+                except BlockingIOError:
+                    forward_drops.inc()
+                except OSError:
+                    worker_exited(shard)
+
+
+def start_workers(
+    sock,
+    worker_count: int,
+    text_frames: bool,
+    client_timeout: float,
+    history_size: int,
+    signer=None,
+    limits=None,
+    throttle_replies=False,
+    coalesce_window=0.0,
+):
+    channels = []
+    controls = []
+    for _ in range(worker_count):
+        parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        control_parent, control_child = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_SEQPACKET
+        )
+        process = multiprocessing.Process(
+            target=run_worker,
+            args=(
+                sock,
+                child,
+                control_child,
+                channels + controls + [parent, control_parent],
+                text_frames,
+                client_timeout,
+                history_size,
+                signer,
+                limits or dict.fromkeys(ratelimit.LIMIT_NAMES, 0),
+                throttle_replies,
+                coalesce_window,
+            ),
+            daemon=True,
+        )
+        process.start()
+        child.close()
+        control_child.close()
+        channels.append(parent)
+        controls.append(control_parent)
+    return ShardRouter(channels, controls)
+
+
+def reload_token_keys(path: str):
+    # 鍵の入れ替え。新しい鍵を先頭に追加し、古い鍵はトークンの有効期限が過ぎるまで残しておく
+    try:
+        keys = tokens.load_keys(path)
+    except (OSError, ValueError) as e:
+        logger.warning("reloading token keys from %s failed: %s", path, e)
+        return
+    registry.signer.set_keys(keys)
+    if shard_router is not None:
+        shard_router.broadcast(("keys", keys))
+    logger.info("reloaded %d token keys (signing with key %d)", len(keys), keys[0][0])
+
+
+def argument_limits(args):
+    # 起動時の引数のレート制限の値
+    return {name: getattr(args, name) for name in ratelimit.LIMIT_NAMES}
 
 
-def main():
-    # カウントダウンのためのスレッドを作成
-    chatroom_thread = threading.Thread(target=enter_chatroom)
+def reload_rate_limits(path: str, defaults):
+    # 設定ファイルに書いてある値だけ変える（書いていないものは defaults、つまり起動時の引数の値に戻す）
+    # 前回読んだ値の上に重ねると、ファイルから消した名前が前回の値のまま残るので、毎回作り直す
+    limits = dict(defaults)
+    try:
+        limits.update(ratelimit.load_limits(path))
+    except (OSError, ValueError) as e:
+        logger.warning("reloading rate limits from %s failed: %s", path, e)
+        return
+    set_rate_limits(limits)
+    if shard_router is not None:
+        shard_router.broadcast(("limits", limits))
+    logger.info(
+        "rate limits: %s",
+        " ".join("{}={:g}".format(name, limits[name]) for name in limits),
+    )
+
+
+def reload_config(args):
+    # SIGHUP で読み直す
+    if args.signed_tokens and args.token_keys:
+        reload_token_keys(args.token_keys)
+    if args.rate_limits:
+        reload_rate_limits(args.rate_limits, argument_limits(args))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Online Chat Messenger server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--tcp-port", type=int, default=9002)
+    parser.add_argument("--udp-port", type=int, default=9001)
+    parser.add_argument(
+        "--text-frames",
+        action="store_true",
+        help="従来のテキスト形式（ルーム名:トークン:ユーザー名:メッセージ）でUDPメッセージをやり取りする",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="リレーを行うワーカープロセスの数（0の場合はこのプロセスの1スレッドでリレーする）",
+    )
+    parser.add_argument(
+        "--client-timeout",
+        type=float,
+        default=DEFAULT_CLIENT_TIMEOUT,
+        help="無操作のクライアントを退出させるまでの時間（秒）",
+    )
+    parser.add_argument(
+        "--backlog",
+        type=int,
+        default=DEFAULT_BACKLOG,
+        help="TCPハンドシェイク用のlisten()バックログ",
+    )
+    parser.add_argument(
+        "--read-timeout",
+        type=float,
+        default=DEFAULT_READ_TIMEOUT,
+        help="ハンドシェイク中の1回の読み込みのタイムアウト（秒）",
+    )
+    parser.add_argument(
+        "--control-idle-timeout",
+        type=float,
+        default=DEFAULT_CONTROL_IDLE_TIMEOUT,
+        help="制御用の接続でリクエストが来ないまま待つ時間（秒）。過ぎると接続を閉じる",
+    )
+    parser.add_argument(
+        "--history",
+        type=int,
+        default=DEFAULT_HISTORY_SIZE,
+        help="ルームごとに残しておくメッセージの数（参加時・再接続時に送り直す。バイナリフレームのみ）",
+    )
+    parser.add_argument(
+        "--signed-tokens",
+        action="store_true",
+        help="ユーザーごとのトークンを保存せず、ルーム名・ユーザーID・有効期限を入れた署名付きトークンを発行する",
+    )
+    parser.add_argument(
+        "--token-keys",
+        default=None,
+        help="署名に使う鍵のファイル（1行に「鍵ID 16進数の鍵」、先頭の鍵で署名する）。SIGHUP で読み直す",
+    )
+    parser.add_argument(
+        "--token-lifetime",
+        type=int,
+        default=tokens.DEFAULT_TOKEN_LIFETIME,
+        help="署名付きトークンの有効期限（秒）",
+    )
+    parser.add_argument(
+        "--state-dir",
+        default=None,
+        help="ルームとセッションを保存するディレクトリ（指定した場合、再起動しても前回の状態から始める）",
+    )
+    parser.add_argument(
+        "--snapshot-bytes",
+        type=int,
+        default=journal.DEFAULT_SNAPSHOT_BYTES,
+        help="ジャーナルがこのバイト数を超えたらスナップショットを取る",
+    )
+    parser.add_argument(
+        "--coalesce-ms",
+        type=float,
+        default=0,
+        help="同じ受信者へのメッセージをこの時間（ミリ秒）ためて1つのデータグラムで送る（0の場合はまとめない。バイナリフレームのみ）",
+    )
+    parser.add_argument(
+        "--peers",
+        nargs="+",
+        default=[],
+        metavar="HOST:PORT",
+        help="フェデレーションする他のノードのUDPアドレス（全ノードを互いに指定する）",
+    )
+    parser.add_argument(
+        "--node-id",
+        type=int,
+        default=None,
+        help="フェデレーションでのこのノードのID（0〜65535、ノードごとに違う値。省略した場合はランダム）",
+    )
+    parser.add_argument(
+        "--client-rate",
+        type=float,
+        default=0,
+        help="送信元アドレスごとに1秒あたりに受け付けるデータグラムの数（0の場合は制限しない）",
+    )
+    parser.add_argument(
+        "--client-burst",
+        type=float,
+        default=0,
+        help="送信元アドレスごとに一度に受け付けるデータグラムの数（0の場合は1秒分）",
+    )
+    parser.add_argument(
+        "--room-rate",
+        type=float,
+        default=0,
+        help="ルームごとに1秒あたりにリレーするメッセージの数（0の場合は制限しない）",
+    )
+    parser.add_argument(
+        "--room-burst",
+        type=float,
+        default=0,
+        help="ルームごとに一度にリレーするメッセージの数（0の場合は1秒分）",
+    )
+    parser.add_argument(
+        "--rate-limits",
+        default=None,
+        help="レート制限の設定ファイル（1行に「名前 値」、名前は client_rate など）。SIGHUP で読み直す",
+    )
+    parser.add_argument(
+        "--throttle-replies",
+        action="store_true",
+        help="制限を超えたデータグラムを捨てた時に、送信者に通知を返す",
+    )
+    parser.add_argument(
+        "--log-level",
+        default="info",
+        choices=["debug", "info", "warning", "error"],
+        help="ログの出力レベル",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=0,
+        help="計測値を公開するHTTPのポート（/metrics と /metrics.json、0の場合は公開しない）",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=0,
+        help="計測値の要約をログに出す間隔（秒、0の場合は出さない）",
+    )
+    args = parser.parse_args(argv)
+    if args.peers and args.workers > 0:
+        # ワーカーはピアのアドレスではないポートから送るので、今は1スレッドのリレーだけで使える
+        parser.error("--peers cannot be used with --workers")
+    return args
+
+
+def main(argv=None):
+    global shard_router, log_debug, send_throttle_replies, federation_node, coalescer
+    args = parse_args(argv)
+    expiry_scheduler.timeout_period = args.client_timeout
+    logging.basicConfig(
+        level=args.log_level.upper(),
+        format="%(asctime)s %(levelname)s %(processName)s %(message)s",
+    )
+    log_debug = logger.isEnabledFor(logging.DEBUG)
+    # テキスト形式には番号がなく履歴を送り直せないので、履歴は持たない
+    history_size = 0 if args.text_frames else args.history
+    # まとめ送りもテキスト形式ではできない
+    coalesce_window = 0.0 if args.text_frames else args.coalesce_ms / 1000
+
+    if args.signed_tokens:
+        keys = tokens.load_keys(args.token_keys) if args.token_keys else None
+        registry.signer = tokens.TokenSigner(
+            keys or tokens.generate_keys(), args.token_lifetime
+        )
+
+    limits = argument_limits(args)
+    if args.rate_limits:
+        limits.update(ratelimit.load_limits(args.rate_limits))
+    set_rate_limits(limits)
+    send_throttle_replies = args.throttle_replies
+
+    if args.peers:
+        node_id = args.node_id
+        if node_id is None:
+            node_id = secrets.randbits(16)
+        federation_node = federation.Federation(
+            node_id, [federation.parse_peer(peer) for peer in args.peers]
+        )
+        metrics.gauge("federation_duplicates", lambda: federation_node.duplicates)
+        metrics.gauge("federation_rooms", lambda: len(federation_node.rooms))
+        logger.info("federating as node %d with %s", node_id, " ".join(args.peers))
+
+    # ワーカーはスレッドを作る前に起動しておく（fork時にスレッドを持ち込まないため）
+    if args.workers > 0:
+        # 9001番はワーカーからの送信にも使うので、起動する前に bind しておく
+        udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_sock.bind((args.host, args.udp_port))
+        # 履歴はリレーを行うワーカーが持つ
+        shard_router = start_workers(
+            udp_sock,
+            args.workers,
+            args.text_frames,
+            args.client_timeout,
+            history_size,
+            registry.signer,
+            limits,
+            args.throttle_replies,
+            coalesce_window,
+        )
+        registry.shard_count = args.workers
+    else:
+        registry.history_size = history_size
+        if coalesce_window > 0:
+            coalescer = RelayCoalescer(coalesce_window)
+
+    # 前回の状態をジャーナルから復元して、リレー側（ワーカー）にも登録し直す
+    if args.state_dir:
+        state = journal.Journal(args.state_dir, args.snapshot_bytes)
+        started = time.perf_counter()
+        registry.restore(state.recover())
+        registry.next_userid = max(registry.next_userid, state.next_userid)
+        restored = 0
+        for room in registry.rooms.values():
+            for client in room.active_clients.values():
+                register_client(room, client)
+                restored += 1
+        logger.info(
+            "restored %d rooms and %d sessions from %s in %.2fs",
+            len(registry.rooms),
+            restored,
+            args.state_dir,
+            time.perf_counter() - started,
+        )
+        registry.journal = state
+        state.start(registry.dump)
+        metrics.gauge("journal_backlog", state.backlog)
+
+    # ハンドシェイク（TCP）のためのスレッドを作成
+    chatroom_thread = threading.Thread(
+        target=enter_chatroom,
+        args=(
+            args.host,
+            args.tcp_port,
+            args.backlog,
+            args.read_timeout,
+            args.text_frames,
+            args.control_idle_timeout,
+        ),
+    )
 
     # メッセージ出力のためのスレッドを作成
-    sendchat_thread = threading.Thread(target=send_chat)
+    if shard_router is not None:
+        sendchat_thread = threading.Thread(
+            target=dispatch_datagrams,
+            args=(udp_sock, shard_router, args.text_frames),
+        )
+    else:
+        sendchat_thread = threading.Thread(
+            target=send_chat, args=(args.host, args.udp_port, args.text_frames)
+        )
+
+    if (args.signed_tokens and args.token_keys) or args.rate_limits:
+        signal.signal(signal.SIGHUP, lambda *_: reload_config(args))
+
+    # 計測値の公開とログへの定期出力
+    if args.metrics_port:
+        metrics_module.serve(collect_metrics, "127.0.0.1", args.metrics_port)
+        logger.info("metrics on http://127.0.0.1:%d/metrics", args.metrics_port)
+    if args.metrics_interval > 0:
+        metrics_module.report_periodically(
+            collect_metrics, args.metrics_interval, logger.info
+        )
 
     # スレッドを開始
     chatroom_thread.start()
@@ -287,4 +2080,5 @@ def main():
     # 必要に応じて他の方法でスレッドの終了を管理する
 
 
-main()
+if __name__ == "__main__":
+    main()
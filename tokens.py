@@ -0,0 +1,118 @@
+import hashlib
+import hmac
+import secrets
+import struct
+import time
+
+# 署名付きトークン（--signed-tokens の時に使う）
+#
+# トークンの中にユーザーID・ルーム名・発行時刻・有効期限を入れて HMAC-SHA256 で署名しておく。
+# サーバはユーザーごとの秘密のトークンを持たずに、署名の確認1回でトークンを検証できる。
+#
+#   Version（1） | KeyID（1） | UserID（4） | IssuedAt（4） | ExpiresAt（4） | RoomNameSize（1） | RoomName | MAC（16）
+#
+# 鍵は鍵IDごとに複数持てる。署名には先頭の鍵を使い、検証はどの鍵でもできるので、
+# 新しい鍵を先頭に追加して古い鍵をしばらく残しておけば、発行済みのトークンを無効にせずに鍵を入れ替えられる。
+
+TOKEN_VERSION = 1
+TOKEN_HEADER = struct.Struct("!BBIIIB")
+MAC_SIZE = 16
+# ルーム名が空の場合のトークンのバイト数
+MIN_TOKEN_SIZE = TOKEN_HEADER.size + MAC_SIZE
+# 有効期限（秒）。バイナリフレームではトークンを使うのは最初のメッセージだけ
+DEFAULT_TOKEN_LIFETIME = 24 * 60 * 60
+# 無効にしたユーザーの一覧がこの件数を超えたら、期限切れのものを掃除する
+REVOKED_PURGE_SIZE = 1024
+
+
+def load_keys(path: str):
+    # 鍵ファイル: 1行に「鍵ID 秘密鍵（16進数）」。先頭の行の鍵で署名する
+    keys = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            key_id, secret = line.split()
+            keys.append((int(key_id), bytes.fromhex(secret)))
+    if not keys:
+        raise ValueError("no signing keys in {}".format(path))
+    return keys
+
+
+def generate_keys():
+    # 鍵ファイルを指定しない場合の鍵。再起動すると発行済みのトークンは使えなくなる
+    return [(1, secrets.token_bytes(32))]
+
+
+class TokenSigner:
+    def __init__(self, keys, lifetime: int = DEFAULT_TOKEN_LIFETIME):
+        self.lifetime = lifetime
+        # ユーザーID → 無効にした時刻。それ以前に発行されたトークンは使えない
+        self.revoked = {}
+        self.purge_size = REVOKED_PURGE_SIZE
+        self.set_keys(keys)
+
+    def set_keys(self, keys):
+        # keys は [(鍵ID, 秘密鍵), ...]
+        # 鍵ごとに初期化済みの HMAC を作っておき、署名のたびに copy() して使う（鍵の処理を毎回しない）
+        self.keys = {
+            key_id: hmac.new(secret, digestmod=hashlib.sha256) for key_id, secret in keys
+        }
+        self.current = keys[0][0]
+
+    def sign(self, key, body) -> bytes:
+        mac = key.copy()
+        mac.update(body)
+        return mac.digest()[:MAC_SIZE]
+
+    def issue(self, userid: int, room_name: str, now: float = None) -> bytes:
+        issued = int(time.time() if now is None else now)
+        key_id = self.current
+        room = room_name.encode("utf-8")
+        body = (
+            TOKEN_HEADER.pack(
+                TOKEN_VERSION, key_id, userid, issued, issued + self.lifetime, len(room)
+            )
+            + room
+        )
+        return body + self.sign(self.keys[key_id], body)
+
+    def verify(self, token: bytes, now: float = None):
+        # 正しいトークンなら (ユーザーID, ルーム名) を返す。そうでなければ None
+        if len(token) < MIN_TOKEN_SIZE:
+            return None
+        version, key_id, userid, issued, expires, room_size = TOKEN_HEADER.unpack_from(
+            token
+        )
+        if version != TOKEN_VERSION:
+            return None
+        if len(token) != TOKEN_HEADER.size + room_size + MAC_SIZE:
+            return None
+        key = self.keys.get(key_id)
+        if key is None:
+            return None
+        mac = self.sign(key, token[:-MAC_SIZE])
+        if not hmac.compare_digest(mac, token[-MAC_SIZE:]):
+            return None
+        if (time.time() if now is None else now) >= expires:
+            return None
+        revoked_at = self.revoked.get(userid)
+        if revoked_at is not None and issued <= revoked_at:
+            return None
+        return userid, token[TOKEN_HEADER.size : -MAC_SIZE].decode("utf-8")
+
+    def revoke(self, userid: int, now: float = None):
+        # そのユーザーにこれまでに発行したトークンをすべて無効にする
+        now = int(time.time() if now is None else now)
+        self.revoked[userid] = now
+        if len(self.revoked) > self.purge_size:
+            self.purge(now)
+            self.purge_size = max(REVOKED_PURGE_SIZE, len(self.revoked) * 2)
+
+    def purge(self, now: float):
+        # 期限が切れたトークンしか残っていないユーザーは一覧から外す
+        oldest = now - self.lifetime
+        for userid, revoked_at in list(self.revoked.items()):
+            if revoked_at < oldest:
+                del self.revoked[userid]